@@ -27,8 +27,14 @@ This module contains functions for the preprocessing phase of the
 breast cancer project.
 """
 
+from collections import namedtuple, OrderedDict
+import functools
+import hashlib
+import io
+import json
 import math
 import os
+import threading
 
 import numpy as np
 import openslide
@@ -36,8 +42,9 @@ from PIL import Image
 from openslide import OpenSlideError
 from openslide.deepzoom import DeepZoomGenerator
 import pandas as pd
-from pyspark.ml.linalg import Vectors
+from pyspark.ml.linalg import Vectors, VectorUDT
 import pyspark.sql.functions as F
+from pyspark.sql.types import BinaryType, DoubleType, IntegerType, StructField, StructType
 from scipy.ndimage.morphology import binary_fill_holes
 from skimage.color import rgb2gray
 from skimage.feature import canny
@@ -46,9 +53,9 @@ from skimage.morphology import binary_closing, binary_dilation, disk
 
 # Open Whole-Slide Image
 
-def open_slide(slide_num, folder, training):
+def get_slide_filename(slide_num, folder, training):
   """
-  Open a whole-slide image, given an image number.
+  Get the filename of a whole-slide image, given an image number.
 
   Args:
     slide_num: Slide image number as an integer.
@@ -59,7 +66,7 @@ def open_slide(slide_num, folder, training):
     training: Boolean for training or testing datasets.
 
   Returns:
-    An OpenSlide object representing a whole-slide image.
+    The path to the whole-slide image file, as a string.
   """
   if training:
     filename = os.path.join(folder, "training_image_data",
@@ -68,6 +75,25 @@ def open_slide(slide_num, folder, training):
     # Testing images
     filename = os.path.join(folder, "testing_image_data",
                             "TUPAC-TE-{}.svs".format(str(slide_num).zfill(3)))
+  return filename
+
+
+def open_slide(slide_num, folder, training):
+  """
+  Open a whole-slide image, given an image number.
+
+  Args:
+    slide_num: Slide image number as an integer.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+
+  Returns:
+    An OpenSlide object representing a whole-slide image.
+  """
+  filename = get_slide_filename(slide_num, folder, training)
   try:
     slide = openslide.open_slide(filename)
   except OpenSlideError:
@@ -102,6 +128,180 @@ def create_tile_generator(slide, tile_size, overlap):
   return generator
 
 
+# Cache Open Slides & Tile Generators
+
+SlideCacheInfo = namedtuple("SlideCacheInfo", ["hits", "misses", "evictions", "max_open", "open"])
+
+
+def get_max_open_slides(fraction=0.25, limit=64):
+  """
+  Determine a default bound on the number of simultaneously open slides.
+
+  The bound is a fraction of the soft file descriptor limit of the
+  current process, capped at `limit`, so that a slide cache never
+  starves the rest of the process (e.g. Spark shuffle files) of file
+  descriptors.
+
+  Args:
+    fraction: Fraction of the soft file descriptor limit to allow.
+    limit: Upper bound on the number of open slides.
+
+  Returns:
+    Integer maximum number of slides to keep open at once.
+  """
+  try:
+    import resource  # Unix only
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+  except (ImportError, OSError, ValueError):
+    return limit
+  if soft == resource.RLIM_INFINITY:
+    return limit
+  return max(1, min(limit, int(soft * fraction)))
+
+
+class SlideCache(object):
+  """
+  A bounded, per-process LRU cache of open slides and tile generators.
+
+  Opening a slide parses the full SVS header, and creating a tile
+  generator rebuilds the DeepZoom level tables, so doing either once
+  per tile is very wasteful.  Each Python worker process keeps a
+  single instance of this cache (see `get_slide_cache`), which maps
+  (slide_num, folder, training) to an open slide and its tile
+  generators, keyed in turn by (tile_size, overlap).  The least
+  recently used slide is evicted once more than `max_open` slides are
+  open.  Evicted slides are closed as soon as they are no longer
+  referenced elsewhere.
+
+  Attributes:
+    max_open: Maximum number of slides to keep open at once.
+    hits: Number of lookups served from the cache.
+    misses: Number of lookups that required opening a slide or
+      creating a tile generator.
+    evictions: Number of slides evicted from the cache.
+  """
+
+  def __init__(self, max_open=None):
+    self.max_open = max_open if max_open is not None else get_max_open_slides()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._slides = OrderedDict()  # (slide_num, folder, training) -> (slide, generators)
+    self._lock = threading.Lock()
+
+  def get_slide(self, slide_num, folder, training):
+    """
+    Get an open slide, opening it if necessary.
+
+    Args:
+      slide_num: Slide image number as an integer.
+      folder: Directory in which the slides folder is stored, as a string.
+      training: Boolean for training or testing datasets.
+
+    Returns:
+      An OpenSlide object representing a whole-slide image, or None if
+      the slide could not be opened.
+    """
+    with self._lock:
+      entry = self._get_entry(slide_num, folder, training)
+      if entry is None:
+        return None
+      return entry[0]
+
+  def get_tile_generator(self, slide_num, folder, training, tile_size, overlap):
+    """
+    Get an open slide and a tile generator for it.
+
+    Args:
+      slide_num: Slide image number as an integer.
+      folder: Directory in which the slides folder is stored, as a string.
+      training: Boolean for training or testing datasets.
+      tile_size: The width and height of a square tile to be generated.
+      overlap: Number of pixels by which to overlap the tiles.
+
+    Returns:
+      A (slide, generator) tuple of an OpenSlide object and a
+      DeepZoomGenerator object, or (None, None) if the slide could not
+      be opened.
+    """
+    with self._lock:
+      entry = self._get_entry(slide_num, folder, training, (tile_size, overlap))
+      if entry is None:
+        return None, None
+      slide, generators = entry
+      if (tile_size, overlap) not in generators:
+        generators[(tile_size, overlap)] = create_tile_generator(slide, tile_size, overlap)
+      return slide, generators[(tile_size, overlap)]
+
+  def info(self):
+    """
+    Return a SlideCacheInfo tuple of the cache statistics.
+    """
+    with self._lock:
+      return SlideCacheInfo(self.hits, self.misses, self.evictions, self.max_open,
+                            len(self._slides))
+
+  def clear(self):
+    """
+    Drop all cached slides and generators, and reset the statistics.
+    """
+    with self._lock:
+      self._slides.clear()
+      self.hits = self.misses = self.evictions = 0
+
+  def _get_entry(self, slide_num, folder, training, generator_key=None):
+    # Look up (and possibly open) a slide entry, counting a hit only if
+    # everything requested is already cached.  Must hold `self._lock`.
+    key = (slide_num, folder, training)
+    entry = self._slides.get(key)
+    if entry is not None:
+      self._slides.move_to_end(key)
+      if generator_key is None or generator_key in entry[1]:
+        self.hits += 1
+      else:
+        self.misses += 1
+      return entry
+    self.misses += 1
+    slide = open_slide(slide_num, folder, training)
+    if slide is None:
+      return None
+    entry = (slide, {})
+    self._slides[key] = entry
+    while len(self._slides) > self.max_open:
+      # Drop the least recently used slide.  The underlying handle is
+      # closed once any in-flight users release their references.
+      self._slides.popitem(last=False)
+      self.evictions += 1
+    return entry
+
+
+_slide_cache = SlideCache()
+
+
+def get_slide_cache():
+  """
+  Get the slide cache of the current process.
+
+  On Spark, each executor Python worker process has its own cache, so
+  the statistics can be gathered from the executors with, e.g.,
+  `rdd.mapPartitions(lambda _: [slide_cache_info()]).collect()`.
+
+  Returns:
+    The SlideCache object for this process.
+  """
+  return _slide_cache
+
+
+def slide_cache_info():
+  """
+  Get the statistics of the slide cache of the current process.
+
+  Returns:
+    A SlideCacheInfo (hits, misses, evictions, max_open, open) tuple.
+  """
+  return _slide_cache.info()
+
+
 # Determine 20x Magnification Zoom Level
 
 def get_20x_zoom_level(slide, generator):
@@ -140,9 +340,79 @@ def get_20x_zoom_level(slide, generator):
   return level
 
 
+# Create Low-Resolution Tissue Mask
+
+def get_tissue_mask(slide, max_size=2048, beta=0.15):
+  """
+  Create a low-resolution tissue mask for a whole-slide image.
+
+  The mask is computed from the lowest resolution level of the slide,
+  or from a thumbnail if that level is larger than `max_size`, using
+  the same optical density threshold as the second check of
+  `keep_tile`, followed by a small amount of morphology.
+
+  Args:
+    slide: An OpenSlide object representing a whole-slide image.
+    max_size: Maximum width or height of the image from which the mask
+      is computed.
+    beta: Optical density threshold below which a pixel is considered
+      to be background.
+
+  Returns:
+    A 2D boolean NumPy array covering the entire slide, in which True
+    indicates tissue.
+  """
+  level = slide.level_count - 1
+  w, h = slide.level_dimensions[level]
+  if max(w, h) <= max_size:
+    thumb = slide.read_region((0, 0), level, (w, h))
+  else:
+    thumb = slide.get_thumbnail((max_size, max_size))
+  thumb = np.asarray(thumb)
+  rgb = thumb[:, :, :3].copy()
+  if thumb.shape[2] == 4:
+    # Treat transparent pixels, i.e. areas outside of the scanned
+    # region, as plain background.
+    rgb[thumb[:, :, 3] == 0] = 255
+  mask = np.min(optical_density(rgb), axis=2) >= beta
+  mask = binary_closing(mask, get_disk(2))
+  mask = binary_dilation(mask, get_disk(2))
+  mask = binary_fill_holes(mask)
+  return mask
+
+
+def get_tile_tissue_fraction(mask, slide, generator, zoom_level, col, row):
+  """
+  Compute the fraction of a tile's footprint covered by tissue.
+
+  Args:
+    mask: A 2D boolean NumPy array covering the entire slide, as
+      returned by `get_tissue_mask`.
+    slide: An OpenSlide object representing a whole-slide image.
+    generator: A DeepZoomGenerator object representing a tile generator.
+    zoom_level: Zoom level of the tile.
+    col: Column of the tile.
+    row: Row of the tile.
+
+  Returns:
+    The fraction of the tile's footprint on the mask that is tissue.
+  """
+  (x, y), level, (w, h) = generator.get_tile_coordinates(zoom_level, (col, row))
+  downsample = slide.level_downsamples[level]
+  width, height = slide.dimensions
+  mask_h, mask_w = mask.shape
+  scale_x = mask_w / width
+  scale_y = mask_h / height
+  x_lower = min(int(x * scale_x), mask_w - 1)
+  y_lower = min(int(y * scale_y), mask_h - 1)
+  x_upper = max(int(math.ceil((x + w * downsample) * scale_x)), x_lower + 1)
+  y_upper = max(int(math.ceil((y + h * downsample) * scale_y)), y_lower + 1)
+  return mask[y_lower:y_upper, x_lower:x_upper].mean()
+
+
 # Generate Tile Indices For Whole-Slide Image.
 
-def process_slide(slide_num, folder, training, tile_size, overlap):
+def process_slide(slide_num, folder, training, tile_size, overlap, prescreen_threshold=None):
   """
   Generate all possible tile indices for a whole-slide image.
 
@@ -159,24 +429,125 @@ def process_slide(slide_num, folder, training, tile_size, overlap):
     training: Boolean for training or testing datasets.
     tile_size: The width and height of a square tile to be generated.
     overlap: Number of pixels by which to overlap the tiles.
+    prescreen_threshold: Optional minimum fraction of a tile's
+      footprint on a low-resolution tissue mask of the slide that must
+      be tissue for the tile to be included.  If None, all tiles are
+      included.  Since this is only a screening step before the full
+      resolution `keep_tile` filter, it should be set conservatively
+      below the final tissue threshold.
 
   Returns:
     A list of (slide_num, tile_size, overlap, zoom_level, col, row)
     integer index tuples representing possible tiles to extract.
   """
-  # Open slide.
-  slide = open_slide(slide_num, folder, training)
-  # Create tile generator.
-  generator = create_tile_generator(slide, tile_size, overlap)
+  # Open slide & create tile generator, reusing any cached ones.
+  slide, generator = get_slide_cache().get_tile_generator(slide_num, folder, training, tile_size,
+                                                          overlap)
   # Get 20x zoom level.
   zoom_level = get_20x_zoom_level(slide, generator)
   # Generate all possible (zoom_level, col, row) tile index tuples.
   cols, rows = generator.level_tiles[zoom_level]
   tile_indices = [(slide_num, tile_size, overlap, zoom_level, col, row)
                   for col in range(cols) for row in range(rows)]
+  if prescreen_threshold is not None:
+    # Drop tiles that are mostly background according to a low-resolution
+    # tissue mask, without ever reading them at full resolution.
+    mask = get_tissue_mask(slide)
+    tile_indices = [tile_index for tile_index in tile_indices
+                    if get_tile_tissue_fraction(mask, slide, generator, zoom_level, tile_index[4],
+                                                tile_index[5]) >= prescreen_threshold]
   return tile_indices
 
 
+# Split Tile Indices Into Contiguous Runs
+
+def get_tile_runs(tile_indices, tiles_per_partition):
+  """
+  Split the tile indices of a single slide into contiguous runs.
+
+  The tile indices are ordered row by row, i.e. in the order in which
+  the tiles are laid out in the slide file, and then cut into runs of
+  at most `tiles_per_partition` tiles, so that processing a run reads
+  neighbouring regions of the slide with a single open handle.
+
+  Args:
+    tile_indices: A list of (slide_num, tile_size, overlap, zoom_level,
+      col, row) integer index tuples from a single slide.
+    tiles_per_partition: Maximum number of tiles in each run.
+
+  Returns:
+    A list of runs, each of which is a list of tile index tuples.
+  """
+  tile_indices = sorted(tile_indices, key=lambda tile_index: (tile_index[5], tile_index[4]))
+  return [tile_indices[i:i+tiles_per_partition]
+          for i in range(0, len(tile_indices), tiles_per_partition)]
+
+
+# Sample Tile Indices
+
+def in_tile_sample(tile_index, frac, seed=None):
+  """
+  Determine if a tile is part of a random sample of tiles.
+
+  The decision is based on a hash of the tile index and the seed, so
+  it is deterministic, independent of the order and partitioning of
+  the tiles, and consistent across sample fractions, i.e. a sample is
+  a subset of any larger sample with the same seed.
+
+  Args:
+    tile_index: A (slide_num, tile_size, overlap, zoom_level, col, row)
+      integer index tuple.
+    frac: Fraction of tiles to keep, in [0, 1].
+    seed: Optional random seed.
+
+  Returns:
+    A Boolean indicating whether or not the tile is in the sample.
+  """
+  key = "{}_{}".format(seed, "_".join(str(int(x)) for x in tile_index)).encode()
+  u = int.from_bytes(hashlib.md5(key).digest()[:8], "little") / 2**64
+  return u < frac
+
+
+def sample_tile_indices(tile_indices, fractions, seed=None):
+  """
+  Sample a set of tile indices, stratified by slide.
+
+  Args:
+    tile_indices: An iterable of (slide_num, tile_size, overlap,
+      zoom_level, col, row) integer index tuples.
+    fractions: Fraction of tiles to keep, either for all slides, or as a
+      dictionary mapping each slide number to a fraction.  Slides that
+      are missing from the dictionary are dropped.
+    seed: Optional random seed.
+
+  Returns:
+    A list of the tile indices in the sample.
+  """
+  if isinstance(fractions, dict):
+    return [tile_index for tile_index in tile_indices
+            if in_tile_sample(tile_index, fractions.get(tile_index[0], 0), seed)]
+  return [tile_index for tile_index in tile_indices if in_tile_sample(tile_index, fractions, seed)]
+
+
+def get_slide_sample_fractions(sample_frac, slide_nums, labels):
+  """
+  Get the tile sampling fraction of each slide, stratified by class.
+
+  Args:
+    sample_frac: Fraction of tiles to keep, either for all classes, or
+      as a dictionary mapping each tumor score to a fraction.
+    slide_nums: List of whole-slide numbers.
+    labels: An array of labels, as returned by `get_labels_array`.
+
+  Returns:
+    A dictionary mapping each slide number to a fraction.
+  """
+  if not isinstance(sample_frac, dict):
+    return {int(slide_num): sample_frac for slide_num in slide_nums}
+  return {int(slide_num): sample_frac.get(int(labels[slide_num]["tumor_score"]), 0)
+          for slide_num in slide_nums}
+
+
 # Generate Tile From Tile Index
 
 def process_tile_index(tile_index, folder, training):
@@ -201,15 +572,41 @@ def process_tile_index(tile_index, folder, training):
     RGB format.
   """
   slide_num, tile_size, overlap, zoom_level, col, row = tile_index
-  # Open slide.
-  slide = open_slide(slide_num, folder, training)
-  # Create tile generator.
-  generator = create_tile_generator(slide, tile_size, overlap)
+  # Open slide & create tile generator, reusing any cached ones.
+  slide, generator = get_slide_cache().get_tile_generator(slide_num, folder, training, tile_size,
+                                                          overlap)
   # Generate tile.
   tile = np.asarray(generator.get_tile(zoom_level, (col, row)))
   return (slide_num, tile)
 
 
+def process_tile_indices(tile_indices, folder, training):
+  """
+  Generate tiles from an iterable of tile indices.
+
+  This is meant to be used with `mapPartitions` on a partition of
+  tiles from a single slide, in which case the slide is opened once
+  for the entire partition.
+
+  Args:
+    tile_indices: An iterable of (slide_num, tile_size, overlap,
+      zoom_level, col, row) integer index tuples representing tiles to
+      extract.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+
+  Returns:
+    Yields (slide_num, tile) tuples, where slide_num is an integer, and
+    tile is a 3D NumPy array of shape (tile_size, tile_size, channels)
+    in RGB format.
+  """
+  for tile_index in tile_indices:
+    yield process_tile_index(tile_index, folder, training)
+
+
 # Filter Tile For Dimensions & Tissue Threshold
 
 def optical_density(tile):
@@ -229,7 +626,128 @@ def optical_density(tile):
   return od
 
 
-def keep_tile(tile_tuple, tile_size, tissue_threshold):
+# Luminance weights used by `skimage.color.rgb2gray`, scaled to map 8-bit
+# RGB values directly to grayscale values in [0, 1].
+GRAY_WEIGHTS = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32) / 255
+
+
+@functools.lru_cache(maxsize=None)
+def get_disk(radius):
+  """
+  Get a cached, read-only disk-shaped structuring element.
+
+  Args:
+    radius: Integer radius of the disk.
+
+  Returns:
+    A 2D uint8 NumPy array equal to `disk(radius)`.
+  """
+  selem = disk(radius)
+  selem.setflags(write=False)
+  return selem
+
+
+def downsample_mask(mask, factor):
+  """
+  Downsample a binary mask by an integer factor.
+
+  A pixel of the downsampled mask is set if any pixel of the
+  corresponding (factor, factor) block of the original mask is set.
+
+  Args:
+    mask: A 2D boolean NumPy array.
+    factor: Integer downsampling factor.
+
+  Returns:
+    A 2D boolean NumPy array of shape
+    (ceil(h / factor), ceil(w / factor)).
+  """
+  if factor == 1:
+    return mask
+  h, w = mask.shape
+  mask = np.pad(mask, ((0, -h % factor), (0, -w % factor)), "constant")
+  return mask.reshape(mask.shape[0] // factor, factor, mask.shape[1] // factor, factor).any(3).any(1)
+
+
+def tissue_percentage_edges(tile, downsample=1):
+  """
+  Estimate the tissue percentage of a tile from its edges.
+
+  This is the first check of `keep_tile`.
+
+  Args:
+    tile: A 3D NumPy array of shape (tile_size, tile_size, channels)
+      with 8-bit RGB values.
+    downsample: Integer factor by which to downsample the edge map
+      before applying morphology.  The structuring elements are scaled
+      down by the same factor.  A factor of 1 reproduces the full
+      resolution computation.
+
+  Returns:
+    The fraction of the tile that is considered to be tissue.
+  """
+  # Convert 3D RGB image to 2D grayscale image, from
+  # 0 (dense tissue) to 1 (plain background), and then take the
+  # 8-bit depth complement, from 1 (dense tissue) to 0 (plain
+  # background).  This is equivalent to `1 - rgb2gray(tile)`,
+  # but in float32 and without an intermediate float64 copy.
+  gray = 1 - np.dot(tile[:, :, :3], GRAY_WEIGHTS)
+  # Canny edge detection with hysteresis thresholding.
+  # This returns a binary map of edges, with 1 equal to
+  # an edge. The idea is that tissue would be full of
+  # edges, while background would not.
+  edges = canny(gray)
+  edges = downsample_mask(edges, downsample)
+  selem = get_disk(max(1, round(10 / downsample)))
+  # Binary closing, which is a dilation followed by
+  # an erosion. This removes small dark spots, which
+  # helps remove noise in the background.
+  mask = binary_closing(edges, selem)
+  # Binary dilation, which enlarges bright areas,
+  # and shrinks dark areas. This helps fill in holes
+  # within regions of tissue.
+  mask = binary_dilation(mask, selem)
+  # Fill remaining holes within regions of tissue.
+  mask = binary_fill_holes(mask)
+  # Calculate percentage of tissue coverage.
+  return mask.mean()
+
+
+def tissue_percentage_od(tile, downsample=1, beta=0.15):
+  """
+  Estimate the tissue percentage of a tile from its optical density.
+
+  This is the second check of `keep_tile`.
+
+  Args:
+    tile: A 3D NumPy array of shape (tile_size, tile_size, channels)
+      with 8-bit RGB values.
+    downsample: Integer factor by which to downsample the thresholded
+      tile before applying morphology.  The structuring elements are
+      scaled down by the same factor.  A factor of 1 reproduces the
+      full resolution computation.
+    beta: Optical density threshold below which a pixel is considered
+      to be background.
+
+  Returns:
+    The fraction of the tile that is considered to be tissue.
+  """
+  # Threshold the optical density of every channel at beta.  Since
+  # `optical_density` is monotonically decreasing, `od >= beta` is
+  # equivalent to `tile <= 240 * exp(-beta) - 1`, which can be
+  # checked directly on the raw values.
+  max_value = 240 * math.exp(-beta) - 1
+  mask = np.max(tile[:, :, :3], axis=2) <= max_value
+  mask = downsample_mask(mask, downsample)
+  selem = get_disk(max(1, round(2 / downsample)))
+  # Apply morphology for same reasons as in the first check.
+  mask = binary_closing(mask, selem)
+  mask = binary_dilation(mask, selem)
+  mask = binary_fill_holes(mask)
+  return mask.mean()
+
+
+def keep_tile(tile_tuple, tile_size, tissue_threshold, downsample=1):
   """
   Determine if a tile should be kept.
 
@@ -245,62 +763,179 @@ def keep_tile(tile_tuple, tile_size, tissue_threshold):
       (tile_size, tile_size, channels).
     tile_size: The width and height of a square tile to be generated.
     tissue_threshold: Tissue percentage threshold.
+    downsample: Integer factor by which to downsample the binary maps
+      of both checks before applying morphology.  Values greater than 1
+      trade exactness for speed.
 
   Returns:
     A Boolean indicating whether or not a tile should be kept for
     future usage.
   """
   slide_num, tile = tile_tuple
-  if tile.shape[0:2] == (tile_size, tile_size):
-    tile_orig = tile
-
-    # Check 1
-    # Convert 3D RGB image to 2D grayscale image, from
-    # 0 (dense tissue) to 1 (plain background).
-    tile = rgb2gray(tile)
-    # 8-bit depth complement, from 1 (dense tissue)
-    # to 0 (plain background).
-    tile = 1 - tile
-    # Canny edge detection with hysteresis thresholding.
-    # This returns a binary map of edges, with 1 equal to
-    # an edge. The idea is that tissue would be full of
-    # edges, while background would not.
-    tile = canny(tile)
-    # Binary closing, which is a dilation followed by
-    # an erosion. This removes small dark spots, which
-    # helps remove noise in the background.
-    tile = binary_closing(tile, disk(10))
-    # Binary dilation, which enlarges bright areas,
-    # and shrinks dark areas. This helps fill in holes
-    # within regions of tissue.
-    tile = binary_dilation(tile, disk(10))
-    # Fill remaining holes within regions of tissue.
-    tile = binary_fill_holes(tile)
-    # Calculate percentage of tissue coverage.
-    percentage = tile.mean()
-    check1 = percentage >= tissue_threshold
-
-    # Check 2
-    # Convert to optical density values
-    tile = optical_density(tile_orig)
-    # Threshold at beta
-    beta = 0.15
-    tile = np.min(tile, axis=2) >= beta
-    # Apply morphology for same reasons as above.
-    tile = binary_closing(tile, disk(2))
-    tile = binary_dilation(tile, disk(2))
-    tile = binary_fill_holes(tile)
-    percentage = tile.mean()
-    check2 = percentage >= tissue_threshold
-
-    return check1 and check2
-  else:
+  if tile.shape[0:2] != (tile_size, tile_size):
     return False
+  # The optical density check is much cheaper than the edge-based
+  # check, so run it first and skip the latter if it already fails.
+  if tissue_percentage_od(tile, downsample) < tissue_threshold:
+    return False
+  return tissue_percentage_edges(tile, downsample) >= tissue_threshold
+
+
+# Catalogue Tissue Percentages Of Tiles
+
+CATALOGUE_PARTITION_COLUMNS = ["tile_size", "overlap", "tissue_downsample", "slide_num"]
+
+
+def get_tile_tissue_percentages(tile_index, folder, training, downsample=1):
+  """
+  Compute the tissue percentages of a tile from both tissue checks.
+
+  Args:
+    tile_index: A (slide_num, tile_size, overlap, zoom_level, col, row)
+      integer index tuple representing a tile to extract.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+    downsample: Integer factor by which to downsample the binary maps
+      of both checks.  See `keep_tile`.
+
+  Returns:
+    An (od_percentage, edges_percentage) tuple of the results of
+    `tissue_percentage_od` and `tissue_percentage_edges`, or None if the
+    tile is not of size (tile_size, tile_size), i.e. would never be kept.
+  """
+  tile_size = tile_index[1]
+  _, tile = process_tile_index(tile_index, folder, training)
+  if tile.shape[0:2] != (tile_size, tile_size):
+    return None
+  return (float(tissue_percentage_od(tile, downsample)),
+          float(tissue_percentage_edges(tile, downsample)))
+
+
+def build_tile_catalogue(spark, slide_nums, folder, training, tile_size, overlap,
+                         tissue_downsample=1, num_partitions=20000):
+  """
+  Build a catalogue of the tissue percentages of all tiles of a set of slides.
+
+  The catalogue holds both tissue percentages that `keep_tile` checks
+  for every full-size tile, so that the tiles can later be filtered
+  against any tissue threshold with `filter_tile_catalogue`, without
+  reading any pixels.
+
+  Args:
+    spark: SparkSession.
+    slide_nums: List of whole-slide numbers to process.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+    tile_size: The width and height of a square tile to be generated.
+    overlap: Number of pixels by which to overlap the tiles.
+    tissue_downsample: Integer factor by which to downsample tiles
+      during tissue detection.  See `keep_tile`.
+    num_partitions: Number of partitions to use during processing.
+
+  Returns:
+    A Spark DataFrame with "slide_num", "tile_size", "overlap",
+    "zoom_level", "col", "row", "tissue_downsample", "od_percentage",
+    and "edges_percentage" columns.
+  """
+  tile_indices = (spark.sparkContext
+      .parallelize(slide_nums)
+      .filter(lambda slide: get_slide_cache().get_slide(slide, folder, training) is not None)
+      .flatMap(lambda slide: process_slide(slide, folder, training, tile_size, overlap))
+      .repartition(num_partitions))
+  rows = (tile_indices
+      .map(lambda tile_index: (tile_index, get_tile_tissue_percentages(tile_index, folder,
+                                                                         training,
+                                                                         tissue_downsample)))
+      .filter(lambda row: row[1] is not None)
+      .map(lambda row: tuple(int(x) for x in row[0]) + (int(tissue_downsample),) + row[1]))
+  schema = StructType([StructField(name, IntegerType()) for name in TILE_INDEX_COLUMNS] +
+                      [StructField("tissue_downsample", IntegerType()),
+                       StructField("od_percentage", DoubleType()),
+                       StructField("edges_percentage", DoubleType())])
+  return spark.createDataFrame(rows, schema)
+
+
+def get_tile_catalogue(spark, slide_nums, folder, training, tile_size, overlap, path,
+                       tissue_downsample=1, num_partitions=20000):
+  """
+  Get the tile catalogue of a set of slides, building it where missing.
+
+  The catalogue is saved at `path` as Parquet, partitioned by
+  `CATALOGUE_PARTITION_COLUMNS`, so that a single catalogue can hold
+  the entries of any number of tile sizes, overlaps, and tissue
+  downsampling factors.  Slides that are not yet catalogued for the
+  given settings are built with `build_tile_catalogue` and added.
+
+  Args:
+    spark: SparkSession.
+    slide_nums: List of whole-slide numbers.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+    tile_size: The width and height of a square tile to be generated.
+    overlap: Number of pixels by which to overlap the tiles.
+    path: Hadoop-supported path of the catalogue.
+    tissue_downsample: Integer factor by which to downsample tiles
+      during tissue detection.  See `keep_tile`.
+    num_partitions: Number of partitions to use while building the
+      catalogue for any missing slides.
+
+  Returns:
+    A Spark DataFrame of the catalogue entries of the given slides, as
+    returned by `build_tile_catalogue`.
+  """
+  from pyspark.sql.utils import AnalysisException
+
+  slide_nums = [int(slide_num) for slide_num in slide_nums]
+  settings = ((F.col("tile_size") == tile_size) & (F.col("overlap") == overlap) &
+              (F.col("tissue_downsample") == tissue_downsample))
+  try:
+    catalogued = {row.slide_num for row in
+                  spark.read.parquet(path).where(settings).select("slide_num").distinct().collect()}
+  except AnalysisException:  # no catalogue yet
+    catalogued = set()
+  missing = [slide_num for slide_num in slide_nums if slide_num not in catalogued]
+  if missing:
+    df = build_tile_catalogue(spark, missing, folder, training, tile_size, overlap,
+                              tissue_downsample, num_partitions)
+    # Only replace the partitions of the newly catalogued slides.
+    (df.write.partitionBy(*CATALOGUE_PARTITION_COLUMNS)
+             .option("partitionOverwriteMode", "dynamic")
+             .mode("overwrite")
+             .parquet(path))
+  return spark.read.parquet(path).where(settings & F.col("slide_num").isin(slide_nums))
+
+
+def filter_tile_catalogue(df, tissue_threshold):
+  """
+  Filter a tile catalogue down to the tiles that should be kept.
+
+  This makes the same decisions as `keep_tile`, without reading any
+  pixels.
+
+  Args:
+    df: A Spark DataFrame of tile catalogue entries, as returned by
+      `get_tile_catalogue`.
+    tissue_threshold: Tissue percentage threshold.
+
+  Returns:
+    A Spark DataFrame of the entries of the tiles that should be kept.
+  """
+  return df.where((F.col("od_percentage") >= tissue_threshold) &
+                  (F.col("edges_percentage") >= tissue_threshold))
 
 
 # Generate Samples From Tile
 
-def process_tile(tile_tuple, sample_size, grayscale):
+def process_tile(tile_tuple, sample_size, grayscale, batch=False, tile_index=None):
   """
   Process a tile into a group of smaller samples.
 
@@ -317,11 +952,22 @@ def process_tile(tile_tuple, sample_size, grayscale):
       generated.
     grayscale: Whether or not to generate grayscale samples, rather
       than RGB.
+    batch: Whether or not to return all samples of the tile as a single
+      batch, rather than as a list of separate sample tuples.
+    tile_index: Optional (slide_num, tile_size, overlap, zoom_level,
+      col, row) index of the tile, from which to compute the
+      coordinates of the samples in a batch.
 
   Returns:
     A list of (slide_num, sample) tuples representing cut up tiles,
     where each sample is a 3D NumPy array of shape
-    (sample_size_x, sample_size_y, channels).
+    (sample_size_x, sample_size_y, channels).  If `batch` is true, a
+    single (slide_num, coords, samples) tuple is returned instead, where
+    samples is a C-contiguous 4D NumPy array of shape
+    (num_samples, sample_size_x, sample_size_y, channels), and coords
+    is an integer array of shape (num_samples, 2) of the (col, row)
+    coordinates of the samples, as returned by `get_sample_coords`, or
+    relative to the tile if `tile_index` is None.
   """
   slide_num, tile = tile_tuple
   if grayscale:
@@ -336,67 +982,78 @@ def process_tile(tile_tuple, sample_size, grayscale):
   # (num_x, num_y, sample_size_x, sample_size_y, ch).
   # 3. Combine num_x and num_y into single axis, returning
   # (num_samples, sample_size_x, sample_size_y, ch).
+  # Note: Step 3 copies the tile once into a new contiguous array, so the samples are views
+  # into a single block of memory.
   samples = (tile.reshape((x // sample_size, sample_size, y // sample_size, sample_size, ch))
                  .swapaxes(1,2)
                  .reshape((-1, sample_size, sample_size, ch)))
+  if batch:
+    if tile_index is None:
+      tile_index = (slide_num, sample_size * (y // sample_size), 0, 0, 0, 0)
+    coords = get_sample_coords(tile_index, sample_size, len(samples))
+    return (slide_num, coords, np.ascontiguousarray(samples))
   samples = [(slide_num, sample) for sample in list(samples)]
   return samples
 
 
-# Normalize staining
-
-def normalize_staining(sample_tuple, beta=0.15, alpha=1, light_intensity=255):
+def unbatch_samples(sample_tuple):
   """
-  Normalize the staining of H&E histology slides.
-
-  This function normalizes the staining of H&E histology slides.
-
-  References:
-    - Macenko, Marc, et al. "A method for normalizing histology slides
-    for quantitative analysis." Biomedical Imaging: From Nano to Macro,
-    2009.  ISBI'09. IEEE International Symposium on. IEEE, 2009.
-      - http://wwwx.cs.unc.edu/~mn/sites/default/files/macenko2009.pdf
-    - https://github.com/mitkovetta/staining-normalization
+  Split a batch of samples back into separate sample tuples.
 
   Args:
-    sample_tuple: A (slide_num, sample) tuple, where slide_num is an
-      integer, and sample is a 3D NumPy array of shape (H,W,C).
+    sample_tuple: A batch of samples with labels, i.e. a (slide_num,
+      tumor_score, molecular_score, coords, samples) tuple, or without
+      labels, i.e. a (slide_num, coords, samples) tuple, as generated
+      by `preprocess` with `batch_samples=True`.  Sample tuples that are
+      not batched, i.e. of length 4 or 2, are passed through.
 
   Returns:
-    A (slide_num, sample) tuple, where the sample is a 3D NumPy array
-    of shape (H,W,C) that has been stain normalized.
+    A list of sample tuples with labels, e.g. (slide_num, tumor_score,
+    molecular_score, sample), or without labels, e.g. (slide_num,
+    sample).
   """
-  # Setup.
-  slide_num, sample = sample_tuple
-  x = np.asarray(sample)
-  h, w, c = x.shape
-  x = x.reshape(-1, c).astype(np.float64)  # shape (H*W, C)
+  if len(sample_tuple) == 5:
+    slide_num, tumor_score, molecular_score, _, samples = sample_tuple
+    return [(slide_num, tumor_score, molecular_score, sample) for sample in samples]
+  elif len(sample_tuple) == 3:
+    slide_num, _, samples = sample_tuple
+    return [(slide_num, sample) for sample in samples]
+  return [sample_tuple]
 
-  # Reference stain vectors and stain saturations.  We will normalize all slides
-  # to these references.  To create these, grab the stain vectors and stain
-  # saturations from a desirable slide.
 
-  # Values in reference implementation for use with eigendecomposition approach, natural log,
-  # and `light_intensity=240`.
-  #stain_ref = np.array([0.5626, 0.2159, 0.7201, 0.8012, 0.4062, 0.5581]).reshape(3,2)
-  #max_sat_ref = np.array([1.9705, 1.0308]).reshape(2,1)
+# Normalize staining
 
-  # SVD w/ log10, and `light_intensity=255`.
-  stain_ref = (np.array([0.54598845, 0.322116, 0.72385198, 0.76419107, 0.42182333, 0.55879629])
-                 .reshape(3,2))
-  max_sat_ref = np.array([0.82791151, 0.61137274]).reshape(2,1)
+# Reference stain vectors and stain saturations.  We will normalize all slides
+# to these references.  To create these, grab the stain vectors and stain
+# saturations from a desirable slide.
 
-  # Convert RGB to OD.
-  # Note: The original paper used log10, and the reference implementation used the natural log.
-  #OD = -np.log((x+1)/light_intensity)  # shape (H*W, C)
-  OD = -np.log10(x/light_intensity + 1e-8)
+# Values in reference implementation for use with eigendecomposition approach, natural log,
+# and `light_intensity=240`.
+#STAIN_REF = np.array([0.5626, 0.2159, 0.7201, 0.8012, 0.4062, 0.5581]).reshape(3,2)
+#MAX_SAT_REF = np.array([1.9705, 1.0308]).reshape(2,1)
+
+# SVD w/ log10, and `light_intensity=255`.
+STAIN_REF = (np.array([0.54598845, 0.322116, 0.72385198, 0.76419107, 0.42182333, 0.55879629])
+               .reshape(3,2))
+MAX_SAT_REF = np.array([0.82791151, 0.61137274]).reshape(2,1)
 
-  # Remove data with OD intensity less than beta.
-  # I.e. remove transparent pixels.
-  # Note: This needs to be checked per channel, rather than
-  # taking an average over all channels for a given pixel.
-  OD_thresh = OD[np.all(OD >= beta, 1), :]  # shape (K, C)
 
+def get_stain_vectors(OD_thresh, alpha=1):
+  """
+  Estimate the stain vectors of H&E histology pixels.
+
+  This uses the method of Macenko et al.  See `normalize_staining`.
+
+  Args:
+    OD_thresh: A 2D NumPy array of shape (K, C) containing the optical
+      density values of K pixels that are not transparent.
+    alpha: Percentile used to find the robust extremes of the stain
+      angles.
+
+  Returns:
+    A 2D NumPy array of shape (C, 2) containing the hematoxylin and
+    eosin stain vectors as columns, in that order.
+  """
   # Calculate eigenvectors.
   # Note: We can either use eigenvector decomposition, or SVD.
   #eigvals, eigvecs = np.linalg.eig(np.cov(OD_thresh.T))  # np.cov results in inf/nans
@@ -435,6 +1092,67 @@ def normalize_staining(sample_tuple, beta=0.15, alpha=1, light_intensity=255):
   if stains[0, 0] < stains[0, 1]:
     stains[:, [0, 1]] = stains[:, [1, 0]]  # swap columns
 
+  return stains
+
+
+def normalize_staining(sample_tuple, beta=0.15, alpha=1, light_intensity=255, stains=None,
+                       max_sat=None):
+  """
+  Normalize the staining of H&E histology slides.
+
+  This function normalizes the staining of H&E histology slides.
+
+  References:
+    - Macenko, Marc, et al. "A method for normalizing histology slides
+    for quantitative analysis." Biomedical Imaging: From Nano to Macro,
+    2009.  ISBI'09. IEEE International Symposium on. IEEE, 2009.
+      - http://wwwx.cs.unc.edu/~mn/sites/default/files/macenko2009.pdf
+    - https://github.com/mitkovetta/staining-normalization
+
+  Args:
+    sample_tuple: A (slide_num, sample) tuple, where slide_num is an
+      integer, and sample is a 3D NumPy array of shape (H,W,C).
+    beta: Optical density threshold below which a pixel is considered
+      to be transparent.
+    alpha: Percentile used to find the robust extremes of the stain
+      angles.
+    light_intensity: Intensity of the light used to image the slides.
+    stains: Optional precomputed (C, 2) stain matrix, e.g. for the
+      entire slide, as returned by `estimate_slide_stains`.  If None,
+      the stain vectors are estimated from the sample itself.
+    max_sat: Optional precomputed (2, 1) array of the pseudo-maximum
+      stain saturations.  If None, they are computed from the sample
+      itself.
+
+  Returns:
+    A (slide_num, sample) tuple, where the sample is a 3D NumPy array
+    of shape (H,W,C) that has been stain normalized.
+  """
+  # Setup.
+  slide_num, sample = sample_tuple
+  x = np.asarray(sample)
+  h, w, c = x.shape
+  x = x.reshape(-1, c).astype(np.float64)  # shape (H*W, C)
+
+  # Reference stain vectors and stain saturations.
+  stain_ref = STAIN_REF
+  max_sat_ref = MAX_SAT_REF
+
+  # Convert RGB to OD.
+  # Note: The original paper used log10, and the reference implementation used the natural log.
+  #OD = -np.log((x+1)/light_intensity)  # shape (H*W, C)
+  OD = -np.log10(x/light_intensity + 1e-8)
+
+  if stains is None:
+    # Remove data with OD intensity less than beta.
+    # I.e. remove transparent pixels.
+    # Note: This needs to be checked per channel, rather than
+    # taking an average over all channels for a given pixel.
+    OD_thresh = OD[np.all(OD >= beta, 1), :]  # shape (K, C)
+
+    # Estimate the stain vectors from the remaining pixels.
+    stains = get_stain_vectors(OD_thresh, alpha)
+
   # Calculate saturations of each stain.
   # Note: Here, we solve
   #    OD = VS
@@ -447,7 +1165,8 @@ def normalize_staining(sample_tuple, beta=0.15, alpha=1, light_intensity=255):
 
   # Normalize stain saturations to have same pseudo-maximum based on
   # a reference max saturation.
-  max_sat = np.percentile(sats, 99, axis=1, keepdims=True)
+  if max_sat is None:
+    max_sat = np.percentile(sats, 99, axis=1, keepdims=True)
   sats = sats / max_sat * max_sat_ref
 
   # Compute optimal OD values.
@@ -466,6 +1185,415 @@ def normalize_staining(sample_tuple, beta=0.15, alpha=1, light_intensity=255):
   return (slide_num, x_norm)
 
 
+@functools.lru_cache(maxsize=None)
+def get_od_lut(light_intensity=255):
+  """
+  Get a look-up table from 8-bit RGB values to optical density values.
+
+  Args:
+    light_intensity: Intensity of the light used to image the slides.
+
+  Returns:
+    A read-only float32 NumPy array of shape (256,), where entry `v`
+    equals `-log10(v/light_intensity + 1e-8)`, as in
+    `normalize_staining`.
+  """
+  lut = -np.log10(np.arange(256) / light_intensity + 1e-8)
+  lut = lut.astype(np.float32)
+  lut.setflags(write=False)
+  return lut
+
+
+def masked_percentile(x, mask, q):
+  """
+  Compute a percentile along the last axis, ignoring masked out values.
+
+  This matches `np.percentile` with linear interpolation applied
+  separately to the selected values of each row.
+
+  Args:
+    x: A 2D NumPy array of shape (N, P).
+    mask: A 2D boolean NumPy array of shape (N, P) selecting the
+      values of each row to use.  Each row must select at least one
+      value.
+    q: Percentile in [0, 100].
+
+  Returns:
+    A NumPy array of shape (N,) containing the percentile of the
+    selected values of each row.
+  """
+  counts = mask.sum(axis=1)
+  x = np.sort(np.where(mask, x, np.inf), axis=1)  # selected values first
+  pos = (counts - 1) * (q / 100)
+  lower = np.floor(pos).astype(np.int64)
+  upper = np.minimum(lower + 1, counts - 1)
+  frac = (pos - lower).astype(x.dtype)
+  x_lower = np.take_along_axis(x, lower[:, np.newaxis], axis=1)[:, 0]
+  x_upper = np.take_along_axis(x, upper[:, np.newaxis], axis=1)[:, 0]
+  return x_lower + (x_upper - x_lower) * frac
+
+
+def normalize_staining_batch(samples, beta=0.15, alpha=1, light_intensity=255, stains=None,
+                             max_sat=None, out=None):
+  """
+  Normalize the staining of a batch of H&E histology samples.
+
+  This is a vectorized, float32 version of `normalize_staining` that
+  processes a stack of samples at once.  The optical density is looked
+  up in a table rather than computed per pixel, the stain vectors are
+  computed from the 3x3 Gram matrix of the thresholded optical density
+  of each sample rather than from an SVD of all of its pixels, and the
+  stain saturations are solved in closed form with the pseudo-inverse
+  of the 3x2 stain matrix rather than with `np.linalg.lstsq`.  Samples
+  with fewer than two tissue pixels are returned unchanged, since their
+  stain vectors cannot be estimated.
+
+  Args:
+    samples: A 4D uint8 NumPy array of shape (N,H,W,C).
+    beta: Optical density threshold below which a pixel is considered
+      to be transparent.
+    alpha: Percentile used to find the robust extremes of the stain
+      angles.
+    light_intensity: Intensity of the light used to image the slides.
+    stains: Optional precomputed stain matrices, as an array of shape
+      (C, 2) for all samples, or (N, C, 2) per sample.  If None, the
+      stain vectors are estimated from each sample itself.
+    max_sat: Optional precomputed pseudo-maximum stain saturations, as
+      an array of shape (2, 1) for all samples, or (N, 2, 1) per
+      sample.  If None, they are computed from each sample itself.
+    out: Optional C-contiguous uint8 NumPy array of shape (N,H,W,C) in
+      which to store the result.
+
+  Returns:
+    A 4D uint8 NumPy array of shape (N,H,W,C) containing the stain
+    normalized samples.
+  """
+  samples = np.asarray(samples)
+  n, h, w, c = samples.shape
+  if out is None:
+    out = np.empty((n, h, w, c), dtype=np.uint8)
+
+  # Convert RGB to OD with a look-up table.
+  lut = get_od_lut(light_intensity)
+  x = samples.reshape(n, -1, c)
+  OD = lut[x]  # shape (N, H*W, C)
+
+  if stains is None:
+    # Remove data with OD intensity less than beta, i.e. transparent pixels, by
+    # zeroing them out, which removes them from the Gram matrix below.  Since
+    # the OD is monotonically decreasing, this is a threshold on the maximum
+    # channel value.
+    max_value = np.count_nonzero(lut >= beta) - 1
+    tissue = np.max(x, axis=2) <= max_value  # shape (N, H*W)
+    valid = tissue.sum(axis=1) >= 2
+    OD_thresh = OD * tissue[:, :, np.newaxis]  # shape (N, H*W, C)
+
+    # Calculate the two largest eigenvectors of the Gram matrix, which are the
+    # top two right singular vectors of the thresholded OD values.  The sign
+    # of the first one is chosen to point into the positive OD octant, as in
+    # `normalize_staining`.  The sign of the second one does not affect the
+    # resulting stain vectors.
+    gram = np.matmul(OD_thresh.transpose(0, 2, 1), OD_thresh)  # shape (N, C, C)
+    _, eigvecs = np.linalg.eigh(gram)  # ascending eigenvalues
+    top_eigvecs = eigvecs[:, :, [-1, -2]]  # shape (N, C, 2)
+    sign = np.where(top_eigvecs[:, :, 0].sum(axis=1) < 0, -1, 1).astype(top_eigvecs.dtype)
+    top_eigvecs[:, :, 0] *= sign[:, np.newaxis]
+
+    # Project thresholded optical density values onto plane spanned by the
+    # 2 largest eigenvectors, and find robust extremes of the angles.
+    proj = np.matmul(OD_thresh, top_eigvecs)  # shape (N, H*W, 2)
+    angles = np.arctan2(proj[:, :, 1], proj[:, :, 0])  # shape (N, H*W)
+    tissue[~valid] = True  # avoid empty selections; these samples are copied below
+    min_angle = masked_percentile(angles, tissue, alpha)
+    max_angle = masked_percentile(angles, tissue, 100-alpha)
+
+    # Convert min/max vectors (extremes) back to optimal stains in OD space.
+    extreme_angles = np.stack([np.stack([np.cos(min_angle), np.cos(max_angle)], axis=1),
+                               np.stack([np.sin(min_angle), np.sin(max_angle)], axis=1)],
+                              axis=1)  # shape (N, 2, 2)
+    stains = np.matmul(top_eigvecs, extreme_angles)  # shape (N, C, 2)
+    stains[~valid] = STAIN_REF  # unused, since these samples are copied below
+
+    # Merge vectors with hematoxylin first, and eosin second, as a heuristic.
+    swap = stains[:, 0, 0] < stains[:, 0, 1]
+    stains[swap] = stains[swap][:, :, ::-1]
+  else:
+    stains = np.broadcast_to(np.asarray(stains, dtype=np.float32), (n, c, 2))
+    valid = np.ones(n, dtype=bool)
+
+  # Calculate saturations of each stain by solving the overdetermined system
+  # OD = VS in the least squares sense, using the closed-form pseudo-inverse
+  # (V^T V)^{-1} V^T of the 3x2 stain matrix V.
+  vtv = np.matmul(stains.transpose(0, 2, 1), stains)  # shape (N, 2, 2)
+  det = vtv[:, 0, 0] * vtv[:, 1, 1] - vtv[:, 0, 1] * vtv[:, 1, 0]
+  vtv_inv = np.stack([np.stack([vtv[:, 1, 1], -vtv[:, 0, 1]], axis=1),
+                      np.stack([-vtv[:, 1, 0], vtv[:, 0, 0]], axis=1)],
+                     axis=1) / det[:, np.newaxis, np.newaxis]
+  pinv = np.matmul(vtv_inv, stains.transpose(0, 2, 1))  # shape (N, 2, C)
+  sats = np.matmul(pinv, OD.transpose(0, 2, 1))  # shape (N, 2, H*W)
+
+  # Normalize stain saturations to have same pseudo-maximum based on a
+  # reference max saturation, and fold this into the reference stain matrix.
+  if max_sat is None:
+    max_sat = np.percentile(sats, 99, axis=2, keepdims=True)  # shape (N, 2, 1)
+  max_sat = np.maximum(np.broadcast_to(max_sat, (n, 2, 1)), np.finfo(np.float32).tiny)
+  stain_norm = (STAIN_REF * (MAX_SAT_REF / max_sat).transpose(0, 2, 1)).astype(np.float32)
+
+  # Compute optimal OD values, and recreate the image in place.
+  x_norm = np.matmul(stain_norm, sats)  # shape (N, C, H*W)
+  np.negative(x_norm, out=x_norm)
+  np.power(np.float32(10), x_norm, out=x_norm)
+  x_norm *= light_intensity
+  np.round(x_norm, out=x_norm)
+  np.clip(x_norm, 0, 255, out=x_norm)
+  np.copyto(out.reshape(n, -1, c), x_norm.transpose(0, 2, 1), casting="unsafe")
+  out[~valid] = samples[~valid]
+  return out
+
+
+def normalize_staining_partition(sample_tuples, batch_size=64, beta=0.15, alpha=1,
+                                 light_intensity=255, slide_stains=None):
+  """
+  Normalize the staining of an iterable of samples in batches.
+
+  This is meant to be used with `mapPartitions`, and groups the
+  samples of a partition into batches for `normalize_staining_batch`.
+
+  Args:
+    sample_tuples: An iterable of (slide_num, sample) tuples, where
+      slide_num is an integer, and sample is a 3D NumPy array of shape
+      (H,W,C).  All samples must have the same shape.
+    batch_size: Number of samples to normalize at once.
+    beta: Optical density threshold below which a pixel is considered
+      to be transparent.
+    alpha: Percentile used to find the robust extremes of the stain
+      angles.
+    light_intensity: Intensity of the light used to image the slides.
+    slide_stains: Optional dictionary mapping each slide number to a
+      precomputed (stains, max_sat) tuple for the slide, as returned by
+      `get_slide_stains`.  If None, the stain vectors are estimated
+      from each sample itself.
+
+  Returns:
+    Yields (slide_num, sample) tuples, where the sample is a 3D NumPy
+    array of shape (H,W,C) that has been stain normalized.
+  """
+  def normalize_batch(batch):
+    slide_nums, samples = zip(*batch)
+    stains = max_sat = None
+    if slide_stains is not None:
+      stains = np.stack([slide_stains[slide_num][0] for slide_num in slide_nums])
+      max_sat = np.stack([slide_stains[slide_num][1] for slide_num in slide_nums])
+    samples = normalize_staining_batch(np.stack(samples), beta, alpha, light_intensity, stains,
+                                       max_sat)
+    return zip(slide_nums, samples)
+
+  batch = []
+  for sample_tuple in sample_tuples:
+    batch.append(sample_tuple)
+    if len(batch) == batch_size:
+      yield from normalize_batch(batch)
+      batch = []
+  if batch:
+    yield from normalize_batch(batch)
+
+
+def normalize_staining_tile(sample_batch, beta=0.15, alpha=1, light_intensity=255,
+                            slide_stains=None):
+  """
+  Normalize the staining of a batch of samples from a single tile.
+
+  Args:
+    sample_batch: A (slide_num, coords, samples) tuple, as returned by
+      `process_tile` with `batch=True`.
+    beta: Optical density threshold below which a pixel is considered
+      to be transparent.
+    alpha: Percentile used to find the robust extremes of the stain
+      angles.
+    light_intensity: Intensity of the light used to image the slides.
+    slide_stains: Optional dictionary mapping each slide number to a
+      precomputed (stains, max_sat) tuple for the slide, as returned by
+      `get_slide_stains`.  If None, the stain vectors are estimated
+      from each sample itself.
+
+  Returns:
+    A (slide_num, coords, samples) tuple, where the samples have been
+    stain normalized with `normalize_staining_batch`.
+  """
+  slide_num, coords, samples = sample_batch
+  stains = max_sat = None
+  if slide_stains is not None:
+    stains, max_sat = slide_stains[slide_num]
+  samples = normalize_staining_batch(samples, beta, alpha, light_intensity, stains, max_sat)
+  return (slide_num, coords, samples)
+
+
+# Estimate Per-Slide Stain References
+
+def estimate_slide_stains(slide_num, folder, training, num_tiles=32, tile_size=512,
+                          num_pixels=1000000, beta=0.15, alpha=1, light_intensity=255, seed=0):
+  """
+  Estimate the stain vectors and saturations of a whole-slide image.
+
+  Rather than estimating the stains of every sample separately, this
+  estimates them once for an entire slide from a random subsample of
+  the tissue pixels in up to `num_tiles` tiles at 20x magnification,
+  chosen among the tiles that contain tissue according to a
+  low-resolution tissue mask of the slide.
+
+  Args:
+    slide_num: Slide image number as an integer.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+    num_tiles: Maximum number of tiles from which to sample pixels.
+    tile_size: The width and height of the square tiles to read.
+    num_pixels: Maximum number of tissue pixels to use.
+    beta: Optical density threshold below which a pixel is considered
+      to be transparent.
+    alpha: Percentile used to find the robust extremes of the stain
+      angles.
+    light_intensity: Intensity of the light used to image the slides.
+    seed: Random seed used to select the tiles and pixels.
+
+  Returns:
+    A (stains, max_sat) tuple of a (C, 2) stain matrix and a (2, 1)
+    array of the pseudo-maximum stain saturations, suitable for
+    `normalize_staining`, or None if the slide could not be opened or
+    does not contain any tissue.
+  """
+  if get_slide_cache().get_slide(slide_num, folder, training) is None:
+    return None
+  rng = np.random.RandomState(seed)
+  tile_indices = process_slide(slide_num, folder, training, tile_size, 0, prescreen_threshold=0.5)
+  if len(tile_indices) > num_tiles:
+    tile_indices = [tile_indices[i] for i in
+                    np.sort(rng.choice(len(tile_indices), num_tiles, replace=False))]
+  OD_thresh = [np.empty((0, 3))]
+  for tile_index in tile_indices:
+    _, tile = process_tile_index(tile_index, folder, training)
+    x = tile[:, :, :3].reshape(-1, 3).astype(np.float64)
+    OD = -np.log10(x/light_intensity + 1e-8)
+    OD_thresh.append(OD[np.all(OD >= beta, 1), :])
+  OD_thresh = np.concatenate(OD_thresh)
+  if len(OD_thresh) < 2:
+    return None
+  if len(OD_thresh) > num_pixels:
+    OD_thresh = OD_thresh[rng.choice(len(OD_thresh), num_pixels, replace=False)]
+  stains = get_stain_vectors(OD_thresh, alpha)
+  sats, _, _, _ = np.linalg.lstsq(stains, OD_thresh.T)
+  max_sat = np.percentile(sats, 99, axis=1, keepdims=True)
+  return stains, max_sat
+
+
+def load_stain_cache(path):
+  """
+  Load a cache of per-slide stain references from a JSON file.
+
+  Args:
+    path: Path to the cache file.  It does not need to exist.
+
+  Returns:
+    A dictionary mapping absolute slide filenames to dictionaries with
+    "mtime", "stains", and "max_sat" entries, or "mtime" and
+    "no_tissue" entries for slides without any detectable tissue.
+  """
+  if not os.path.isfile(path):
+    return {}
+  with open(path) as f:
+    return json.load(f)
+
+
+def save_stain_cache(cache, path):
+  """
+  Save a cache of per-slide stain references to a JSON file.
+
+  The file is replaced atomically, so that an interrupted run never
+  leaves a corrupted cache behind.
+
+  Args:
+    cache: A dictionary as returned by `load_stain_cache`.
+    path: Path to the cache file.
+  """
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as f:
+    json.dump(cache, f, indent=2, sort_keys=True)
+  os.replace(tmp_path, path)
+
+
+def get_slide_stains(spark, slide_nums, folder, training, cache_path=None, pool=None):
+  """
+  Get the stain references of a set of whole-slide images.
+
+  Stain references are loaded from the cache at `cache_path` if they
+  were computed from the current version of the slide file, as
+  determined by its modification time.  The remaining slides are
+  estimated in parallel with `estimate_slide_stains`, and added to the
+  cache.  Slides without any detectable tissue are mapped to the
+  reference stains, i.e. left as they are, and are also cached so that
+  they are not estimated again on the next run.
+
+  Args:
+    spark: SparkSession, or None to estimate the stains locally.
+    slide_nums: List of whole-slide numbers.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+    cache_path: Optional path to a JSON file in which to cache the
+      stain references across runs.
+    pool: Optional `multiprocessing.Pool` with which to estimate the
+      stains locally in parallel if `spark` is None.
+
+  Returns:
+    A dictionary mapping each slide number that exists to a
+    (stains, max_sat) tuple of a (C, 2) stain matrix and a (2, 1) array
+    of the pseudo-maximum stain saturations.
+  """
+  cache = load_stain_cache(cache_path) if cache_path is not None else {}
+  slide_stains = {}
+  missing = []
+  for slide_num in slide_nums:
+    filename = os.path.abspath(get_slide_filename(slide_num, folder, training))
+    if not os.path.isfile(filename):
+      continue
+    mtime = os.path.getmtime(filename)
+    entry = cache.get(filename)
+    if entry is not None and entry["mtime"] == mtime:
+      if entry.get("no_tissue", False):
+        slide_stains[slide_num] = (STAIN_REF, MAX_SAT_REF)
+      else:
+        slide_stains[slide_num] = (np.array(entry["stains"]), np.array(entry["max_sat"]))
+    else:
+      missing.append((slide_num, filename, mtime))
+
+  if missing:
+    if spark is not None:
+      estimates = (spark.sparkContext
+          .parallelize(missing, len(missing))
+          .map(lambda m: (m, estimate_slide_stains(m[0], folder, training)))
+          .collect())
+    else:
+      args = [(m[0], folder, training) for m in missing]
+      map_fn = pool.starmap if pool is not None else lambda f, xs: [f(*x) for x in xs]
+      estimates = list(zip(missing, map_fn(estimate_slide_stains, args)))
+    for (slide_num, filename, mtime), estimate in estimates:
+      if estimate is None:
+        slide_stains[slide_num] = (STAIN_REF, MAX_SAT_REF)
+        cache[filename] = {"mtime": mtime, "no_tissue": True}
+        continue
+      stains, max_sat = estimate
+      slide_stains[slide_num] = (stains, max_sat)
+      cache[filename] = {"mtime": mtime, "stains": stains.tolist(), "max_sat": max_sat.tolist()}
+    if cache_path is not None:
+      save_stain_cache(cache, cache_path)
+
+  return slide_stains
+
+
 def flatten_sample_tuple(sample_tuple):
   """
   Flatten a (H,W,C) sample into a (C*H*W) row vector.
@@ -532,11 +1660,58 @@ def get_labels_df(folder, filename="training_ground_truth.csv"):
   return labels_df
 
 
+LABELS_DTYPE = np.dtype([("tumor_score", np.int32), ("molecular_score", np.float64)])
+
+
+def get_labels_array(labels_df):
+  """
+  Create a compact array of the ground truth labels indexed by slide number.
+
+  This is much cheaper to ship to Spark workers, e.g. as a broadcast
+  variable, and to look up than the Pandas DataFrame.
+
+  Args:
+    labels_df: A Pandas DataFrame of labels, as returned by
+      `get_labels_df`.
+
+  Returns:
+    A 1D structured NumPy array with "tumor_score" and
+    "molecular_score" fields, in which the labels of each slide are
+    stored at the index of the slide number.  Entries of missing slide
+    numbers are zero.
+  """
+  labels = np.zeros(labels_df["slide_num"].max() + 1, dtype=LABELS_DTYPE)
+  labels["tumor_score"][labels_df["slide_num"]] = labels_df["tumor_score"]
+  labels["molecular_score"][labels_df["slide_num"]] = labels_df["molecular_score"]
+  return labels
+
+
+def add_labels(sample_tuple, labels):
+  """
+  Add the ground truth labels of a slide to a sample or batch of samples.
+
+  Args:
+    sample_tuple: A (slide_num, sample) tuple, or a (slide_num, coords,
+      samples) batch of samples.
+    labels: An array of labels, as returned by `get_labels_array`.
+
+  Returns:
+    A (slide_num, tumor_score, molecular_score, sample) tuple, or a
+    (slide_num, tumor_score, molecular_score, coords, samples) batch.
+  """
+  slide_num = int(sample_tuple[0])
+  tumor_score, molecular_score = labels[slide_num]
+  return (slide_num, int(tumor_score), float(molecular_score), *sample_tuple[1:])
+
+
 # Process All Slides Into A Spark RDD
 
 def preprocess(spark, slide_nums, folder="data", training=True, tile_size=1024, overlap=0,
                tissue_threshold=0.9, sample_size=256, grayscale=False, normalize_stains=True,
-               num_partitions=20000):
+               num_partitions=20000, partition_by_slide=False, tiles_per_partition=1000,
+               prescreen_threshold=None, tissue_downsample=1, stain_batch_size=None,
+               per_slide_stains=False, stain_cache_path=None, tile_indices=None,
+               catalogue_path=None, batch_samples=False, sample_frac=None, seed=None):
   """
   Preprocess a set of whole-slide images.
 
@@ -561,64 +1736,541 @@ def preprocess(spark, slide_nums, folder="data", training=True, tile_size=1024,
     training: Boolean for training or testing datasets.
     tile_size: The width and height of a square tile to be generated.
     overlap: Number of pixels by which to overlap the tiles.
-    tissue_threshold: Tissue percentage threshold for filtering.
+    tissue_threshold: Tissue percentage threshold for filtering, or None
+      to keep all tiles, e.g. if `tile_indices` have already been
+      filtered with `filter_tile_indices`.
     sample_size: The new width and height of the square samples to be
       generated.
     grayscale: Whether or not to generate grayscale samples, rather
       than RGB.
     normalize_stains: Whether or not to apply stain normalization.
+    stain_batch_size: Optional number of samples per batch with which
+      to apply the vectorized, float32 stain normalization of
+      `normalize_staining_batch` to each partition.  If None, samples
+      are normalized one at a time with `normalize_staining`.
+    per_slide_stains: Whether or not to estimate the stains once per
+      slide with `get_slide_stains`, rather than from every sample.
+    stain_cache_path: Optional path to a JSON file in which to cache
+      the per-slide stains across runs.
     num_partitions: Number of partitions to use during processing.
+      This is ignored if `partition_by_slide` is true.
+    partition_by_slide: Whether or not to partition the tiles by slide,
+      rather than randomly.  If true, each partition will contain a
+      contiguous run of tiles from a single slide, which will be
+      processed with a single open slide handle.
+    tiles_per_partition: Maximum number of tiles in each partition if
+      `partition_by_slide` is true.  Smaller values spread large slides
+      across more of the cluster.
+    prescreen_threshold: Optional minimum tissue fraction of a tile on a
+      low-resolution tissue mask of its slide for the tile to be read
+      at full resolution, or None to read all tiles.  See
+      `process_slide`.
+    tissue_downsample: Integer factor by which to downsample tiles
+      during tissue detection.  See `keep_tile`.
+    tile_indices: Optional RDD of (slide_num, tile_size, overlap,
+      zoom_level, col, row) tile indices to process, such as a set of
+      tile indices saved by a previous run, in which case the tile
+      indices are not regenerated with `process_slide`, and
+      `slide_nums`, `tile_size`, `overlap`, and `prescreen_threshold`
+      are only used for the stain estimation and tissue filtering.
+    catalogue_path: Optional Hadoop-supported path of a tile catalogue
+      from which to select the tiles with enough tissue, rather than
+      checking the pixels of every tile.  Any slides that are missing
+      from the catalogue are added to it first, and
+      `prescreen_threshold` is ignored, since the catalogue covers all
+      tiles.  See `get_tile_catalogue`.
+    batch_samples: Whether or not to keep the samples of each tile
+      together as a single batch.  In this case, each element of the
+      returned RDD holds the coordinates and samples of an entire tile,
+      as returned by `process_tile` with `batch=True`, rather than a
+      single sample, and the stains are normalized a tile at a time
+      with the vectorized `normalize_staining_tile`.  See also
+      `unbatch_samples`.
+    sample_frac: Optional fraction of tiles to process, which samples
+      the tile indices before any pixels are read, stratified by slide.
+      For training data sets, this may also be a dictionary mapping
+      each tumor score to a fraction.  See `in_tile_sample`.
+    seed: Random seed used for the sampling.
 
   Returns:
     A Spark RDD in which, for training data sets, each element contains the slide number, tumor
     score, molecular score, and the sample as a numpy array; for validation data set,
-    each element contains the slide number and the sample as a numpy array
+    each element contains the slide number and the sample as a numpy array.  If
+    `batch_samples` is true, each element instead contains the slide number, tumor score,
+    molecular score, sample coordinates, and a batch of samples for training data sets, or
+    the slide number, sample coordinates, and a batch of samples otherwise.
   """
   # Filter out broken slides
   # Note: "Broken" here is due to a "version of OpenJPEG with broken support for chroma-subsampled
   # images".
-  slides = (spark.sparkContext
-      .parallelize(slide_nums)
-      .filter(lambda slide: open_slide(slide, folder, training) is not None))
-
-  # Create DataFrame of all tile locations and increase number of partitions
-  # to avoid OOM during subsequent processing.
-  tile_indices = (slides.flatMap(
-      lambda slide: process_slide(slide, folder, training, tile_size, overlap)))
-  # TODO: Explore computing the ideal paritition sizes based on projected number
-  #   of tiles after filtering.  I.e. something like the following:
-  #rows = tile_indices.count()
-  #part_size = 128
-  #channels = 1 if grayscale else 3
-  #row_mb = tile_size * tile_size * channels * 8 / 1024 / 1024  # size of one row in MB
-  #rows_per_part = round(part_size / row_mb)
-  #num_parts = rows / rows_per_part
-  tile_indices = tile_indices.repartition(num_partitions)
-  tile_indices.cache()
-
-  # Extract all tiles into an RDD, filter, cut into smaller samples, apply stain
-  # normalization, and flatten.
-  tiles = tile_indices.map(lambda tile_index: process_tile_index(tile_index, folder, training))
-  filtered_tiles = tiles.filter(lambda tile: keep_tile(tile, tile_size, tissue_threshold))
-  samples = filtered_tiles.flatMap(lambda tile: process_tile(tile, sample_size, grayscale))
+  if catalogue_path is not None and tile_indices is None and tissue_threshold is not None:
+    # Select the tiles with enough tissue from the catalogue, instead of
+    # filtering the extracted tiles.
+    catalogue = get_tile_catalogue(spark, slide_nums, folder, training, tile_size, overlap,
+                                   catalogue_path, tissue_downsample, num_partitions)
+    tile_indices = df_2_tile_indices(filter_tile_catalogue(catalogue, tissue_threshold))
+    tissue_threshold = None
+
+  if tile_indices is None:
+    slides = (spark.sparkContext
+        .parallelize(slide_nums)
+        .filter(lambda slide: get_slide_cache().get_slide(slide, folder, training) is not None))
+    slide_tile_indices = slides.map(
+        lambda slide: process_slide(slide, folder, training, tile_size, overlap,
+                                    prescreen_threshold))
+  else:
+    # Group the given tile indices by slide.
+    slide_tile_indices = tile_indices.groupBy(lambda tile_index: tile_index[0]).values()
+
+  if sample_frac is not None:
+    # Sample the tile indices, stratified by slide, and thus by class.
+    if isinstance(sample_frac, dict) and not training:
+      raise ValueError("sample_frac must be a single fraction for testing data sets")
+    labels = get_labels_array(get_labels_df(folder)) if training else None
+    fractions = get_slide_sample_fractions(sample_frac, slide_nums, labels)
+    slide_tile_indices = slide_tile_indices.map(
+        lambda slide_tile_indices: sample_tile_indices(slide_tile_indices, fractions, seed))
+
+  if partition_by_slide:
+    # Create an RDD of contiguous runs of tile locations, and place each run in
+    # its own partition so that every partition reads from a single slide.
+    tile_runs = (slide_tile_indices.flatMap(
+        lambda slide_tile_indices: get_tile_runs(slide_tile_indices, tiles_per_partition)))
+    tile_runs.cache()
+    num_runs = max(tile_runs.count(), 1)
+    tile_indices = (tile_runs.zipWithIndex()
+                             .map(lambda run_i: (run_i[1], run_i[0]))
+                             .partitionBy(num_runs, lambda i: i)
+                             .flatMap(lambda run_i: run_i[1], preservesPartitioning=True))
+    tile_indices.cache()
+
+    # Extract all tiles into an RDD, one partition at a time, keeping the tile indices.
+    tiles = tile_indices.mapPartitions(
+        lambda tile_indices: ((tile_index, process_tile_index(tile_index, folder, training))
+                              for tile_index in tile_indices))
+  else:
+    # Create DataFrame of all tile locations and increase number of partitions
+    # to avoid OOM during subsequent processing.
+    tile_indices = slide_tile_indices.flatMap(lambda slide_tile_indices: slide_tile_indices)
+    # TODO: Explore computing the ideal paritition sizes based on projected number
+    #   of tiles after filtering.  I.e. something like the following:
+    #rows = tile_indices.count()
+    #part_size = 128
+    #channels = 1 if grayscale else 3
+    #row_mb = tile_size * tile_size * channels * 8 / 1024 / 1024  # size of one row in MB
+    #rows_per_part = round(part_size / row_mb)
+    #num_parts = rows / rows_per_part
+    tile_indices = tile_indices.repartition(num_partitions)
+    tile_indices.cache()
+
+    # Extract all tiles into an RDD, keeping the tile indices.
+    tiles = tile_indices.map(
+        lambda tile_index: (tile_index, process_tile_index(tile_index, folder, training)))
+
+  # Filter tiles, cut into smaller samples, apply stain normalization, and flatten.
+  if tissue_threshold is not None:
+    filtered_tiles = tiles.filter(
+        lambda tile: keep_tile(tile[1], tile_size, tissue_threshold, tissue_downsample))
+  else:
+    filtered_tiles = tiles
+  if batch_samples:
+    samples = filtered_tiles.map(
+        lambda tile: process_tile(tile[1], sample_size, grayscale, batch=True,
+                                  tile_index=tile[0]))
+  else:
+    samples = filtered_tiles.flatMap(lambda tile: process_tile(tile[1], sample_size, grayscale))
   if normalize_stains:
-    samples = samples.map(lambda sample: normalize_staining(sample))
+    slide_stains = None
+    if per_slide_stains:
+      # Estimate the stains once per slide, and ship them to the workers.
+      slide_stains = spark.sparkContext.broadcast(
+          get_slide_stains(spark, slide_nums, folder, training, stain_cache_path))
+    if batch_samples:
+      samples = samples.map(
+          lambda batch: normalize_staining_tile(
+              batch, slide_stains=slide_stains.value if slide_stains is not None else None))
+    elif stain_batch_size:
+      samples = samples.mapPartitions(
+          lambda samples: normalize_staining_partition(
+              samples, stain_batch_size,
+              slide_stains=slide_stains.value if slide_stains is not None else None))
+    elif slide_stains is not None:
+      samples = samples.map(
+          lambda sample: normalize_staining(sample, stains=slide_stains.value[sample[0]][0],
+                                            max_sat=slide_stains.value[sample[0]][1]))
+    else:
+      samples = samples.map(lambda sample: normalize_staining(sample))
 
   # Convert to a DataFrame
   if training:
     # Append labels
-    labels_df = get_labels_df(folder)
-    samples_with_labels = (samples.map(
-        lambda tup: (int(tup[0]), int(labels_df.at[tup[0],"tumor_score"]),
-                     float(labels_df.at[tup[0],"molecular_score"]), tup[1])))
+    # Ship the labels to the workers once, as a compact array.  With
+    # `batch_samples`, the labels are added once per tile.
+    labels = spark.sparkContext.broadcast(get_labels_array(get_labels_df(folder)))
+    samples_with_labels = samples.map(lambda tup: add_labels(tup, labels.value))
     return samples_with_labels
   else:  # testing data -- no labels
     return samples
 
 
+# Process All Slides Locally With A Process Pool
+
+def get_slide_tile_runs(slide_num, folder, training, tile_size, overlap, tiles_per_run,
+                        prescreen_threshold=None, sample_frac=None, seed=None):
+  """
+  Generate the tile indices of a whole-slide image as contiguous runs.
+
+  Args:
+    slide_num: Slide image number as an integer.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+    tile_size: The width and height of a square tile to be generated.
+    overlap: Number of pixels by which to overlap the tiles.
+    tiles_per_run: Maximum number of tiles in each run.
+    prescreen_threshold: Optional low-resolution tissue prescreening
+      threshold.  See `process_slide`.
+    sample_frac: Optional fraction of tiles to keep.  See
+      `sample_tile_indices`.
+    seed: Random seed used for the sampling.
+
+  Returns:
+    A list of runs of tile index tuples, as returned by
+    `get_tile_runs`, which is empty if the slide could not be opened.
+  """
+  if get_slide_cache().get_slide(slide_num, folder, training) is None:
+    return []
+  tile_indices = process_slide(slide_num, folder, training, tile_size, overlap,
+                               prescreen_threshold)
+  if sample_frac is not None:
+    tile_indices = sample_tile_indices(tile_indices, sample_frac, seed)
+  return get_tile_runs(tile_indices, tiles_per_run)
+
+
+def process_tile_run(tile_run, folder, training, tile_size, tissue_threshold, sample_size,
+                     grayscale, normalize_stains, tissue_downsample=1, stain_batch_size=None,
+                     slide_stains=None, batch_samples=False):
+  """
+  Process a run of tile indices into samples.
+
+  This applies the same stages as `preprocess` to a single run of
+  tiles, such as one returned by `get_tile_runs`.
+
+  Args:
+    tile_run: An iterable of (slide_num, tile_size, overlap, zoom_level,
+      col, row) integer index tuples.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+    tile_size: The width and height of a square tile to be generated.
+    tissue_threshold: Tissue percentage threshold for filtering, or None
+      to keep all tiles.
+    sample_size: The new width and height of the square samples to be
+      generated.
+    grayscale: Whether or not to generate grayscale samples, rather
+      than RGB.
+    normalize_stains: Whether or not to apply stain normalization.
+    tissue_downsample: Integer factor by which to downsample tiles
+      during tissue detection.  See `keep_tile`.
+    stain_batch_size: Optional number of samples per batch for
+      `normalize_staining_partition`.
+    slide_stains: Optional dictionary mapping slide numbers to
+      precomputed (stains, max_sat) tuples, as returned by
+      `get_slide_stains`.
+    batch_samples: Whether or not to keep the samples of each tile
+      together as a single batch.  See `preprocess`.
+
+  Returns:
+    A list of (slide_num, sample) tuples, or of (slide_num, coords,
+    samples) batches if `batch_samples` is true.
+  """
+  tiles = ((tile_index, process_tile_index(tile_index, folder, training))
+           for tile_index in tile_run)
+  if tissue_threshold is not None:
+    tiles = (tile for tile in tiles
+             if keep_tile(tile[1], tile_size, tissue_threshold, tissue_downsample))
+  if batch_samples:
+    samples = (process_tile(tile[1], sample_size, grayscale, batch=True, tile_index=tile[0])
+               for tile in tiles)
+    if normalize_stains:
+      samples = (normalize_staining_tile(batch, slide_stains=slide_stains) for batch in samples)
+    return list(samples)
+  samples = (sample for tile in tiles for sample in process_tile(tile[1], sample_size, grayscale))
+  if normalize_stains:
+    if stain_batch_size:
+      samples = normalize_staining_partition(samples, stain_batch_size,
+                                             slide_stains=slide_stains)
+    elif slide_stains is not None:
+      samples = (normalize_staining(sample, stains=slide_stains[sample[0]][0],
+                                    max_sat=slide_stains[sample[0]][1])
+                 for sample in samples)
+    else:
+      samples = (normalize_staining(sample) for sample in samples)
+  return list(samples)
+
+
+def preprocess_local(slide_nums, folder="data", training=True, tile_size=1024, overlap=0,
+                     tissue_threshold=0.9, sample_size=256, grayscale=False,
+                     normalize_stains=True, processes=None, tiles_per_task=100,
+                     max_pending_tasks=None, prescreen_threshold=None, tissue_downsample=1,
+                     stain_batch_size=None, per_slide_stains=False, stain_cache_path=None,
+                     batch_samples=False, sample_frac=None, seed=None):
+  """
+  Preprocess a set of whole-slide images on a local process pool.
+
+  This is an alternative to `preprocess` for a single machine, which
+  does not need a SparkSession.  The tile indices of each slide are
+  split into contiguous runs of at most `tiles_per_task` tiles, and
+  each run is processed as a single task by `process_tile_run`, so
+  that each task reads from a single open slide.  At most
+  `max_pending_tasks` tasks are in flight at once, and the samples are
+  yielded as soon as their task completes, so that memory use stays
+  bounded and the samples can be streamed straight to a writer, e.g.
+  `save_partition_2_jpeg`.
+
+  Args:
+    slide_nums: List of whole-slide numbers to process.
+    folder: Local directory in which the slides folder and ground truth
+      file is stored, as a string.  See `preprocess`.
+    training: Boolean for training or testing datasets.
+    tile_size: The width and height of a square tile to be generated.
+    overlap: Number of pixels by which to overlap the tiles.
+    tissue_threshold: Tissue percentage threshold for filtering.
+    sample_size: The new width and height of the square samples to be
+      generated.
+    grayscale: Whether or not to generate grayscale samples, rather
+      than RGB.
+    normalize_stains: Whether or not to apply stain normalization.
+    processes: Number of worker processes, or None to use all CPUs.
+    tiles_per_task: Maximum number of tiles in each task.
+    max_pending_tasks: Maximum number of tasks in flight, or None for
+      twice the number of processes.
+    prescreen_threshold: Optional low-resolution tissue prescreening
+      threshold.  See `process_slide`.
+    tissue_downsample: Integer factor by which to downsample tiles
+      during tissue detection.  See `keep_tile`.
+    stain_batch_size: Optional number of samples per batch with which
+      to apply the vectorized stain normalization.
+    per_slide_stains: Whether or not to estimate the stains once per
+      slide with `get_slide_stains`, rather than from every sample.
+    stain_cache_path: Optional path to a JSON file in which to cache
+      the per-slide stains across runs.
+    batch_samples: Whether or not to keep the samples of each tile
+      together as a single batch, which avoids pickling every sample
+      separately.  See `preprocess`.
+    sample_frac: Optional fraction of tiles to process, or dictionary
+      mapping each tumor score to a fraction.  See `preprocess`.
+    seed: Random seed used for the sampling.
+
+  Returns:
+    Yields the same elements as the RDD returned by `preprocess`, i.e.
+    (slide_num, tumor_score, molecular_score, sample) tuples for
+    training data sets, or (slide_num, sample) tuples otherwise, or
+    batches thereof if `batch_samples` is true, in the order of the
+    tasks.
+  """
+  import multiprocessing
+  from collections import deque
+
+  processes = processes or os.cpu_count()
+  max_pending_tasks = max_pending_tasks or 2 * processes
+  if training:
+    labels = get_labels_array(get_labels_df(folder))
+  fractions = {}
+  if sample_frac is not None:
+    if isinstance(sample_frac, dict) and not training:
+      raise ValueError("sample_frac must be a single fraction for testing data sets")
+    fractions = get_slide_sample_fractions(sample_frac, slide_nums,
+                                           labels if training else None)
+
+  with multiprocessing.Pool(processes) as pool:
+    slide_stains = None
+    if normalize_stains and per_slide_stains:
+      slide_stains = get_slide_stains(None, slide_nums, folder, training, stain_cache_path, pool)
+
+    # Generate the tile runs of all slides in parallel.
+    slide_runs = pool.starmap(
+        get_slide_tile_runs,
+        [(slide_num, folder, training, tile_size, overlap, tiles_per_task, prescreen_threshold,
+          fractions.get(int(slide_num)), seed)
+         for slide_num in slide_nums])
+    tile_runs = (tile_run for runs in slide_runs for tile_run in runs)
+
+    # Process the tile runs, keeping a bounded number of tasks in flight.
+    pending = deque()
+    while True:
+      while len(pending) < max_pending_tasks:
+        tile_run = next(tile_runs, None)
+        if tile_run is None:
+          break
+        slide_num = tile_run[0][0]
+        stains = {slide_num: slide_stains[slide_num]} if slide_stains is not None else None
+        pending.append(pool.apply_async(
+            process_tile_run,
+            (tile_run, folder, training, tile_size, tissue_threshold, sample_size, grayscale,
+             normalize_stains, tissue_downsample, stain_batch_size, stains, batch_samples)))
+      if not pending:
+        break
+      for sample_tuple in pending.popleft().get():
+        if training:
+          yield add_labels(sample_tuple, labels)
+        else:
+          yield sample_tuple
+
+
+# Stream Samples From Slides
+
+def get_sample_coords(tile_index, sample_size, num_samples):
+  """
+  Get the coordinates of the samples cut from a tile.
+
+  The coordinates of a sample are its (col, row) position on the grid
+  of square `sample_size` samples at the zoom level of the tile.  If
+  `sample_size` equals the tile size, these are the tile coordinates.
+
+  Args:
+    tile_index: A (slide_num, tile_size, overlap, zoom_level, col, row)
+      integer index tuple.
+    sample_size: The width and height of the square samples.
+    num_samples: Number of samples cut from the tile, in the order of
+      `process_tile`.
+
+  Returns:
+    An integer NumPy array of shape (num_samples, 2) of (col, row)
+    coordinates.
+  """
+  _, tile_size, _, _, col, row = tile_index
+  samples_per_side = tile_size // sample_size
+  n = np.arange(num_samples)
+  return np.stack([col * samples_per_side + n % samples_per_side,
+                   row * samples_per_side + n // samples_per_side], axis=1)
+
+
+_STREAM_DONE = object()
+
+
+def stream_samples(slide_nums, folder="data", training=True, tile_size=1024, overlap=0,
+                   tissue_threshold=0.9, sample_size=256, grayscale=False, normalize_stains=True,
+                   num_threads=4, queue_size=64, prescreen_threshold=None, tissue_downsample=1):
+  """
+  Lazily stream the samples of a set of whole-slide images.
+
+  This is a pure-Python alternative to `preprocess` for consumers such
+  as notebooks and training code.  A pool of `num_threads` threads
+  reads, filters, cuts, and normalizes the tiles of the slides, one
+  slide after another, and puts the samples into a queue that holds at
+  most `queue_size` samples.  The threads block while the queue is
+  full, so memory use is proportional to the queue size, regardless of
+  the size of the slides.  Closing the generator early stops the
+  threads.
+
+  Args:
+    slide_nums: List of whole-slide numbers to process.
+    folder: Local directory in which the slides folder is stored, as a
+      string.  See `preprocess`.
+    training: Boolean for training or testing datasets.
+    tile_size: The width and height of a square tile to be generated.
+    overlap: Number of pixels by which to overlap the tiles.
+    tissue_threshold: Tissue percentage threshold for filtering, or None
+      to keep all tiles.
+    sample_size: The new width and height of the square samples to be
+      generated.
+    grayscale: Whether or not to generate grayscale samples, rather
+      than RGB.
+    normalize_stains: Whether or not to apply stain normalization.
+    num_threads: Number of threads with which to process tiles.
+    queue_size: Maximum number of samples to prefetch.
+    prescreen_threshold: Optional low-resolution tissue prescreening
+      threshold.  See `process_slide`.
+    tissue_downsample: Integer factor by which to downsample tiles
+      during tissue detection.  See `keep_tile`.
+
+  Returns:
+    Yields (slide_num, coords, sample) tuples, where coords is the
+    (col, row) position of the sample on the grid of samples at the
+    20x zoom level of the slide (see `get_sample_coords`), and sample
+    is a 3D NumPy array of shape (sample_size, sample_size, channels).
+    With more than one thread, the samples of neighbouring tiles may
+    be yielded out of order.
+  """
+  import queue
+
+  def generate_tile_indices():
+    for slide_num in slide_nums:
+      if get_slide_cache().get_slide(slide_num, folder, training) is None:
+        continue
+      tile_indices = process_slide(slide_num, folder, training, tile_size, overlap,
+                                   prescreen_threshold)
+      # Read the tiles in the order in which they are laid out in the slide file.
+      for tile_run in get_tile_runs(tile_indices, max(len(tile_indices), 1)):
+        for tile_index in tile_run:
+          yield tile_index
+
+  tile_indices = generate_tile_indices()
+  lock = threading.Lock()
+  stop = threading.Event()
+  samples = queue.Queue(queue_size)
+
+  def put(item):
+    # Block while the queue is full, unless the consumer has stopped.
+    while not stop.is_set():
+      try:
+        samples.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def work():
+    try:
+      while not stop.is_set():
+        with lock:
+          tile_index = next(tile_indices, None)
+        if tile_index is None:
+          break
+        tile = process_tile_index(tile_index, folder, training)
+        if (tissue_threshold is not None and
+            not keep_tile(tile, tile_size, tissue_threshold, tissue_downsample)):
+          continue
+        slide_num, coords, tile_samples = process_tile(tile, sample_size, grayscale, batch=True,
+                                                       tile_index=tile_index)
+        for sample, sample_coords in zip(tile_samples, coords):
+          if normalize_stains:
+            _, sample = normalize_staining((slide_num, sample))
+          if not put((slide_num, (int(sample_coords[0]), int(sample_coords[1])), sample)):
+            return
+    except Exception as e:
+      put(e)
+    finally:
+      put(_STREAM_DONE)
+
+  threads = [threading.Thread(target=work, daemon=True) for _ in range(num_threads)]
+  for thread in threads:
+    thread.start()
+  try:
+    num_done = 0
+    while num_done < num_threads:
+      item = samples.get()
+      if item is _STREAM_DONE:
+        num_done += 1
+      elif isinstance(item, Exception):
+        raise item
+      else:
+        yield item
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+
+
 # Save DataFrame
 
-def save_df(df, filepath, sample_size, grayscale, mode="error", format="parquet", file_size=128):
+def save_df(df, filepath, sample_size, grayscale, mode="error", format="parquet", file_size=128,
+            partition_by=None):
   """
   Save a preprocessed DataFrame with a constraint on the file sizes.
 
@@ -639,16 +2291,183 @@ def save_df(df, filepath, sample_size, grayscale, mode="error", format="parquet"
     format: The format in which to save the DataFrame.
     file_size: Size in MB of each saved file.  128 MB is an
       empirically ideal size.
+    partition_by: Optional column name, or list of column names, by
+      which to partition the saved data on disk, e.g. "slide_num".
+      With `mode="overwrite"` and the Spark
+      `spark.sql.sources.partitionOverwriteMode` setting set to
+      "dynamic", only the partitions present in `df` are replaced.
   """
   channels = 1 if grayscale else 3
-  row_mb = sample_size * sample_size * channels * 8 / 1024 / 1024  # size of one row in MB
+  # Samples are stored as either 8-byte doubles in a Vector, or raw bytes.
+  value_bytes = 1 if isinstance(df.schema["sample"].dataType, BinaryType) else 8
+  row_mb = sample_size * sample_size * channels * value_bytes / 1024 / 1024  # size of one row in MB
   rows_per_file = round(file_size / row_mb)
-  df.write.option("maxRecordsPerFile", rows_per_file).mode(mode).save(filepath, format=format)
+  writer = df.write.option("maxRecordsPerFile", rows_per_file).mode(mode)
+  if partition_by is not None:
+    writer = writer.partitionBy(partition_by)
+  writer.save(filepath, format=format)
+
+
+# Checkpointing
+
+TILE_INDEX_COLUMNS = ["slide_num", "tile_size", "overlap", "zoom_level", "col", "row"]
+
+
+def filter_tile_indices(tile_indices, folder, training, tile_size, tissue_threshold,
+                        tissue_downsample=1):
+  """
+  Filter an RDD of tile indices down to those of tiles with tissue.
+
+  This reads and checks each tile with `keep_tile`, but only keeps the
+  index of the tile, so that the result can be saved cheaply and
+  reused as the `tile_indices` of `preprocess` with a
+  `tissue_threshold` of None.
+
+  Args:
+    tile_indices: An RDD of (slide_num, tile_size, overlap, zoom_level,
+      col, row) integer index tuples.
+    folder: Directory in which the slides folder is stored, as a string.
+      This should contain either a `training_image_data` folder with
+      images in the format `TUPAC-TR-###.svs`, or a `testing_image_data`
+      folder with images in the format `TUPAC-TE-###.svs`.
+    training: Boolean for training or testing datasets.
+    tile_size: The width and height of the square tiles.
+    tissue_threshold: Tissue percentage threshold for filtering.
+    tissue_downsample: Integer factor by which to downsample tiles
+      during tissue detection.  See `keep_tile`.
+
+  Returns:
+    An RDD of the tile indices of the tiles that should be kept.
+  """
+  return tile_indices.filter(
+      lambda tile_index: keep_tile(process_tile_index(tile_index, folder, training), tile_size,
+                                   tissue_threshold, tissue_downsample))
+
+
+def tile_indices_2_df(spark, tile_indices):
+  """
+  Convert an RDD of tile indices to a Spark DataFrame.
+
+  Args:
+    spark: SparkSession.
+    tile_indices: An RDD of (slide_num, tile_size, overlap, zoom_level,
+      col, row) integer index tuples.
+
+  Returns:
+    A Spark DataFrame with integer `TILE_INDEX_COLUMNS` columns.
+  """
+  schema = StructType([StructField(name, IntegerType()) for name in TILE_INDEX_COLUMNS])
+  return spark.createDataFrame(
+      tile_indices.map(lambda tile_index: tuple(int(x) for x in tile_index)), schema)
+
+
+def df_2_tile_indices(df):
+  """
+  Convert a Spark DataFrame of tile indices back to an RDD.
+
+  Args:
+    df: A Spark DataFrame with `TILE_INDEX_COLUMNS` columns, in any
+      order, such as one saved from `tile_indices_2_df`.
+
+  Returns:
+    An RDD of (slide_num, tile_size, overlap, zoom_level, col, row)
+    integer index tuples.
+  """
+  return df.select(*TILE_INDEX_COLUMNS).rdd.map(tuple)
+
+
+def get_fingerprint(params):
+  """
+  Get a short, stable fingerprint of a set of parameters.
+
+  Args:
+    params: A JSON-serializable dictionary of parameters.
+
+  Returns:
+    A 12 character hexadecimal string.
+  """
+  return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def load_manifest(path):
+  """
+  Load a manifest of completed slides from a JSON file.
+
+  Args:
+    path: Path to the manifest file.  It does not need to exist.
+
+  Returns:
+    A dictionary mapping stage names to dictionaries that map slide
+    numbers, as strings, to the modification times of the slide files
+    that were processed.
+  """
+  return load_stain_cache(path)
+
+
+def save_manifest(manifest, path):
+  """
+  Save a manifest of completed slides to a JSON file.
+
+  The file is replaced atomically, so that an interrupted run never
+  leaves a corrupted manifest behind.
+
+  Args:
+    manifest: A dictionary as returned by `load_manifest`.
+    path: Path to the manifest file.
+  """
+  save_stain_cache(manifest, path)
+
+
+def get_stale_slides(manifest, stage, slide_nums, folder, training):
+  """
+  Get the slides whose outputs of a stage are missing or stale.
+
+  Outputs are stale if the slide file has been modified since the
+  stage was completed for it.
+
+  Args:
+    manifest: A dictionary as returned by `load_manifest`.
+    stage: The name of the stage, which should include a fingerprint
+      of its parameters.
+    slide_nums: List of whole-slide numbers.
+    folder: Directory in which the slides folder is stored, as a string.
+    training: Boolean for training or testing datasets.
+
+  Returns:
+    A list of the slide numbers that need to be (re)processed.
+  """
+  completed = manifest.get(stage, {})
+  stale = []
+  for slide_num in slide_nums:
+    filename = get_slide_filename(slide_num, folder, training)
+    mtime = os.path.getmtime(filename) if os.path.isfile(filename) else None
+    if completed.get(str(slide_num), -1) != mtime:
+      stale.append(slide_num)
+  return stale
+
+
+def mark_slides_complete(manifest, stage, slide_nums, folder, training):
+  """
+  Record the slides for which a stage has been completed.
+
+  Args:
+    manifest: A dictionary as returned by `load_manifest`, which will
+      be updated in place.
+    stage: The name of the stage, which should include a fingerprint
+      of its parameters.
+    slide_nums: List of whole-slide numbers.
+    folder: Directory in which the slides folder is stored, as a string.
+    training: Boolean for training or testing datasets.
+  """
+  completed = manifest.setdefault(stage, {})
+  for slide_num in slide_nums:
+    filename = get_slide_filename(slide_num, folder, training)
+    completed[str(slide_num)] = os.path.getmtime(filename) if os.path.isfile(filename) else None
 
 
 # Utilities
 
-def add_row_indices(df, training=True):
+def add_row_indices(df, training=True, method="partition"):
   """
   Add a row index column for faster data ingestion times with SystemML.
 
@@ -657,10 +2476,47 @@ def add_row_indices(df, training=True):
       tumor score, molecular score, and the sample stretched out into a
       Vector.
     training: Boolean for training or testing datasets.
+    method: The method with which to compute the indices.  Options
+      include:
+        * `partition`: Count the rows of each partition, and offset
+          `monotonically_increasing_id` by the number of rows in all
+          preceding partitions, entirely within the DataFrame API.  The
+          indices are recorded in the metadata of the "__INDEX" column
+          as {"start": 1, "count": <number of rows>, "contiguous": true},
+          which is saved in the Parquet files.  Note that `df` is
+          evaluated twice, so it should be deterministic, e.g. read
+          from files, or cached.
+        * `zip`: Round trip through the RDD API with `zipWithIndex`.
+      Both methods produce the same indices.
 
   Returns:
-    The Spark DataFrame with a row index column called "__INDEX".
+    The Spark DataFrame with a 1-based row index column called "__INDEX".
   """
+  if method == "partition":
+    # Count the rows in each partition, and compute the index of the first row of each.
+    counts = dict(df.select(F.spark_partition_id().alias("partition"))
+                    .groupBy("partition").count()
+                    .collect())
+    num_partitions = max(counts, default=-1) + 1
+    offsets = np.concatenate([[0], np.cumsum([counts.get(i, 0) for i in range(num_partitions)])])
+    num_rows = int(offsets[-1])
+    # The ids generated by `monotonically_increasing_id` contain the partition id in the upper
+    # 31 bits, and the position within the partition in the lower 33 bits.
+    partition = F.spark_partition_id()
+    position = F.monotonically_increasing_id() - F.shiftLeft(partition.cast("long"), 33)
+    offset = F.array(*[F.lit(int(x)) for x in offsets[:-1]] or [F.lit(0)])[partition]
+    index_type = "int" if num_rows < 2**31 else "long"
+    metadata = {"start": 1, "count": num_rows, "contiguous": True}
+    index = (position + offset + 1).astype(index_type).alias("__INDEX", metadata=metadata)
+    if training:
+      df = df.select(index, df.slide_num.astype("int"), df.tumor_score.astype("int"),
+                     df.molecular_score, df["sample"])
+    else:  # testing data -- no labels
+      df = df.select(index, df.slide_num.astype("int"), df["sample"])
+    return df
+  elif method != "zip":
+    raise ValueError("method must be either 'partition' or 'zip', got {}".format(method))
+
   rdd = (df.rdd
            .zipWithIndex()
            .map(lambda r: (r[1] + 1, *r[0])))  # flatten & convert index to 1-based indexing
@@ -693,7 +2549,7 @@ def sample(df, frac, training=True, seed=None):
   return df_sample
 
 
-def rdd_2_df(rdd, training=True):
+def rdd_2_df(rdd, training=True, storage="vector", sample_shape=None):
   """
   Convert the sample RDD to a Spark DataFrame.
 
@@ -703,36 +2559,304 @@ def rdd_2_df(rdd, training=True):
       sample); for the RDD witout labels, each element will be (slide_num,
       sample).
     training: Boolean for training or testing datasets.
+    storage: The way in which to store the samples.  Options include:
+        * `vector`: Stretch each sample out into a Vector of doubles,
+          after transposing it from (H,W,C) to (C,H,W).
+        * `binary`: Store the raw (H,W,C) uint8 bytes of each sample,
+          which is 8x smaller.  The shape of the samples is recorded in
+          the metadata of the "sample" column.  See
+          `read_binary_samples`.
+    sample_shape: The (H,W,C) shape of the samples, which is required
+      for `binary` storage.
+
+  Batches of samples, as generated by `preprocess` with
+  `batch_samples=True`, are split into one row per sample.
 
   Returns:
     A Spark DataFrame in which each row contains the slide number, tumor
-    score, molecular score, and the sample stretched out into a Vector.
+    score, molecular score, and the sample stretched out into a Vector
+    or stored as raw bytes.
   """
+  if storage == "vector":
+    sample_type = VectorUDT()
+    to_sample = lambda sample: Vectors.dense(flatten_sample(sample))
+  elif storage == "binary":
+    if sample_shape is None:
+      raise ValueError("sample_shape is required for binary storage")
+    sample_type = BinaryType()
+    to_sample = lambda sample: bytearray(np.ascontiguousarray(sample, dtype=np.uint8))
+  else:
+    raise ValueError("storage must be either 'vector' or 'binary', got {}".format(storage))
+  metadata = {}
+  if sample_shape is not None:
+    metadata = {"shape": [int(x) for x in sample_shape], "dtype": "uint8", "layout": "HWC"}
+  sample_field = StructField("sample", sample_type, metadata=metadata)
+  rdd = rdd.flatMap(unbatch_samples)
+
   if training:
     # Append labels
     samples_with_labels = (rdd.map(
-        lambda tup: (tup[0], tup[1], tup[2], Vectors.dense(flatten_sample(tup[3])))))
-    df = samples_with_labels.toDF(["slide_num", "tumor_score", "molecular_score", "sample"])
-    df = df.select(df.slide_num.astype("int"), df.tumor_score.astype("int"),
-                     df.molecular_score, df["sample"])
+        lambda tup: (int(tup[0]), int(tup[1]), float(tup[2]), to_sample(tup[3]))))
+    schema = StructType([StructField("slide_num", IntegerType()),
+                         StructField("tumor_score", IntegerType()),
+                         StructField("molecular_score", DoubleType()),
+                         sample_field])
+    df = samples_with_labels.toDF(schema)
   else:  # testing data -- no labels
-    samples = (rdd.map(lambda tup: (tup[0], Vectors.dense(flatten_sample(tup[1])))))
-    df = samples.toDF(["slide_num", "sample"])
-    df = df.select(df.slide_num.astype("int"), df["sample"])
+    samples = rdd.map(lambda tup: (int(tup[0]), to_sample(tup[1])))
+    schema = StructType([StructField("slide_num", IntegerType()), sample_field])
+    df = samples.toDF(schema)
   return df
 
 
-def save_rdd_2_jpeg(rdd, save_dir):
+def read_binary_samples(path, sample_shape=None, batch_size=1024):
+  """
+  Read samples stored with `binary` storage as NumPy arrays.
+
+  This reads the Parquet files of a DataFrame saved from `rdd_2_df`
+  with `storage="binary"` directly, without Spark, and yields the
+  samples of each batch of rows as a single array that is a zero-copy
+  view of the bytes read from disk.
+
+  DataFrames saved with partitioning, such as by `save_df` with
+  `partition_by`, are read recursively, and the partition columns,
+  which Spark only encodes in the `key=value` directory names, are
+  added back to each batch.
+
+  Note: This requires `pyarrow`.
+
+  Args:
+    path: Path to a Parquet file, or a directory of Parquet files,
+      possibly within partition subdirectories.
+    sample_shape: Optional (H,W,C) shape of the samples.  If None, the
+      shape is taken from the metadata of the "sample" column.
+    batch_size: Maximum number of rows in each batch.
+
+  Returns:
+    Yields dictionaries mapping each column name to a NumPy array of
+    the values of a batch of rows, where the "sample" entry is a uint8
+    array of shape (N,H,W,C).
+  """
+  import pyarrow as pa  # optional dependency
+  import pyarrow.parquet as pq
+
+  def parse_partition_value(value):
+    # Spark infers the types of partition columns from their values
+    for parse in (int, float):
+      try:
+        return parse(value)
+      except ValueError:
+        pass
+    return value
+
+  if os.path.isdir(path):
+    filenames = []
+    for root, dirs, files in os.walk(path):
+      dirs[:] = sorted(d for d in dirs if not d.startswith((".", "_")))
+      filenames.extend(os.path.join(root, f) for f in sorted(files)
+                       if f.endswith(".parquet") and not f.startswith((".", "_")))
+  else:
+    filenames = [path]
+  for filename in filenames:
+    partitions = {}
+    if os.path.isdir(path):
+      for part in os.path.relpath(os.path.dirname(filename), path).split(os.sep):
+        if "=" in part:
+          key, value = part.split("=", 1)
+          partitions[key] = parse_partition_value(value)
+    parquet_file = pq.ParquetFile(filename)
+    shape = sample_shape
+    if shape is None:
+      # Spark stores the schema of the DataFrame, including column metadata,
+      # in the Parquet footer.
+      spark_schema = parquet_file.schema_arrow.metadata[b"org.apache.spark.sql.parquet.row.metadata"]
+      fields = {field["name"]: field for field in json.loads(spark_schema)["fields"]}
+      shape = fields["sample"]["metadata"]["shape"]
+    sample_bytes = int(np.prod(shape))
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+      columns = {name: batch.column(i) for i, name in enumerate(batch.schema.names)}
+      binary = columns.pop("sample")
+      if binary.null_count:
+        raise ValueError("found null samples in {}".format(filename))
+      # The values of a binary column are stored back to back in a single
+      # data buffer, delimited by an offsets buffer.
+      _, offsets, data = binary.buffers()
+      offset_type = np.int64 if pa.types.is_large_binary(binary.type) else np.int32
+      offsets = np.frombuffer(offsets, dtype=offset_type)[binary.offset:binary.offset+len(binary)+1]
+      if np.any(np.diff(offsets) != sample_bytes):
+        raise ValueError("samples in {} do not have shape {}".format(filename, shape))
+      samples = np.frombuffer(data, dtype=np.uint8)[offsets[0]:offsets[-1]]
+      batch_dict = {name: column.to_numpy(zero_copy_only=False)
+                    for name, column in columns.items()}
+      for key, value in partitions.items():
+        batch_dict[key] = np.full(len(binary), value)
+      batch_dict["sample"] = samples.reshape(len(binary), *shape)
+      yield batch_dict
+
+
+def save_rdd_2_jpeg(rdd, save_dir, shards=False):
   """
   Save the Spark RDD into JPEG
 
+  Each partition is written in bulk by `save_partition_2_jpeg`, and
+  each sample is named deterministically by its slide number and a
+  hash of its contents, so that reruns and retried tasks overwrite
+  the same files rather than creating duplicates or collisions.
+
   Args:
     rdd: the spark RDD with or without labels. The RDD element could be
      a tuple with labels (slide_num, tumor_score, molecular_score, sample)
      or a tuple without labels, e.g. (slide_num, sample)
     save_dir: the file directory at which to save JPEGs
+    shards: Whether to pack the JPEGs of each partition into a single
+      `shard-<partition>.tar` file with an accompanying
+      `shard-<partition>.index` file, rather than writing individual
+      JPEG files.
+  """
+  rdd.foreachPartition(lambda sample_elements:
+                       save_partition_2_jpeg(sample_elements, save_dir, shards))
+
+
+def save_partition_2_jpeg(sample_elements, save_dir, shards=False, shard_id=None):
+  """
+  Save a partition of samples with or without labels into JPEG
+
+  Labelled samples are saved into a `<tumor_score>` subdirectory (or
+  tar member path) of `save_dir`.
+
+  Args:
+    sample_elements: An iterable of sample tuples with labels, e.g.
+      (slide_num, tumor_score, molecular_score, sample), or without
+      labels, e.g. (slide_num, sample), or of batches of samples with
+      coordinates, as generated by `preprocess` with
+      `batch_samples=True`.  Samples from batches are named by their
+      coordinates, rather than by a hash of their contents.  Since
+      separate samples do not carry their coordinates, identical
+      samples, such as blank background, are disambiguated by the
+      order in which they occur, so that none of them are dropped.
+      However, identical separate samples in different partitions
+      share a file, so use `batch_samples=True` to save one file per
+      sample location.
+    save_dir: the file directory at which to save JPEGs
+    shards: Whether to pack the JPEGs into a single tar shard with an
+      index file, rather than writing individual JPEG files.
+    shard_id: The integer id of the shard.  If None, the id of the
+      current Spark partition is used.
+
+  Returns:
+    The number of saved samples, which is also the number of distinct
+    files, or shard members, that were written.
+  """
+  made_dirs = set()
+  name_counts = {}
+  if shards:
+    import tarfile
+    from pyspark import TaskContext
+    if shard_id is None:
+      shard_id = TaskContext.get().partitionId()
+    os.makedirs(save_dir, exist_ok=True)
+    shard_path = os.path.join(save_dir, "shard-{:05d}.tar".format(shard_id))
+    index_path = os.path.join(save_dir, "shard-{:05d}.index".format(shard_id))
+    # Write to temporary files, and then move them into place, so that a
+    # failed task never leaves a partial shard behind.
+    tar = tarfile.open(shard_path + ".tmp", "w")
+    index = []
+  def generate_named_samples():
+    for sample_element in sample_elements:
+      if len(sample_element) in (3, 5):  # batch of samples with coordinates
+        for element, coords in zip(unbatch_samples(sample_element), sample_element[-2]):
+          yield get_jpeg_name(element, coords)
+      else:
+        yield get_jpeg_name(sample_element)
+
+  count = 0
+  for label, filename, img_value in generate_named_samples():
+    name = filename if label is None else os.path.join(str(label), filename)
+    if name in name_counts:  # identical separate sample, e.g. blank background
+      name_counts[name] += 1
+      root, ext = os.path.splitext(name)
+      name = "{}_{}{}".format(root, name_counts[name], ext)
+    else:
+      name_counts[name] = 0
+    data = encode_jpeg(img_value)
+    if shards:
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      tar.addfile(info, io.BytesIO(data))
+      # The data is followed by padding up to the next 512-byte block.
+      offset = tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+      index.append("{}\t{}\t{}\t{}\n".format(
+          name, "" if label is None else label, offset, info.size))
+    else:
+      filepath = os.path.join(save_dir, name)
+      dirname = os.path.dirname(filepath)
+      if dirname not in made_dirs:
+        os.makedirs(dirname, exist_ok=True)
+        made_dirs.add(dirname)
+      with open(filepath, "wb") as f:
+        f.write(data)
+    count += 1
+  if shards:
+    tar.close()
+    with open(index_path + ".tmp", "w") as f:
+      f.write("name\tlabel\toffset\tsize\n")
+      f.writelines(index)
+    os.replace(shard_path + ".tmp", shard_path)
+    os.replace(index_path + ".tmp", index_path)
+  return count
+
+
+def get_jpeg_name(sample_element, coords=None):
+  """
+  Get the label and deterministic JPEG filename of a sample.
+
+  Args:
+    sample_element: it may be a sample tuple with labels, e.g. (slide_num, tumor_score, molecular_score, sample)
+      or a sample tuple without labels, e.g. (slide_num, sample)
+    coords: Optional (col, row) coordinates of the sample, as returned
+      by `get_sample_coords`.
+
+  Returns:
+    A (tumor_score, filename, sample) tuple, where tumor_score is None
+    for samples without labels, and filename is of the form
+    `<slide_num>_<col>_<row>.jpeg` if `coords` are given, or
+    `<slide_num>_<hash>.jpeg` with a hash of the sample contents
+    otherwise.
+  """
+  if len(sample_element) == 4: # for the sample element with labels
+    slide_num, tumor_score, molecular_score, img_value = sample_element
+  elif len(sample_element) == 2: # for the sample element without labels
+    slide_num, img_value = sample_element
+    tumor_score = None
+  else:
+    raise ValueError("This type of sample_element is not supported yet")
+  if coords is not None:
+    filename = '{slide_num}_{col}_{row}.jpeg'.format(slide_num=slide_num, col=coords[0],
+                                                     row=coords[1])
+  else:
+    digest = hashlib.sha1(np.ascontiguousarray(img_value, dtype=np.uint8)).hexdigest()
+    filename = '{slide_num}_{hash}.jpeg'.format(slide_num=slide_num, hash=digest[:16])
+  return tumor_score, filename, img_value
+
+
+def encode_jpeg(img_value):
+  """
+  Encode a sample as JPEG bytes.
+
+  Args:
+    img_value: the image value with the size (img_size_x, img_size_y, channels)
+
+  Returns:
+    The JPEG-encoded bytes.
   """
-  rdd.foreach(lambda sample_element: save_2_jpeg(sample_element, save_dir))
+  img_value = img_value.astype(np.uint8)
+  if img_value.shape[2] == 1:  # grayscale
+    img = Image.fromarray(img_value[:, :, 0], 'L')
+  else:
+    img = Image.fromarray(img_value, 'RGB')
+  buf = io.BytesIO()
+  img.save(buf, format='JPEG')
+  return buf.getvalue()
 
 
 def save_2_jpeg(sample_element, save_dir):
@@ -760,9 +2884,7 @@ def save_nonlabelled_sample_2_jpeg(sample, save_dir):
     sample_element: a sample tuple without labels, e.g. (slide_num, sample)
     save_dir: the file directory at which to save JPEGs
   """
-  slide_num, img_value = sample
-  filename = '{slide_num}_{hash}.jpeg'.format(
-    slide_num=slide_num, hash=np.random.randint(1e4))
+  _, filename, img_value = get_jpeg_name(sample)
   filepath = os.path.join(save_dir, filename)
   save_jpeg_help(img_value, filepath)
 
@@ -775,9 +2897,7 @@ def save_labelled_sample_2_jpeg(sample_with_label, save_dir):
     sample_element: a sample tuple with labels, e.g. (slide_num, tumor_score, molecular_score, sample)
     save_dir: the file directory at which to save JPEGs
   """
-  slide_num, tumor_score, molecular_score, img_value = sample_with_label
-  filename = '{slide_num}_{hash}.jpeg'.format(
-      slide_num=slide_num, hash=np.random.randint(1e4))
+  tumor_score, filename, img_value = get_jpeg_name(sample_with_label)
   class_dir = os.path.join(save_dir, str(tumor_score))
   filepath = os.path.join(class_dir, filename)
   save_jpeg_help(img_value, filepath)
@@ -793,6 +2913,424 @@ def save_jpeg_help(img_value, filepath):
    """
   dir = os.path.dirname(filepath)
   os.makedirs(dir, exist_ok=True)
-  img = Image.fromarray(img_value.astype(np.uint8), 'RGB')
-  img.save(filepath)
+  with open(filepath, "wb") as f:
+    f.write(encode_jpeg(img_value))
+
 
+
+# ---
+# tests
+# TODO: eventually move these to a separate file.
+# `py.test breastcancer/preprocessing.py`
+
+def test_keep_tile_parity():
+  from scipy.ndimage import gaussian_filter
+
+  def keep_tile_reference(tile, tile_size, tissue_threshold):
+    # original full resolution, float64 implementation of `keep_tile`
+    if tile.shape[0:2] != (tile_size, tile_size):
+      return False
+    mask = canny(1 - rgb2gray(tile))
+    mask = binary_fill_holes(binary_dilation(binary_closing(mask, disk(10)), disk(10)))
+    check1 = mask.mean() >= tissue_threshold
+    mask = np.min(optical_density(tile), axis=2) >= 0.15
+    mask = binary_fill_holes(binary_dilation(binary_closing(mask, disk(2)), disk(2)))
+    check2 = mask.mean() >= tissue_threshold
+    return check1 and check2
+
+  def create_tile(seed, tissue_frac, size):
+    # textured "tissue" covering roughly `tissue_frac` of a noisy background
+    rng = np.random.RandomState(seed)
+    texture = gaussian_filter(rng.rand(size, size, 3), (2, 2, 0))
+    texture = (texture - texture.min()) / (texture.max() - texture.min())
+    tissue = np.array([100, 30, 100]) + 100 * texture
+    background = 235 + rng.randint(-5, 5, (size, size, 3))
+    blob = gaussian_filter(rng.rand(size, size), 20)
+    mask = blob >= np.percentile(blob, 100 * (1 - tissue_frac))
+    tile = np.where(mask[:, :, np.newaxis], tissue, background)
+    return np.clip(tile, 0, 255).astype(np.uint8)
+
+  tile_size = 128
+  tiles = [create_tile(seed, frac, tile_size)
+           for seed in range(3) for frac in (0, 0.3, 0.6, 0.85, 0.95, 1)]
+  tiles.append(create_tile(0, 1, tile_size)[:100])  # partial tile
+
+  # full resolution decisions match the original implementation
+  for tissue_threshold in (0.1, 0.5, 0.8, 0.9):
+    for tile in tiles:
+      keep = keep_tile((1, tile), tile_size, tissue_threshold)
+      assert keep == keep_tile_reference(tile, tile_size, tissue_threshold)
+
+  # downsampled morphology yields valid percentages
+  for tile in tiles[:-1]:
+    for downsample in (2, 4):
+      assert 0 <= tissue_percentage_edges(tile, downsample) <= 1
+      assert 0 <= tissue_percentage_od(tile, downsample) <= 1
+
+  # plain background is always dropped
+  assert not keep_tile((1, tiles[0]), tile_size, 0.1, downsample=4)
+
+
+def test_normalize_staining_batch():
+  def create_he_sample(rng, size):
+    # mixture of two randomly perturbed H&E stains, with some background and noise
+    stains = STAIN_REF + rng.uniform(-0.1, 0.1, STAIN_REF.shape)
+    stains /= np.linalg.norm(stains, axis=0)
+    sats = rng.gamma(2, 0.3, (2, size * size)) * rng.uniform(0.5, 1.5, (2, 1))
+    sats[:, rng.rand(size * size) < 0.2] = 0
+    x = 255 * 10**(-np.dot(stains, sats)) + rng.normal(0, 2, (3, size * size))
+    return np.clip(np.round(x.T.reshape(size, size, 3)), 0, 255).astype(np.uint8)
+
+  rng = np.random.RandomState(0)
+  samples = np.stack([create_he_sample(rng, 32) for _ in range(8)])
+
+  def assert_close(batch, reference):
+    assert batch.dtype == np.uint8 and batch.shape == samples.shape
+    assert np.abs(batch.astype(np.int64) - reference).max() <= 1
+
+  # estimated stains match the per-sample implementation
+  reference = np.stack([normalize_staining((1, sample))[1] for sample in samples])
+  assert_close(normalize_staining_batch(samples), reference)
+
+  # results are written into a preallocated buffer
+  out = np.zeros_like(samples)
+  assert normalize_staining_batch(samples, out=out) is out
+  assert_close(out, reference)
+
+  # fixed stains, with and without fixed saturations
+  stains, max_sat = STAIN_REF * 1.05, MAX_SAT_REF * 1.1
+  reference = np.stack([normalize_staining((1, sample), stains=stains, max_sat=max_sat)[1]
+                        for sample in samples])
+  assert_close(normalize_staining_batch(samples, stains=stains, max_sat=max_sat), reference)
+  reference = np.stack([normalize_staining((1, sample), stains=stains)[1] for sample in samples])
+  assert_close(normalize_staining_batch(samples, stains=stains), reference)
+
+  # samples without tissue are left unchanged
+  blank = np.full((2, 32, 32, 3), 250, dtype=np.uint8)
+  assert np.array_equal(normalize_staining_batch(blank), blank)
+
+def test_save_partition_2_jpeg(tmpdir):
+  import tarfile
+
+  rng = np.random.RandomState(0)
+  samples = [(1, 2, 0.5, rng.randint(0, 256, (32, 32, 3)).astype(np.uint8)) for _ in range(3)]
+  samples.append(samples[0])  # duplicate samples, e.g. blank background, are all kept
+
+  # individual files are named deterministically
+  save_dir = str(tmpdir.join("files"))
+  assert save_partition_2_jpeg(iter(samples), save_dir) == 4
+  names = sorted(os.listdir(os.path.join(save_dir, "2")))
+  duplicate_name = get_jpeg_name(samples[0])[1].replace(".jpeg", "_1.jpeg")
+  assert names == sorted([get_jpeg_name(sample)[1] for sample in samples[:3]] + [duplicate_name])
+  assert save_partition_2_jpeg(iter(samples), save_dir) == 4
+  assert sorted(os.listdir(os.path.join(save_dir, "2"))) == names
+
+  # shards contain the same JPEGs, at the offsets listed in the index
+  save_dir = str(tmpdir.join("shards"))
+  save_partition_2_jpeg(iter(samples), save_dir, shards=True, shard_id=3)
+  assert sorted(os.listdir(save_dir)) == ["shard-00003.index", "shard-00003.tar"]
+  index = pd.read_csv(os.path.join(save_dir, "shard-00003.index"), sep="\t")
+  assert len(index) == 4 and index["name"].nunique() == 4 and (index["label"] == 2).all()
+  with open(os.path.join(save_dir, "shard-00003.tar"), "rb") as f:
+    data = f.read()
+  for name, offset, size in zip(index["name"], index["offset"], index["size"]):
+    with open(os.path.join(str(tmpdir.join("files")), name), "rb") as f:
+      assert data[offset:offset+size] == f.read()
+  with tarfile.open(os.path.join(save_dir, "shard-00003.tar")) as tar:
+    assert tar.getnames() == list(index["name"])
+
+
+def test_get_sample_coords():
+  # a 4x4 grid of samples per tile, in the order of `process_tile`
+  tile = np.arange(8 * 8).reshape(8, 8, 1)
+  samples = process_tile((1, tile), 2, False)
+  coords = get_sample_coords((1, 8, 0, 12, 3, 5), 2, len(samples))
+  assert coords.shape == (16, 2)
+  for (_, sample), (col, row) in zip(samples, coords):
+    assert np.array_equal(sample, tile[(row-20)*2:(row-20)*2+2, (col-12)*2:(col-12)*2+2])
+  # a single sample per tile has the tile coordinates
+  assert get_sample_coords((1, 8, 0, 12, 3, 5), 8, 1).tolist() == [[3, 5]]
+
+
+def test_add_labels():
+  labels_df = pd.DataFrame({"tumor_score": [1, 3, 2], "molecular_score": [0.5, 0.25, 0.75]})
+  labels_df["slide_num"] = labels_df.index + 1
+  labels_df.set_index("slide_num", drop=False, inplace=True)
+  labels = get_labels_array(labels_df)
+  sample = np.zeros((4, 4, 3), dtype=np.uint8)
+  for slide_num in labels_df.index:
+    tumor_score = labels_df.at[slide_num, "tumor_score"]
+    molecular_score = labels_df.at[slide_num, "molecular_score"]
+    assert add_labels((slide_num, sample), labels)[:3] == (slide_num, tumor_score,
+                                                          molecular_score)
+  coords, samples = np.zeros((2, 2)), np.zeros((2, 4, 4, 3))
+  slide_num, tumor_score, molecular_score, *batch = add_labels((np.int64(2), coords, samples),
+                                                               labels)
+  assert (type(slide_num), tumor_score, molecular_score) == (int, 3, 0.25)
+  assert batch[0] is coords and batch[1] is samples
+
+
+def benchmark_add_labels(num_slides=500, num_samples=20000, batch_size=16, seed=0):
+  """
+  Time looking up the labels of samples, in microseconds per sample.
+
+  Compares the original two Pandas `.at` lookups per sample against the
+  `get_labels_array` lookup in `add_labels`, both per sample and once
+  per batch of `batch_size` samples.  Run with
+  `python -c "from breastcancer import preprocessing; print(preprocessing.benchmark_add_labels())"`
+  from the repository root.
+  """
+  import timeit
+  rng = np.random.RandomState(seed)
+  labels_df = pd.DataFrame({"tumor_score": rng.randint(1, 4, num_slides),
+                            "molecular_score": rng.rand(num_slides)})
+  labels_df["slide_num"] = labels_df.index + 1
+  labels_df.set_index("slide_num", drop=False, inplace=True)
+  labels = get_labels_array(labels_df)
+  slide_nums = rng.randint(1, num_slides + 1, num_samples)
+  sample = np.zeros((4, 4, 3), dtype=np.uint8)
+  coords, samples = np.zeros((batch_size, 2)), np.zeros((batch_size, 4, 4, 3))
+
+  def pandas_at():
+    for slide_num in slide_nums:
+      (slide_num, labels_df.at[slide_num, "tumor_score"],
+       labels_df.at[slide_num, "molecular_score"], sample)
+  def array_lookup():
+    for slide_num in slide_nums:
+      add_labels((slide_num, sample), labels)
+  def array_lookup_batched():
+    for slide_num in slide_nums[::batch_size]:
+      add_labels((slide_num, coords, samples), labels)
+
+  return {name: min(timeit.repeat(fn, number=1, repeat=3)) / num_samples * 1e6
+          for name, fn in [("pandas_at", pandas_at), ("array_lookup", array_lookup),
+                           ("array_lookup_batched", array_lookup_batched)]}
+
+
+def test_benchmark_add_labels():
+  # NOTE: wall-clock times are too noisy to compare in a test, so only check that it runs
+  times = benchmark_add_labels(num_slides=10, num_samples=100)
+  assert sorted(times) == ["array_lookup", "array_lookup_batched", "pandas_at"]
+  assert all(t > 0 for t in times.values())
+
+
+def test_stream_samples(monkeypatch):
+  import pytest
+
+  class FakeSlideCache:
+    def get_slide(self, slide_num, folder, training):
+      return object() if slide_num != 9 else None  # slide 9 is missing
+
+  def process_slide_mock(slide_num, folder, training, tile_size, overlap, prescreen_threshold):
+    return [(slide_num, tile_size, overlap, 0, col, row) for row in range(2) for col in range(3)]
+
+  def process_tile_index_mock(tile_index):
+    slide_num, tile_size, _, _, col, row = tile_index
+    if tile_index == failing_tile:
+      raise ValueError("corrupt tile")
+    # every 2x2 sample is filled with its global (col, row) position
+    tile = np.empty((tile_size, tile_size, 3), dtype=np.uint8)
+    for i in range(0, tile_size, 2):
+      for j in range(0, tile_size, 2):
+        tile[i:i+2, j:j+2] = (slide_num, col * tile_size // 2 + j // 2,
+                              row * tile_size // 2 + i // 2)
+    return slide_num, tile
+
+  failing_tile = None
+  monkeypatch.setitem(globals(), "get_slide_cache", FakeSlideCache)
+  monkeypatch.setitem(globals(), "process_slide", process_slide_mock)
+  monkeypatch.setitem(globals(), "process_tile_index",
+                      lambda tile_index, folder, training: process_tile_index_mock(tile_index))
+  kwargs = dict(tile_size=4, tissue_threshold=None, sample_size=2, normalize_stains=False,
+                num_threads=3, queue_size=4)
+  num_threads = threading.active_count()
+
+  # all samples of both slides arrive, each with its coordinates
+  samples = list(stream_samples([1, 9, 2], **kwargs))
+  assert len(samples) == 2 * 6 * 4
+  assert sorted((slide_num, coords) for slide_num, coords, _ in samples) == sorted(
+      (slide_num, (col, row)) for slide_num in (1, 2) for row in range(4) for col in range(6))
+  for slide_num, coords, sample in samples:
+    assert sample.shape == (2, 2, 3) and (sample == (slide_num, *coords)).all()
+  assert threading.active_count() == num_threads
+
+  # errors in a worker are re-raised to the consumer
+  failing_tile = (2, 4, 0, 0, 1, 1)
+  with pytest.raises(ValueError, match="corrupt tile"):
+    list(stream_samples([1, 2], **kwargs))
+  assert threading.active_count() == num_threads
+  failing_tile = None
+
+  # closing the generator early stops the threads, even while they are blocked on the queue
+  stream = stream_samples([1, 2], **dict(kwargs, queue_size=1))
+  next(stream)
+  stream.close()
+  assert threading.active_count() == num_threads
+
+def test_sample_tile_indices():
+  tile_indices = [(slide_num, 256, 0, 14, col, row)
+                  for slide_num in (1, 2) for col in range(100) for row in range(100)]
+  sample = sample_tile_indices(tile_indices, 0.1, seed=42)
+  assert abs(len(sample) / len(tile_indices) - 0.1) < 0.01
+  # deterministic, independent of order, and nested across fractions
+  assert sample_tile_indices(tile_indices[::-1], 0.1, seed=42) == sample[::-1]
+  assert set(sample) <= set(sample_tile_indices(tile_indices, 0.2, seed=42))
+  assert sample != sample_tile_indices(tile_indices, 0.1, seed=0)
+  # stratified by slide
+  sample = sample_tile_indices(tile_indices, {1: 0.5, 2: 0}, seed=42)
+  assert 0.45 < len(sample) / 10000 < 0.55 and all(t[0] == 1 for t in sample)
+
+
+def test_read_binary_samples_partitioned(tmpdir):
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  # a DataFrame saved with `partition_by="slide_num"`, in the layout written by Spark
+  shape = (2, 2, 3)
+  spark_schema = json.dumps({"type": "struct", "fields": [
+      {"name": "tumor_score", "type": "integer", "nullable": True, "metadata": {}},
+      {"name": "sample", "type": "binary", "nullable": True, "metadata": {"shape": shape}}]})
+  samples = {}
+  for slide_num, num_samples in [(3, 2), (10, 3)]:
+    slide_samples = np.random.randint(0, 256, size=(num_samples,) + shape, dtype=np.uint8)
+    samples[slide_num] = slide_samples
+    table = pa.table({"tumor_score": pa.array([slide_num % 3 + 1] * num_samples, pa.int32()),
+                      "sample": pa.array([s.tobytes() for s in slide_samples], pa.binary())})
+    table = table.replace_schema_metadata(
+        {"org.apache.spark.sql.parquet.row.metadata": spark_schema})
+    folder = os.path.join(str(tmpdir), "slide_num={}".format(slide_num))
+    os.makedirs(folder)
+    pq.write_table(table, os.path.join(folder, "part-00000.snappy.parquet"))
+  open(os.path.join(str(tmpdir), "_SUCCESS"), "w").close()
+
+  batches = list(read_binary_samples(str(tmpdir)))
+  assert len(batches) == 2
+  for batch in batches:
+    slide_num = batch["slide_num"][0]
+    assert np.all(batch["slide_num"] == slide_num)
+    assert np.array_equal(batch["sample"], samples[slide_num])
+    assert np.all(batch["tumor_score"] == slide_num % 3 + 1)
+  assert sorted(batch["slide_num"][0] for batch in batches) == [3, 10]
+
+
+def test_get_slide_stains_cache(tmpdir, monkeypatch):
+  folder = str(tmpdir)
+  os.makedirs(os.path.join(folder, "training_image_data"))
+  for slide_num in [1, 2]:
+    open(get_slide_filename(slide_num, folder, True), "w").close()
+  stains = np.arange(6, dtype=np.float64).reshape(3, 2)
+  max_sat = np.array([[1.5], [2.5]])
+  estimated = []
+  def estimate_slide_stains_mock(slide_num, folder, training):
+    estimated.append(slide_num)
+    return (stains, max_sat) if slide_num == 1 else None  # slide 2 has no tissue
+  monkeypatch.setitem(globals(), "estimate_slide_stains", estimate_slide_stains_mock)
+  cache_path = os.path.join(folder, "stains.json")
+
+  for _ in range(2):  # the second run is served from the cache
+    slide_stains = get_slide_stains(None, [1, 2, 3], folder, True, cache_path)
+    assert sorted(slide_stains) == [1, 2]
+    assert np.array_equal(slide_stains[1][0], stains)
+    assert np.array_equal(slide_stains[1][1], max_sat)
+    assert slide_stains[2][0] is STAIN_REF and slide_stains[2][1] is MAX_SAT_REF
+  assert estimated == [1, 2]
+  assert load_stain_cache(cache_path)[get_slide_filename(2, folder, True)]["no_tissue"]
+
+  # slides that changed are estimated again
+  os.utime(get_slide_filename(2, folder, True), (0, 0))
+  get_slide_stains(None, [1, 2], folder, True, cache_path)
+  assert estimated == [1, 2, 2]
+
+
+def get_local_spark_session():
+  """Get a small local SparkSession for tests, or skip the test if Spark can't run."""
+  import shutil
+  import pytest
+  from pyspark.sql import SparkSession
+  if "JAVA_HOME" not in os.environ and shutil.which("java") is None:
+    pytest.skip("Spark requires Java")
+  return (SparkSession.builder
+                      .master("local[2]")
+                      .appName("breastcancer-preprocessing-tests")
+                      .config("spark.sql.shuffle.partitions", "4")
+                      .config("spark.ui.enabled", "false")
+                      .getOrCreate())
+
+
+def test_add_row_indices():
+  spark = get_local_spark_session()
+  # uneven partitions, including empty ones
+  partition_sizes = [3, 0, 7, 1, 0, 5]
+  offsets = np.concatenate([[0], np.cumsum(partition_sizes)])
+  rdd = (spark.sparkContext.parallelize(range(len(partition_sizes)), len(partition_sizes))
+      .flatMap(lambda p: [(p, p % 3 + 1, float(i), Vectors.dense([float(i)]))
+                          for i in range(offsets[p], offsets[p+1])]))
+  df = rdd.toDF(["slide_num", "tumor_score", "molecular_score", "sample"]).cache()
+  num_rows = int(offsets[-1])
+
+  for training in (True, False):
+    df_in = df if training else df.select("slide_num", "sample")
+    indexed = add_row_indices(df_in, training)
+    rows = indexed.collect()
+    # contiguous 1-based indices, in the order of the rows
+    assert [row["__INDEX"] for row in rows] == list(range(1, num_rows + 1))
+    assert [row["sample"][0] for row in rows] == list(range(num_rows))
+    assert indexed.schema["__INDEX"].metadata == {"start": 1, "count": num_rows,
+                                                  "contiguous": True}
+    assert indexed.columns == (["__INDEX"] + df_in.columns)
+    # same indices as the RDD round trip
+    zipped = add_row_indices(df_in, training, method="zip")
+    assert ({row["sample"][0]: row["__INDEX"] for row in zipped.collect()} ==
+            {row["sample"][0]: row["__INDEX"] for row in rows})
+
+
+def test_get_tile_catalogue(tmpdir, monkeypatch):
+  spark = get_local_spark_session()
+  path = str(tmpdir.join("catalogue.parquet"))
+  schema = StructType([StructField(name, IntegerType()) for name in TILE_INDEX_COLUMNS] +
+                      [StructField("tissue_downsample", IntegerType()),
+                       StructField("od_percentage", DoubleType()),
+                       StructField("edges_percentage", DoubleType())])
+  built = []
+
+  def build_tile_catalogue_mock(spark, slide_nums, folder, training, tile_size, overlap,
+                                tissue_downsample, num_partitions):
+    # stand-in for reading the tiles of the slides, run on the driver only
+    built.append(sorted(slide_nums))
+    rows = [(slide_num, tile_size, overlap, 16, col, row, tissue_downsample, col / 4, row / 2)
+            for slide_num in slide_nums for row in range(2) for col in range(4)]
+    return spark.createDataFrame(rows, schema)
+
+  def get_entries(df):
+    return sorted(tuple(row[name] for name in schema.names) for row in df.collect())
+
+  monkeypatch.setitem(globals(), "build_tile_catalogue", build_tile_catalogue_mock)
+  get_catalogue = lambda slide_nums, tile_size=256: get_tile_catalogue(
+      spark, slide_nums, "data", True, tile_size, 0, path, tissue_downsample=2)
+
+  # the catalogue round trips through Parquet
+  catalogue = get_catalogue([1, 2])
+  assert built == [[1, 2]]
+  expected = get_entries(build_tile_catalogue_mock(spark, [1, 2], "data", True, 256, 0, 2, 1))
+  built.clear()
+  assert get_entries(catalogue) == expected
+  assert dict(catalogue.dtypes) == {field.name: field.dataType.simpleString()
+                                    for field in schema.fields}
+
+  # only missing slides are built, and only their partitions are written
+  catalogue = get_catalogue([2, 3])
+  assert built == [[3]]
+  expected = get_entries(build_tile_catalogue_mock(spark, [2, 3], "data", True, 256, 0, 2, 1))
+  built.clear()
+  assert get_entries(catalogue) == expected
+  get_catalogue([1, 2, 3])
+  assert built == []
+  get_catalogue([1], tile_size=512)  # other settings are catalogued separately
+  assert built == [[1]]
+  assert get_entries(spark.read.parquet(path)) == sorted(
+      get_entries(build_tile_catalogue_mock(spark, [1, 2, 3], "data", True, 256, 0, 2, 1)) +
+      get_entries(build_tile_catalogue_mock(spark, [1], "data", True, 512, 0, 2, 1)))
+
+  # tiles are filtered against any threshold without reading pixels
+  kept = get_entries(filter_tile_catalogue(get_catalogue([1]), 0.5))
+  assert [(entry[4], entry[5]) for entry in kept] == [(2, 1), (3, 1)]
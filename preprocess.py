@@ -24,108 +24,515 @@ Preprocess -- Predicting Breast Cancer Proliferation Scores with
 Apache SystemML
 
 This script runs the preprocessing phase of the breast cancer project.
+
+The work is split into stages, the outputs of which are saved per slide:
+  1. `tiles`: The tile indices of each slide.
+  2. `kept`: The tile indices of the tiles that contain enough tissue,
+     optionally selected from a persistent catalogue of the tissue
+     percentages of all tiles, which makes threshold sweeps cheap.
+  3. The samples cut from the kept tiles, saved as JPEGs and/or
+     DataFrames.
+The slides completed by each stage are recorded in a JSON manifest,
+keyed by a fingerprint of the parameters of the stage and all stages
+before it.  A rerun therefore only processes slides whose outputs are
+missing, or stale due to a modified slide file, and a change to a
+downstream parameter such as `sample_size` reuses the tile filtering.
+
+With `--backend local`, the slides are instead preprocessed into JPEGs
+on a local process pool, without Spark.
 """
+import argparse
+import itertools
 import os
 import shutil
+import time
 
 import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from pyspark.sql import SparkSession
+import pyspark.sql.functions as F
+
+from breastcancer.preprocessing import (add_row_indices, df_2_tile_indices, filter_tile_catalogue,
+                                        filter_tile_indices, get_fingerprint, get_labels_df,
+                                        get_slide_cache, get_stale_slides, get_tile_catalogue,
+                                        in_tile_sample, load_manifest, mark_slides_complete,
+                                        preprocess, preprocess_local, process_slide, rdd_2_df,
+                                        sample, save_df, save_manifest, save_partition_2_jpeg,
+                                        save_rdd_2_jpeg, tile_indices_2_df)
+
+
+def save_tile_indices(spark, tile_indices, path):
+  """
+  Save an RDD of tile indices, replacing the data of its slides only.
+
+  Args:
+    spark: SparkSession.
+    tile_indices: An RDD of (slide_num, tile_size, overlap, zoom_level,
+      col, row) integer index tuples.
+    path: Hadoop-supported path at which to save the tile indices.
+  """
+  (tile_indices_2_df(spark, tile_indices)
+      .write.partitionBy("slide_num").mode("overwrite").parquet(path))
+
+
+def load_tile_indices(spark, path, slide_nums):
+  """
+  Load the saved tile indices of a set of slides.
+
+  Args:
+    spark: SparkSession.
+    path: Hadoop-supported path at which the tile indices were saved.
+    slide_nums: List of whole-slide numbers to load.
+
+  Returns:
+    An RDD of (slide_num, tile_size, overlap, zoom_level, col, row)
+    integer index tuples.
+  """
+  schema = tile_indices_2_df(spark, spark.sparkContext.emptyRDD()).schema
+  df = spark.read.schema(schema).parquet(path).where(F.col("slide_num").isin(list(slide_nums)))
+  return df_2_tile_indices(df)
+
+
+def load_samples_df(spark, path):
+  """
+  Load a samples DataFrame that was saved partitioned by slide.
+
+  Args:
+    spark: SparkSession.
+    path: Hadoop-supported path at which the DataFrame was saved.
+
+  Returns:
+    The Spark DataFrame, with the "slide_num" column moved back to the
+    front.
+  """
+  df = spark.read.load(path)
+  return df.select("slide_num", *[c for c in df.columns if c != "slide_num"])
+
+
+def remove_slide_jpegs(jpeg_folder, slide_nums):
+  """
+  Remove the JPEGs of a set of slides from a folder of JPEGs.
+
+  The JPEGs are named by content or coordinates, so rather than being
+  overwritten, the JPEGs of a slide that is processed again with
+  different parameters would otherwise be mixed with its old ones.
+
+  Args:
+    jpeg_folder: Local path to a folder of JPEGs, as saved by
+      `save_rdd_2_jpeg` without shards, i.e. with a subfolder per label.
+    slide_nums: List of whole-slide numbers.
+  """
+  prefixes = tuple("{}_".format(int(slide_num)) for slide_num in slide_nums)
+  for dirpath, _, filenames in os.walk(jpeg_folder):
+    for filename in filenames:
+      if filename.startswith(prefixes) and filename.endswith(".jpeg"):
+        os.remove(os.path.join(dirpath, filename))
+
+
+def get_job_folders(jpeg_folder, slide_nums, slides_per_job):
+  """
+  Get the folders of the JPEG shards of each job, named by its slides.
+
+  Any other job folders, e.g. from a run with a different
+  `slides_per_job`, contain the samples of slides that are in the
+  current jobs too, and are therefore removed.
+
+  Args:
+    jpeg_folder: Local path to the folder containing the job folders.
+    slide_nums: List of whole-slide numbers in the split.
+    slides_per_job: Number of slides per job.
+
+  Returns:
+    A list of the local paths to the folders of the jobs, in order.
+  """
+  job_folders = []
+  for i in range(0, len(slide_nums), slides_per_job):
+    chunk = [int(x) for x in slide_nums[i:i+slides_per_job]]
+    job_folders.append(os.path.join(jpeg_folder, "job-{:03d}-{:03d}-{}".format(
+        chunk[0], chunk[-1], get_fingerprint(chunk))))
+  if os.path.isdir(jpeg_folder):
+    for name in os.listdir(jpeg_folder):
+      path = os.path.join(jpeg_folder, name)
+      if name.startswith("job-") and path not in job_folders:
+        shutil.rmtree(path)
+  return job_folders
+
+
+def get_output_suffix(args):
+  """
+  Get the suffix of the names of the output JPEG folders and DataFrames.
+
+  Args:
+    args: The parsed command line arguments.
+
+  Returns:
+    A string such as "256", "256_grayscale", or "0.01_sample_256" if
+    the tiles are sampled with `--tile_sample_frac`.
+  """
+  suffix = "{}{}".format(args.sample_size, "_grayscale" if args.grayscale else "")
+  if args.tile_sample_frac is not None:
+    suffix = "{}_sample_{}".format(args.tile_sample_frac, suffix)
+  return suffix
+
+
+def process_split(spark, args, split, slide_nums, manifest):
+  """
+  Run all preprocessing stages for a split of the slides.
+
+  Args:
+    spark: SparkSession.
+    args: The parsed command line arguments.
+    split: The name of the split, i.e. "train" or "val".
+    slide_nums: List of whole-slide numbers in the split.
+    manifest: A dictionary as returned by `load_manifest`, which will
+      be updated and saved after each stage.
+  """
+  training = True
+  folder = args.folder
+  suffix = get_output_suffix(args)
+  jpeg_folder = os.path.join(args.save_folder, "{}_{}".format(split, suffix))
+  df_path = os.path.join(args.save_folder, "{}_{}.parquet".format(split, suffix))
+  indexed_df_path = os.path.join(args.save_folder, "{}_{}_indexed.parquet".format(split, suffix))
+  sample_df_path = os.path.join(args.save_folder, "{}_{}_sample_{}.parquet".format(
+      split, args.sample_frac, suffix))
+
+  # Fingerprint the parameters of each stage, including those of the stages before it.
+  tiles_params = {"folder": folder, "tile_size": args.tile_size, "overlap": args.overlap,
+                  "prescreen_threshold": args.prescreen_threshold,
+                  "tile_sample_frac": args.tile_sample_frac, "seed": args.seed}
+  kept_params = dict(tiles_params, tissue_threshold=args.tissue_threshold,
+                     tissue_downsample=args.tissue_downsample,
+                     catalogue=args.catalogue_path is not None)
+  samples_params = dict(kept_params, sample_size=args.sample_size, grayscale=args.grayscale,
+                        normalize_stains=args.normalize_stains,
+                        per_slide_stains=args.per_slide_stains,
+                        batch_samples=args.batch_samples, save_jpegs=args.save_jpegs,
+                        jpeg_shards=args.jpeg_shards, convert2DF=args.convert2DF,
+                        storage=args.storage)
+  final_params = dict(samples_params, slide_nums=sorted(int(x) for x in slide_nums),
+                      row_indices=args.row_indices, sample_frac=args.sample_frac)
+  tiles_stage = "tiles_{}".format(get_fingerprint(tiles_params))
+  kept_stage = "kept_{}".format(get_fingerprint(kept_params))
+  samples_stage = "{}_{}".format(split, get_fingerprint(samples_params))
+  final_stage = "{}_final_{}".format(split, get_fingerprint(final_params))
+  tiles_path = os.path.join(args.save_folder, "{}.parquet".format(tiles_stage))
+  kept_path = os.path.join(args.save_folder, "{}.parquet".format(kept_stage))
+
+  # Process the slides in chunks of `slides_per_job` slides, checkpointing after each stage.
+  slides_per_job = args.slides_per_job or max(len(slide_nums), 1)
+  if args.save_jpegs and args.jpeg_shards:
+    job_folders = get_job_folders(jpeg_folder, slide_nums, slides_per_job)
+  for job, i in enumerate(range(0, len(slide_nums), slides_per_job)):
+    chunk = list(slide_nums[i:i+slides_per_job])
+
+    # 1. Tile indices
+    stale = get_stale_slides(manifest, tiles_stage, chunk, folder, training)
+    if stale:
+      print("{} job {}: generating tile indices for {} slides".format(split, job, len(stale)))
+      tile_indices = (spark.sparkContext
+          .parallelize(stale, len(stale))
+          .filter(lambda slide: get_slide_cache().get_slide(slide, folder, training) is not None)
+          .flatMap(lambda slide: process_slide(slide, folder, training, args.tile_size,
+                                               args.overlap, args.prescreen_threshold)))
+      if args.tile_sample_frac is not None:
+        # Sample the tiles before any of them are read.
+        tile_indices = tile_indices.filter(
+            lambda tile_index: in_tile_sample(tile_index, args.tile_sample_frac, args.seed))
+      save_tile_indices(spark, tile_indices, tiles_path)
+      mark_slides_complete(manifest, tiles_stage, stale, folder, training)
+      save_manifest(manifest, args.manifest)
+
+    # 2. Kept tile indices
+    stale = get_stale_slides(manifest, kept_stage, chunk, folder, training)
+    if stale:
+      print("{} job {}: filtering tiles of {} slides".format(split, job, len(stale)))
+      if args.catalogue_path and args.tile_sample_frac is None:
+        # Select the tiles from the catalogue of tissue percentages, without reading pixels.
+        catalogue = get_tile_catalogue(spark, stale, folder, training, args.tile_size,
+                                       args.overlap, args.catalogue_path, args.tissue_downsample,
+                                       args.num_partitions)
+        kept_tile_indices = df_2_tile_indices(filter_tile_catalogue(catalogue,
+                                                                    args.tissue_threshold))
+      else:
+        tile_indices = load_tile_indices(spark, tiles_path, stale)
+        tile_indices = tile_indices.repartition(args.num_partitions)
+        kept_tile_indices = filter_tile_indices(tile_indices, folder, training, args.tile_size,
+                                                args.tissue_threshold, args.tissue_downsample)
+      save_tile_indices(spark, kept_tile_indices, kept_path)
+      mark_slides_complete(manifest, kept_stage, stale, folder, training)
+      save_manifest(manifest, args.manifest)
+
+    # 3. Samples
+    stale = get_stale_slides(manifest, samples_stage, chunk, folder, training)
+    if args.save_jpegs and args.jpeg_shards and not os.path.isdir(job_folders[job]):
+      stale = chunk  # the job folder was removed, e.g. due to a change of `slides_per_job`
+    if stale:
+      if args.save_jpegs and args.jpeg_shards:
+        # Shards mix the samples of all slides in a job, so rewrite the entire job.
+        stale = chunk
+      print("{} job {}: generating samples for {} slides".format(split, job, len(stale)))
+      kept_tile_indices = load_tile_indices(spark, kept_path, stale)
+      rdd = preprocess(spark, stale, folder=folder, training=training, tile_size=args.tile_size,
+                       overlap=args.overlap, tissue_threshold=None, sample_size=args.sample_size,
+                       grayscale=args.grayscale, normalize_stains=args.normalize_stains,
+                       num_partitions=args.num_partitions,
+                       partition_by_slide=args.partition_by_slide,
+                       tiles_per_partition=args.tiles_per_partition,
+                       stain_batch_size=args.stain_batch_size,
+                       per_slide_stains=args.per_slide_stains,
+                       stain_cache_path=args.stain_cache_path, tile_indices=kept_tile_indices,
+                       batch_samples=args.batch_samples)
+      if args.save_jpegs:
+        if args.jpeg_shards:
+          shutil.rmtree(job_folders[job], ignore_errors=True)
+          save_rdd_2_jpeg(rdd, job_folders[job], shards=True)
+        else:
+          remove_slide_jpegs(jpeg_folder, stale)
+          save_rdd_2_jpeg(rdd, jpeg_folder)
+      if args.convert2DF:
+        channels = 1 if args.grayscale else 3
+        sample_shape = (args.sample_size, args.sample_size, channels)
+        df = rdd_2_df(rdd, training, storage=args.storage, sample_shape=sample_shape)
+        # NOTE: `read_binary_samples` restores the `slide_num` partition column of `binary`
+        # DataFrames from the partition directories
+        save_df(df, df_path, args.sample_size, args.grayscale, mode="overwrite",
+                partition_by="slide_num")
+      mark_slides_complete(manifest, samples_stage, stale, folder, training)
+      save_manifest(manifest, args.manifest)
+
+  # Add row indices to, and sample, the complete DataFrame.
+  if (args.convert2DF and (args.row_indices or args.sample_frac > 0) and
+      get_stale_slides(manifest, final_stage, slide_nums, folder, training)):
+    df = load_samples_df(spark, df_path)
+    if args.row_indices:
+      df = add_row_indices(df, training)
+      save_df(df, indexed_df_path, args.sample_size, args.grayscale, mode="overwrite")
+      df = spark.read.load(indexed_df_path)
+    if args.sample_frac > 0:
+      df_sample = sample(df, args.sample_frac, training, args.seed)
+      save_df(df_sample, sample_df_path, args.sample_size, args.grayscale, mode="overwrite")
+    mark_slides_complete(manifest, final_stage, slide_nums, folder, training)
+    save_manifest(manifest, args.manifest)
+
+
+def process_split_local(args, split, slide_nums, manifest):
+  """
+  Preprocess a split of the slides into JPEGs on a local process pool.
+
+  Args:
+    args: The parsed command line arguments.
+    split: The name of the split, i.e. "train" or "val".
+    slide_nums: List of whole-slide numbers in the split.
+    manifest: A dictionary as returned by `load_manifest`, which will
+      be updated and saved after each job.
+  """
+  training = True
+  folder = args.folder
+  suffix = get_output_suffix(args)
+  jpeg_folder = os.path.join(args.save_folder, "{}_{}".format(split, suffix))
+  params = {"folder": folder, "tile_size": args.tile_size, "overlap": args.overlap,
+            "prescreen_threshold": args.prescreen_threshold,
+            "tissue_threshold": args.tissue_threshold,
+            "tissue_downsample": args.tissue_downsample, "sample_size": args.sample_size,
+            "grayscale": args.grayscale, "normalize_stains": args.normalize_stains,
+            "per_slide_stains": args.per_slide_stains, "batch_samples": args.batch_samples,
+            "tile_sample_frac": args.tile_sample_frac, "seed": args.seed,
+            "jpeg_shards": args.jpeg_shards}
+  stage = "{}_local_{}".format(split, get_fingerprint(params))
+
+  slides_per_job = args.slides_per_job or max(len(slide_nums), 1)
+  if args.jpeg_shards:
+    job_folders = get_job_folders(jpeg_folder, slide_nums, slides_per_job)
+  for job, i in enumerate(range(0, len(slide_nums), slides_per_job)):
+    chunk = list(slide_nums[i:i+slides_per_job])
+    stale = get_stale_slides(manifest, stage, chunk, folder, training)
+    if args.jpeg_shards and not os.path.isdir(job_folders[job]):
+      stale = chunk  # the job folder was removed, e.g. due to a change of `slides_per_job`
+    if not stale:
+      continue
+    if args.jpeg_shards:
+      # Shards mix the samples of all slides in a job, so rewrite the entire job.
+      stale = chunk
+    print("{} job {}: generating samples for {} slides".format(split, job, len(stale)))
+    start = time.time()
+    samples = preprocess_local(stale, folder=folder, training=training, tile_size=args.tile_size,
+                               overlap=args.overlap, tissue_threshold=args.tissue_threshold,
+                               sample_size=args.sample_size, grayscale=args.grayscale,
+                               normalize_stains=args.normalize_stains, processes=args.processes,
+                               prescreen_threshold=args.prescreen_threshold,
+                               tissue_downsample=args.tissue_downsample,
+                               stain_batch_size=args.stain_batch_size,
+                               per_slide_stains=args.per_slide_stains,
+                               stain_cache_path=args.stain_cache_path,
+                               batch_samples=args.batch_samples,
+                               sample_frac=args.tile_sample_frac, seed=args.seed)
+    if args.jpeg_shards:
+      shutil.rmtree(job_folders[job], ignore_errors=True)
+      count = 0
+      for shard_id in itertools.count():
+        shard = list(itertools.islice(samples, args.tiles_per_partition))
+        if not shard:
+          break
+        count += save_partition_2_jpeg(shard, job_folders[job], shards=True, shard_id=shard_id)
+    else:
+      remove_slide_jpegs(jpeg_folder, stale)
+      count = save_partition_2_jpeg(samples, jpeg_folder)
+    elapsed = time.time() - start
+    print("{} job {}: saved {} samples in {:.1f}s ({:.1f} samples/s)".format(
+        split, job, count, elapsed, count / elapsed))
+    mark_slides_complete(manifest, stage, stale, folder, training)
+    save_manifest(manifest, args.manifest)
+
+
+def main(args):
+  """
+  Run the preprocessing phase.
+
+  Args:
+    args: The parsed command line arguments.
+  """
+  if args.backend == "spark":
+    # Create new SparkSession
+    spark = (SparkSession.builder
+                         .appName("Breast Cancer -- Preprocessing")
+                         .getOrCreate())
+    # Only replace the slide partitions that are rewritten when saving partitioned outputs.
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+
+    # Ship a fresh copy of the `breastcancer` package to the Spark workers.
+    # Note: The zip must include the `breastcancer` directory itself,
+    # as well as all files within it for `addPyFile` to work correctly.
+    # This is equivalent to `zip -r breastcancer.zip breastcancer`.
+    dirname = "breastcancer"
+    zipname = dirname + ".zip"
+    shutil.make_archive(dirname, 'zip', dirname + "/..", dirname)
+    spark.sparkContext.addPyFile(zipname)
+
+  # Execute Preprocessing & Save
+
+  # TODO: Filtering tiles and then cutting into samples could result
+  # in samples with less tissue than desired, despite that being the
+  # procedure of the paper.  Look into simply selecting tiles of the
+  # desired size to begin with.
+
+  # Get labels
+  labels_df = get_labels_df(args.folder)
+
+  # Split into train and validation sets based on slide number, stratified by class
+  train, val = train_test_split(labels_df, train_size=args.train_frac,
+                                stratify=labels_df['tumor_score'], random_state=args.seed)
+
+  # Process train & val slides, resuming from any previous runs
+  manifest = load_manifest(args.manifest)
+  for split, slides in (("train", train), ("val", val)):
+    if args.backend == "spark":
+      process_split(spark, args, split, sorted(slides.index), manifest)
+    else:
+      process_split_local(args, split, sorted(slides.index), manifest)
+
+
+if __name__ == "__main__":
+  def check_float_range(x, lb, ub):
+    """Argparse utility function for a float type in [lb, ub]."""
+    try:
+      x = float(x)
+    except ValueError as err:
+      raise argparse.ArgumentTypeError(str(err))
+    if x < lb or x > ub:
+      err = "Value should be in [{}, {}]. Got {} instead.".format(lb, ub, x)
+      raise argparse.ArgumentTypeError(err)
+    return x
+
+  # parse args
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--backend", default="spark", choices=["spark", "local"],
+      help="execution backend, where `local` runs on a local process pool without Spark, and "\
+           "only saves JPEGs (default: %(default)s)")
+  parser.add_argument("--processes", type=int,
+      help="number of worker processes for the `local` backend (default: all CPUs)")
+  parser.add_argument("--folder", default="data",
+      help="Linux-filesystem directory from which to read the raw WSI data (default: %(default)s)")
+  parser.add_argument("--save_folder", default="data",
+      help="Hadoop-supported directory in which to save the outputs (default: %(default)s)")
+  parser.add_argument("--manifest",
+      help="local path to the JSON manifest of completed slides "\
+           "(default: `save_folder/preprocess_manifest.json`)")
+  parser.add_argument("--tile_size", type=int, default=256,
+      help="width and height of the square tiles to generate (default: %(default)s)")
+  parser.add_argument("--overlap", type=int, default=0,
+      help="number of pixels by which to overlap the tiles (default: %(default)s)")
+  parser.add_argument("--prescreen_threshold", type=lambda x: check_float_range(x, 0, 1),
+      help="minimum tissue fraction of a tile on a low-resolution tissue mask for the tile to be "\
+           "read at full resolution (default: read all tiles)")
+  parser.add_argument("--tissue_threshold", type=lambda x: check_float_range(x, 0, 1),
+      default=0.9, help="tissue percentage threshold for filtering tiles (default: %(default)s)")
+  parser.add_argument("--tissue_downsample", type=int, default=1,
+      help="integer factor by which to downsample tiles during tissue detection "\
+           "(default: %(default)s)")
+  parser.add_argument("--catalogue_path",
+      help="Hadoop-supported path of a catalogue of the tissue percentages of all tiles, from "\
+           "which to filter tiles against `--tissue_threshold` without reading pixels, and to "\
+           "which any missing slides are added (default: filter by reading the tiles)")
+  parser.add_argument("--sample_size", type=int, default=256,
+      help="width and height of the square samples to cut from the tiles (default: %(default)s)")
+  parser.add_argument("--grayscale", default=False, action="store_true",
+      help="generate grayscale samples, rather than RGB (default: %(default)s)")
+  parser.add_argument("--no_normalize_stains", dest="normalize_stains", default=True,
+      action="store_false", help="do not apply stain normalization")
+  parser.add_argument("--per_slide_stains", default=False, action="store_true",
+      help="estimate the stains once per slide (default: %(default)s)")
+  parser.add_argument("--stain_batch_size", type=int,
+      help="number of samples per batch for vectorized stain normalization "\
+           "(default: normalize one sample at a time)")
+  parser.add_argument("--stain_cache_path",
+      help="path to a JSON file in which to cache the per-slide stains (default: %(default)s)")
+  parser.add_argument("--batch_samples", default=False, action="store_true",
+      help="process the samples of each tile as a single array, with vectorized stain "\
+           "normalization, and name JPEGs by sample coordinates (default: %(default)s)")
+  parser.add_argument("--num_partitions", type=int, default=200,
+      help="number of partitions to use during processing (default: %(default)s)")
+  parser.add_argument("--partition_by_slide", default=False, action="store_true",
+      help="partition the tiles by slide, rather than randomly (default: %(default)s)")
+  parser.add_argument("--tiles_per_partition", type=int, default=1000,
+      help="maximum number of tiles in each partition with `--partition_by_slide`, or of "\
+           "elements (samples, or tiles with `--batch_samples`) in each JPEG shard with the "\
+           "`local` backend (default: %(default)s)")
+  parser.add_argument("--slides_per_job", type=int,
+      help="number of slides to process, and checkpoint, at a time (default: all slides)")
+  parser.add_argument("--no_jpegs", dest="save_jpegs", default=True, action="store_false",
+      help="do not save the samples as JPEGs")
+  parser.add_argument("--jpeg_shards", default=False, action="store_true",
+      help="pack the JPEGs into tar shards, rather than individual files (default: %(default)s)")
+  parser.add_argument("--convert2DF", default=False, action="store_true",
+      help="save the samples as DataFrames (default: %(default)s)")
+  parser.add_argument("--storage", default="vector", choices=["vector", "binary"],
+      help="storage of the samples in the DataFrames, where `binary` DataFrames can also be "
+           "read without Spark by `read_binary_samples` (default: %(default)s)")
+  parser.add_argument("--row_indices", default=False, action="store_true",
+      help="save additional DataFrames with row indices (default: %(default)s)")
+  parser.add_argument("--train_frac", type=lambda x: check_float_range(x, 0, 1), default=0.8,
+      help="decimal percentage of slides to include in the training set during the train/val "\
+           "split (default: %(default)s)")
+  parser.add_argument("--sample_frac", type=lambda x: check_float_range(x, 0, 1), default=0.01,
+      help="decimal percentage of rows of the DataFrames to save in additional sampled "\
+           "DataFrames, or 0 to skip (default: %(default)s)")
+  parser.add_argument("--tile_sample_frac", type=lambda x: check_float_range(x, 0, 1),
+      help="decimal percentage of tiles of each slide to process, sampled deterministically "\
+           "before any pixels are read, in order to directly produce small development "\
+           "datasets, which are saved with a `<frac>_sample` name (default: process all tiles)")
+  parser.add_argument("--seed", type=int, default=42,
+      help="random seed for the train/val split and sampling (default: %(default)s)")
+  args = parser.parse_args()
 
-from breastcancer.preprocessing import add_row_indices, get_labels_df, preprocess, save_df, sample, rdd_2_df, save_rdd_2_jpeg
-
-
-# Create new SparkSession
-spark = (SparkSession.builder
-                     .appName("Breast Cancer -- Preprocessing")
-                     .getOrCreate())
-
-# Ship a fresh copy of the `breastcancer` package to the Spark workers.
-# Note: The zip must include the `breastcancer` directory itself,
-# as well as all files within it for `addPyFile` to work correctly.
-# This is equivalent to `zip -r breastcancer.zip breastcancer`.
-dirname = "breastcancer"
-zipname = dirname + ".zip"
-shutil.make_archive(dirname, 'zip', dirname + "/..", dirname)
-spark.sparkContext.addPyFile(zipname)
-
-
-# Execute Preprocessing & Save
-
-# TODO: Filtering tiles and then cutting into samples could result
-# in samples with less tissue than desired, despite that being the
-# procedure of the paper.  Look into simply selecting tiles of the
-# desired size to begin with.
-
-# Settings
-# TODO: Convert this to a set of parsed command line arguments
-tile_size = 256
-sample_size = 256
-grayscale = False
-num_partitions = 200
-training = True
-save_jpegs = True
-convert2DF = False
-row_indices = False
-train_frac = 0.8
-sample_frac=0.01
-seed = 42
-folder = "data"  # Linux-filesystem directory to read raw WSI data
-save_folder = "data"  # Hadoop-supported directory in which to save DataFrames
-train_rdd_folder_jpeg = os.path.join(save_folder, "train_{}{}".format(sample_size,
-    "_grayscale" if grayscale else ""))
-val_rdd_folder_jpeg = os.path.join(save_folder, "val_{}{}".format(sample_size,
-    "_grayscale" if grayscale else ""))
-
-train_df_path_parquet = os.path.join(save_folder, "train_{}{}.parquet".format(sample_size,
-    "_grayscale" if grayscale else ""))
-val_df_path_parquet = os.path.join(save_folder, "val_{}{}.parquet".format(sample_size,
-    "_grayscale" if grayscale else ""))
-train_sample_path_parquet = os.path.join(save_folder, "train_{}_sample_{}{}.parquet"
-    .format(sample_frac, sample_size, "_grayscale" if grayscale else ""))
-val_sample_path_parquet = os.path.join(save_folder, "val_{}_sample_{}{}.parquet"
-    .format(sample_frac, sample_size, "_grayscale" if grayscale else ""))
-
-
-# Get labels
-labels_df = get_labels_df(folder)
-
-# Split into train and validation sets based on slide number, stratified by class
-train, val = train_test_split(labels_df, train_size=train_frac, stratify=labels_df['tumor_score'],
-                              random_state=seed)
-
-# Process train & val slides
-train_rdd = preprocess(spark, train.index, tile_size=tile_size, sample_size=sample_size,
-                      grayscale=grayscale, num_partitions=num_partitions, folder=folder)
-val_rdd = preprocess(spark, val.index, tile_size=tile_size, sample_size=sample_size,
-                    grayscale=grayscale, num_partitions=num_partitions, folder=folder)
-
-if save_jpegs:
-  save_rdd_2_jpeg(train_rdd, train_rdd_folder_jpeg)
-  save_rdd_2_jpeg(val_rdd, val_rdd_folder_jpeg)
-
-if convert2DF:
-  train_df = rdd_2_df(train_rdd)
-  val_df = rdd_2_df(val_rdd)
-
-  if row_indices:
-    # Add row indices
-    train_df = add_row_indices(train_df)
-    val_df = add_row_indices(val_df)
-
-  # Save train & val DataFrames
-  save_df(train_df, train_df_path_parquet, sample_size, grayscale)
-  save_df(val_df, val_df_path_parquet, sample_size, grayscale)
-
-  if sample_frac > 0:
-    # Sample Data
-    train_df = spark.read.load(train_df_path_parquet)
-    val_df = spark.read.load(val_df_path_parquet)
-    train_sample = sample(train_df, sample_frac, seed)
-    val_sample = sample(val_df, sample_frac, seed)
-
-    # Save sampled DataFrames.
-    save_df(train_sample, train_sample_path_parquet, sample_size, grayscale)
-    save_df(val_sample, val_sample_path_parquet, sample_size, grayscale)
+  # set any other defaults
+  if args.backend == "local" and (args.convert2DF or not args.save_jpegs):
+    parser.error("the `local` backend only supports saving JPEGs")
+  if args.tile_sample_frac is not None:
+    args.sample_frac = 0  # the outputs are already sampled
+  if args.manifest is None:
+    args.manifest = os.path.join(args.save_folder, "preprocess_manifest.json")
+  os.makedirs(os.path.dirname(os.path.abspath(args.manifest)), exist_ok=True)
 
+  # preprocess!
+  main(args)
@@ -1,56 +1,94 @@
 """Preprocessing - mitosis detection"""
 import argparse
+from collections import deque
+import itertools
 import math
+import multiprocessing
 import os
 import shutil
+import time
+import zlib
 
 import numpy as np
 from PIL import Image
 from sklearn.model_selection import train_test_split
 
 
-def create_mask(h, w, coords, size):
+def create_mask(h, w, coords, size, downsample=1, counts=False):
   """Create a binary image mask with locations of mitosis patches.
 
   Areas equal to zero indicate normal regions, while areas equal to one
   indicate mitosis regions.
 
+  If the patches cover many times more area in total than the mask
+  itself, they are all placed at once by marking the corners of each patch in a
+  difference array, and then integrating it with cumulative sums, so
+  the cost is independent of the number and size of the patches.
+
   Args:
     h: Integer height of the mask.
     w: Integer width of the mask.
-    coords: A list-like collection of (row, col) mitosis coordinates.
+    coords: A list-like collection of (row, col) mitosis coordinates,
+      such as a NumPy array of shape (N, 2).
     size: An integer size of the square patches to place on the mask.
+    downsample: An integer factor by which to downsample the mask, in
+      which case each element of the mask covers a block of
+      `downsample` x `downsample` pixels, and is set if any pixel of the
+      block is within a mitosis patch.
+    counts: Whether or not to return the number of mitosis patches
+      covering each element, rather than a binary mask.
 
   Returns:
     A binary mask of the same shape as `im` indicating where the
-    mitosis patches are located.
+    mitosis patches are located, or of shape
+    (ceil(h/downsample), ceil(w/downsample)) if downsampled.  If
+    `counts` is true, an integer mask of the number of patches covering
+    each element is returned instead.
   """
   # check that row, col, and size are within the image bounds
   assert 1 < size <= min(h, w), "size must be >1 and within the bounds of the image"
-
-  # create mitosis patch mask
-  mask = np.zeros((h, w), dtype=np.bool)
-  for row, col in coords:
-    assert 0 <= row <= h, "row is outside of the image height"
-    assert 0 <= col <= w, "col is outside of the image width"
-
-    # (row, col) is the center, so compute upper and lower bounds of patch
-    half_size = round(size / 2)
-    row_lower = row - half_size
-    row_upper = row + half_size
-    col_lower = col - half_size
-    col_upper = col + half_size
-
-    # clip the bounds to the size of the image
-    row_lower = max(0, row_lower)
-    row_upper = min(row_upper, h)
-    col_lower = max(0, col_lower)
-    col_upper = min(col_upper, w)
-
-    # indicate mitosis patch area on mask
-    mask[row_lower:row_upper, col_lower:col_upper] = True
-
-  return mask
+  assert downsample >= 1, "downsample must be an integer >= 1"
+  coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+  rows, cols = coords[:, 0], coords[:, 1]
+  assert np.all((0 <= rows) & (rows <= h)), "row is outside of the image height"
+  assert np.all((0 <= cols) & (cols <= w)), "col is outside of the image width"
+
+  # (row, col) is the center, so compute upper and lower bounds of patches,
+  # clipped to the size of the image
+  half_size = round(size / 2)
+  row_lower = np.clip(rows - half_size, 0, h)
+  row_upper = np.clip(rows + half_size, 0, h)
+  col_lower = np.clip(cols - half_size, 0, w)
+  col_upper = np.clip(cols + half_size, 0, w)
+
+  # map the bounds to the downsampled grid, covering any partially covered blocks
+  mask_h, mask_w = -(-h // downsample), -(-w // downsample)
+  row_lower, col_lower = row_lower // downsample, col_lower // downsample
+  row_upper, col_upper = -(-row_upper // downsample), -(-col_upper // downsample)
+
+  if np.sum((row_upper - row_lower) * (col_upper - col_lower)) < 8 * mask_h * mask_w:
+    # with few patches, it is cheaper to simply place each patch on the mask
+    mask = np.zeros((mask_h, mask_w), dtype=np.int32 if counts else bool)
+    for bounds in zip(row_lower, row_upper, col_lower, col_upper):
+      if counts:
+        mask[bounds[0]:bounds[1], bounds[2]:bounds[3]] += 1
+      else:
+        mask[bounds[0]:bounds[1], bounds[2]:bounds[3]] = True
+    return mask
+
+  # mark the corners of each patch in a difference array, and integrate it
+  diff = np.zeros((mask_h + 1, mask_w + 1), dtype=np.int32)
+  np.add.at(diff, (row_lower, col_lower), 1)
+  np.add.at(diff, (row_lower, col_upper), -1)
+  np.add.at(diff, (row_upper, col_lower), -1)
+  np.add.at(diff, (row_upper, col_upper), 1)
+  np.cumsum(diff, axis=0, out=diff)
+  np.cumsum(diff, axis=1, out=diff)
+  mask = diff[:mask_h, :mask_w]
+
+  if counts:
+    return mask
+  return mask > 0
 
 
 def extract_patch(im, row, col, size):
@@ -157,11 +195,63 @@ def gen_normal_coords(mask, size, stride, threshold):
   assert stride > 0, "stride must be an integer > 0"
   assert 0 <= threshold <= 1, "threshold must be a valid decimal percentage"
 
-  for row, col in gen_dense_coords(h, w, size, stride):
-    # extract patch from mask to check for overlap with mitosis patch
-    mask_patch = np.squeeze(extract_patch(np.atleast_3d(mask), row, col, size))
-    if np.mean(mask_patch) <= threshold:
-      yield row, col
+  for row, col in get_normal_coords(mask, size, stride, threshold).tolist():
+    yield row, col
+
+
+def get_normal_coords(mask, size, stride, threshold):
+  """Get (row, col) coordinates for normal patches.
+
+  This is the vectorized equivalent of `gen_normal_coords`.  Rather
+  than extracting each candidate patch from the mask, a summed-area
+  table of the mask is built once, from which the overlap of every
+  candidate patch in the sliding window with the mitosis patches is
+  computed at once.  Patches extending past the edges of the mask are
+  reflected, as in `extract_patch`.
+
+  Args:
+    mask: A binary mask, indicating where the mitosis patches are
+      located, of the same height and width as the region image.
+    size: An integer size of the square patch to extract.
+    stride: An integer number of pixels by which to shift in the
+      sliding window for normal patches.
+    threshold: A decimal inclusive upper bound on the percentage of
+      allowable overlap with mitosis patches.
+
+  Returns:
+    A NumPy array of shape (N, 2) containing the (row, col) coordinates
+    of the centers of the normal patches, in sliding window order.
+  """
+  # check that size is within the mask bounds
+  assert np.ndim(mask) == 2, "mask must be of shape (h, w)"
+  h, w = mask.shape
+  assert 1 < size <= min(h, w), "size must be > 1 and within the bounds of the image"
+  assert stride > 0, "stride must be an integer > 0"
+  assert 0 <= threshold <= 1, "threshold must be a valid decimal percentage"
+
+  # a patch centered at (row, col) spans [row - half_size, row + half_size), which can
+  # extend past the mask for odd sizes, so reflect the mask by that amount
+  half_size = round(size / 2)
+  pad = max(0, 2*half_size - size)
+  mask = np.pad(mask.astype(np.int64), ((0, pad), (0, pad)), 'reflect')
+
+  # summed-area table, with a leading row & col of zeros
+  table = np.zeros((h + pad + 1, w + pad + 1), dtype=np.int64)
+  np.cumsum(mask, axis=0, out=table[1:, 1:])
+  np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+
+  # overlap of every candidate patch, with the same (row, col) ordering as
+  # `gen_dense_coords`
+  rows = np.arange(0, h-size+1, stride)
+  cols = np.arange(0, w-size+1, stride)
+  rows_upper = rows + 2*half_size
+  cols_upper = cols + 2*half_size
+  overlap = (table[np.ix_(rows_upper, cols_upper)] - table[np.ix_(rows, cols_upper)] -
+             table[np.ix_(rows_upper, cols)] + table[np.ix_(rows, cols)])
+  overlap = overlap / (2*half_size)**2
+
+  row_idx, col_idx = np.nonzero(overlap <= threshold)
+  return np.stack([rows[row_idx], cols[col_idx]], axis=1) + half_size
 
 
 def gen_random_translation(h, w, row, col, max_shift):
@@ -194,7 +284,87 @@ def gen_random_translation(h, w, row, col, max_shift):
   return row_shift, col_shift
 
 
-def gen_patches(im, coords, size, rotations, translations, max_shift, p):
+def get_rotation_grid(bounding_size, size, thetas):
+  """Compute the sampling grids of centered patches of rotated images.
+
+  For each theta, this computes where the pixels of a centered patch of
+  the given size of a bounding patch rotated counter-clockwise by theta
+  degrees about its center are located in the original (unrotated)
+  bounding patch.  This follows the conventions of `PIL.Image.rotate`.
+
+  Args:
+    bounding_size: Integer size of the square bounding patch.
+    size: Integer size of the square centered patches to sample.
+    thetas: An array of shape (N,) of degrees of rotation.
+
+  Returns:
+    A tuple of (rows, cols) float arrays of shape (N, size, size)
+    containing the continuous source coordinates in the bounding patch,
+    where pixel (i, j) is centered at (i + 0.5, j + 0.5).
+  """
+  # PIL computes the inverse transform with the angle negated, and rounds the matrix
+  rads = -np.radians(np.asarray(thetas, dtype=np.float64))
+  cos = np.round(np.cos(rads), 15)[:, np.newaxis, np.newaxis]
+  sin = np.round(np.sin(rads), 15)[:, np.newaxis, np.newaxis]
+
+  # pixel centers of the patch, relative to the center of the bounding patch
+  center = bounding_size / 2
+  offsets = np.arange(size) + 0.5 - size / 2
+  rows = offsets[np.newaxis, :, np.newaxis]
+  cols = offsets[np.newaxis, np.newaxis, :]
+
+  # rotate about the center of the bounding patch
+  return -sin*cols + cos*rows + center, cos*cols + sin*rows + center
+
+
+def interpolate_bilinear(ims, idx, rows, cols):
+  """Sample images at continuous coordinates with bilinear interpolation.
+
+  This follows the conventions of PIL's bilinear filter, such that
+  locations outside of the image are filled with zeros, neighbors are
+  clamped to the edges of the image, and values are truncated.
+
+  Args:
+    ims: A uint8 NumPy array of shape (M, h, w, c) of images.
+    idx: An integer array of shape (N,) indicating the image in `ims`
+      from which to sample each output patch.
+    rows: A float array of shape (N, size, size) of row coordinates,
+      as returned by `get_rotation_grid`.
+    cols: A float array of shape (N, size, size) of col coordinates,
+      as returned by `get_rotation_grid`.
+
+  Returns:
+    A uint8 NumPy array of shape (N, size, size, c).
+  """
+  _, h, w, c = ims.shape
+  valid = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+  rows = rows - 0.5
+  cols = cols - 0.5
+  row_lower = np.floor(rows)
+  col_lower = np.floor(cols)
+  drow = (rows - row_lower)[..., np.newaxis]
+  dcol = (cols - col_lower)[..., np.newaxis]
+  row_lower = row_lower.astype(np.intp)
+  col_lower = col_lower.astype(np.intp)
+
+  # flat indices of the neighbors, clamped to the edges of the images
+  offset = np.asarray(idx)[:, np.newaxis, np.newaxis] * h
+  row0 = (offset + np.clip(row_lower, 0, h-1)) * w
+  row1 = (offset + np.clip(row_lower + 1, 0, h-1)) * w
+  col0 = np.clip(col_lower, 0, w-1)
+  col1 = np.clip(col_lower + 1, 0, w-1)
+
+  pixels = ims.reshape(-1, c)
+  top = pixels.take(row0 + col0, axis=0).astype(np.float64)
+  top += (pixels.take(row0 + col1, axis=0) - top) * dcol
+  bottom = pixels.take(row1 + col0, axis=0).astype(np.float64)
+  bottom += (pixels.take(row1 + col1, axis=0) - bottom) * dcol
+  top += (bottom - top) * drow
+  top[~valid] = 0
+  return top.astype(np.uint8)
+
+
+def gen_patches(im, coords, size, rotations, translations, max_shift, p, batch_size=8):
   """Generate patches with sampling and augmentation from coordinates.
 
   For every set of (row, col) coordinates in `coords`, this function
@@ -202,9 +372,14 @@ def gen_patches(im, coords, size, rotations, translations, max_shift, p):
   combination of some number of rotations evenly-spaced in [0, 180],
   and some number of random translations per rotation.
 
+  Rather than rotating and cropping each patch separately, for each
+  batch of coordinates, a window spanning all translations of each
+  sampled rotation is interpolated from the image with precomputed
+  sampling grids, from which the translated patches are cropped.
+
   NOTE: This function will internally create an uint8 version of `im`
-  in order to use PIL to rotate the image.  It will yield patches
-  converted back to the original type.
+  in order to match PIL rotations.  It will yield patches converted back
+  to the original type.
 
   Args:
     im: An image stored as a NumPy array of shape (h, w, c).
@@ -219,6 +394,8 @@ def gen_patches(im, coords, size, rotations, translations, max_shift, p):
     max_shift: Integer upper bound on the spatial shift range for
       the random translations.
     p: A decimal probability of sampling each patch.
+    batch_size: Integer number of coordinates for which to sample the
+      patches at once.
 
   Returns:
     Yields (patch, row, col, rot, row_shift, col_shift) tuples, where
@@ -235,8 +412,9 @@ def gen_patches(im, coords, size, rotations, translations, max_shift, p):
   assert translations >= 0, "translations must be >0"
   assert max_shift >= 0, "max_shift must be >= 0"
   assert 0 <= p <= 1, "p must be a valid decimal probability"
+  assert batch_size > 0, "batch_size must be an integer > 0"
 
-  # convert to uint8 type in order to use PIL to rotate
+  # convert to uint8 type in order to match PIL rotations
   orig_dtype = im.dtype
   im = im.astype(np.uint8)
 
@@ -260,26 +438,73 @@ def gen_patches(im, coords, size, rotations, translations, max_shift, p):
   # starting with 0 degrees, which equates to a centered patch.
   rads = math.pi / 4  # 45 degrees, which is worst case
   bounding_size = math.ceil((size+2*max_shift) * (math.cos(rads) + math.sin(rads)))
-  row_center = col_center = round(bounding_size / 2)
   # TODO: either emit a warning, or add a parameter to allow empty corners
   assert bounding_size < min(h, w), "patch size is too large to avoid empty corners after rotation"
-
-  for row, col in coords:
-    bounding_patch = Image.fromarray(extract_patch(im, row, col, bounding_size))  # PIL for rotation
-
-    # rotations
-    for theta in np.linspace(0, 180, rotations+1, dtype=int):  # always include 0 degrees
-      rotated_patch = np.asarray(bounding_patch.rotate(theta, Image.BILINEAR))  # then back to numpy
-
-      # random translations
-      shifts = [gen_random_translation(h, w, row, col, max_shift) for _ in range(rotations)]
-      for row_shift, col_shift in [(0, 0)] + shifts:  # always include 0 shift
-        patch = extract_patch(rotated_patch, row_center + row_shift, col_center + col_shift, size)
-        patch = patch.astype(orig_dtype)  # convert back to original data type
-
-        # sample from a Bernoulli distribution with probability `p`
-        if np.random.binomial(1, p):
-          yield patch, row, col, theta, row_shift, col_shift
+  # `extract_patch` yields patches of an even size
+  bounding_size = 2 * round(bounding_size / 2)
+  patch_size = 2 * round(size / 2)
+  # every translation of a rotated patch lies within a centered window of the rotated
+  # bounding patch, so sample that window once per rotation and crop the translations
+  # NOTE: translations are only drawn when there are rotations
+  margin = max_shift if rotations > 0 else 0
+  window_size = patch_size + 2*margin
+  window_lower = (bounding_size - window_size) // 2
+  window_upper = window_lower + window_size
+  thetas = np.linspace(0, 180, rotations+1, dtype=int)  # always include 0 degrees
+  grids = get_rotation_grid(bounding_size, window_size, thetas)
+  interp_chunk_size = max(1, 2**14 // window_size**2)
+
+  coords = iter(coords)
+  while True:
+    batch_coords = list(itertools.islice(coords, batch_size))
+    if not batch_coords:
+      break
+
+    # draw the random translations & samples in the same order as for individual patches
+    windows_info = []  # (coords index, theta index)
+    patches_info = []  # (window index, row, col, theta, row_shift, col_shift)
+    for i, (row, col) in enumerate(batch_coords):
+      for j, theta in enumerate(thetas):
+        # random translations
+        shifts = [gen_random_translation(h, w, row, col, max_shift) for _ in range(rotations)]
+        for row_shift, col_shift in [(0, 0)] + shifts:  # always include 0 shift
+          # sample from a Bernoulli distribution with probability `p`
+          if np.random.binomial(1, p):
+            if not windows_info or windows_info[-1] != (i, j):
+              windows_info.append((i, j))
+            patches_info.append((len(windows_info) - 1, row, col, theta, row_shift, col_shift))
+    if not patches_info:
+      continue
+
+    # rotate the windows of all sampled patches, interpolating all arbitrary rotations at
+    # once, while multiples of 90 degrees are exact
+    bounding_patches = {i: extract_patch(im, *batch_coords[i], bounding_size)
+                        for i, _ in windows_info}
+    windows = [None] * len(windows_info)
+    interp = []
+    for k, (i, j) in enumerate(windows_info):
+      if thetas[j] % 90 == 0:
+        rotated_patch = np.rot90(bounding_patches[i], thetas[j] // 90)
+        windows[k] = rotated_patch[window_lower:window_upper, window_lower:window_upper]
+      else:
+        interp.append(k)
+    # NOTE: the interpolation is memory-bound, so it is performed on chunks of windows that
+    # are small enough to stay in the CPU cache
+    for chunk_start in range(0, len(interp), interp_chunk_size):
+      chunk = interp[chunk_start:chunk_start+interp_chunk_size]
+      idx = [windows_info[k][0] for k in chunk]
+      theta_idx = [windows_info[k][1] for k in chunk]
+      ims = np.stack([bounding_patches[i] for i in idx])
+      rotated_windows = interpolate_bilinear(ims, np.arange(len(idx)), grids[0][theta_idx],
+          grids[1][theta_idx])
+      for k, window in zip(chunk, rotated_windows):
+        windows[k] = window
+
+    for k, row, col, theta, row_shift, col_shift in patches_info:
+      patch = windows[k][margin+row_shift:margin+row_shift+patch_size,
+                         margin+col_shift:margin+col_shift+patch_size]
+      patch = patch.astype(orig_dtype)  # convert back to original data type
+      yield patch, row, col, theta, row_shift, col_shift
 
 
 def save_patch(patch, path, lab, case, region, row, col, rotation, row_shift, col_shift, suffix="",
@@ -316,9 +541,245 @@ def save_patch(patch, path, lab, case, region, row, col, rotation, row_shift, co
   Image.fromarray(patch).save(file_path)
 
 
+# metadata of each patch stored in the index of a set of patch shards
+PATCH_INDEX_COLUMNS = [("label", np.uint8), ("lab", np.uint8), ("case", np.uint8),
+                       ("region", np.uint16), ("row", np.int32), ("col", np.int32),
+                       ("rotation", np.int16), ("row_shift", np.int16), ("col_shift", np.int16)]
+
+
+def get_shard_filename(shard_num):
+  """Get the filename of a patch shard.
+
+  Args:
+    shard_num: Integer shard number.
+
+  Returns:
+    A string filename.
+  """
+  return f"patches-{shard_num:05d}.bin"
+
+
+def save_patches_2_shards(patches, path, shard_size=4096):
+  """Save image patches into shards of raw uint8 arrays.
+
+  Rather than saving each patch to a separate image file, the patches
+  are appended as raw uint8 arrays to shard files containing
+  `shard_size` patches each (except possibly the last one), such that
+  patch `i` is stored in shard `i // shard_size`.  The metadata that
+  would otherwise be encoded in the filenames is stored in a columnar
+  index file, "index.npz", which is written last.  Any existing shards
+  in `path` will be replaced.
+
+  Args:
+    patches: An iterable of (patch, label, lab, case, region, row, col,
+      rotation, row_shift, col_shift) tuples, where patch is a uint8
+      NumPy array of shape (size, size, c), label is 1 for mitosis or 0
+      for normal, and the rest are as in `save_patch`.
+    path: A string path to the folder in which to store the shards.
+    shard_size: Integer number of patches per shard.
+
+  Returns:
+    The integer number of patches saved.
+  """
+  assert shard_size > 0, "shard_size must be an integer > 0"
+  os.makedirs(path, exist_ok=True)
+  for filename in os.listdir(path):  # remove any existing shards
+    if filename.startswith("patches-") or filename == "index.npz":
+      os.remove(os.path.join(path, filename))
+
+  columns = [[] for _ in PATCH_INDEX_COLUMNS]
+  patch_shape = (0, 0, 0)
+  f = None
+  try:
+    for i, (patch, *metadata) in enumerate(patches):
+      if i == 0:
+        patch_shape = patch.shape
+      assert patch.shape == patch_shape, "patches must all be of the same shape"
+      assert patch.dtype == np.uint8, "patches must be of type uint8"
+      if i % shard_size == 0:
+        if f is not None:
+          f.close()
+        f = open(os.path.join(path, get_shard_filename(i // shard_size)), 'wb')
+      f.write(np.ascontiguousarray(patch).tobytes())
+      for column, value in zip(columns, metadata):
+        column.append(int(value))
+  finally:
+    if f is not None:
+      f.close()
+
+  index = {name: np.array(column, dtype=dtype)
+           for (name, dtype), column in zip(PATCH_INDEX_COLUMNS, columns)}
+  index_path = os.path.join(path, "index.npz")
+  with open(index_path + ".tmp", 'wb') as f:
+    np.savez(f, patch_shape=np.array(patch_shape), shard_size=np.array(shard_size), **index)
+  os.replace(index_path + ".tmp", index_path)
+  return len(index["label"])
+
+
+def load_patch_shards(path):
+  """Load image patch shards saved with `save_patches_2_shards`.
+
+  The shards are memory-mapped, so patches are only read from disk as
+  they are accessed.
+
+  Args:
+    path: A string path to the folder containing the shards.
+
+  Returns:
+    A tuple of (shards, index), where shards is a list of read-only
+    uint8 NumPy memmaps of shape (n, size, size, c), and index is a
+    dictionary mapping each of the `PATCH_INDEX_COLUMNS` to a NumPy
+    array containing that column for all patches.  If no patches were
+    saved, shards contains a single empty array of shape (0, 0, 0, 0).
+  """
+  with np.load(os.path.join(path, "index.npz")) as data:
+    index = {name: data[name] for name in data.files}
+  patch_shape = tuple(index.pop("patch_shape"))
+  shard_size = int(index.pop("shard_size"))
+  num_patches = len(index["label"])
+  shards = []
+  for shard_num, start in enumerate(range(0, num_patches, shard_size)):
+    shard_path = os.path.join(path, get_shard_filename(shard_num))
+    shape = (min(shard_size, num_patches - start),) + patch_shape
+    shards.append(np.memmap(shard_path, dtype=np.uint8, mode='r', shape=shape))
+  if not shards:  # no patches, and thus no shard files
+    shards.append(np.empty((0,) + patch_shape, dtype=np.uint8))
+  return shards, index
+
+
+def gather_patches(shards, indices):
+  """Gather image patches from shards loaded with `load_patch_shards`.
+
+  Args:
+    shards: A list of uint8 NumPy arrays of shape (n, size, size, c).
+    indices: An integer array of shape (N,) of patch numbers.
+
+  Returns:
+    A uint8 NumPy array of shape (N, size, size, c).
+  """
+  shard_size = max(len(shards[0]), 1)  # avoid dividing by zero for an empty split
+  shard_nums, offsets = np.divmod(np.asarray(indices, dtype=np.int64), shard_size)
+  patches = np.empty((len(offsets),) + shards[0].shape[1:], dtype=np.uint8)
+  for shard_num in np.unique(shard_nums):
+    in_shard = shard_nums == shard_num
+    patches[in_shard] = shards[shard_num][offsets[in_shard]]
+  return patches
+
+
+def get_region_seed(seed, lab, case, region):
+  """Derive a random seed for a single region image.
+
+  The seed only depends on the base seed and the identity of the
+  region, so that each region yields the same patches regardless of
+  the order or the process in which the regions are processed.
+
+  Args:
+    seed: Integer base random seed, or None.
+    lab: An integer laboratory number.
+    case: A string zero-padded case number.
+    region: A string region number.
+
+  Returns:
+    An integer seed in [0, 2**32), or None if `seed` is None.
+  """
+  if seed is None:
+    return None
+  return zlib.crc32(f"{seed}_{lab}_{case}_{region}".encode())
+
+
+def process_region(region_im_path, coords_path, base_save_path, split_name, lab, case, region,
+    patch_size, rotations, translations, max_shift, stride, overlap_threshold, p, seed=None,
+    save_format="jpg"):
+  """Generate and save the mitosis & normal patches of a region image.
+
+  Args:
+    region_im_path: Path to the region image.
+    coords_path: Path to the CSV file of mitosis (row, col) coordinates
+      for the region.  A missing file indicates no mitoses.
+    base_save_path: Path to folder in which to write the folders of
+      output patches.
+    split_name: String name of the split ("train" or "val").
+    lab: An integer laboratory number from which the region originated.
+    case: A string zero-padded case number from which the region
+      originated.
+    region: A string region number.
+    patch_size: An integer size of the square patch to extract.
+    rotations: Integer number of evenly-spaced rotation augmented
+      patches to extract for each mitosis, in addition to the centered
+      mitosis patch.
+    translations: Integer number of random translation augmented
+      patches to extract for each rotated mitosis patch, in addition to
+      the centered rotated mitosis patch.
+    max_shift: Integer upper bound on the spatial shift range for
+      the random translations.
+    stride: An integer number of pixels by which to shift in the
+      sliding window for normal patches.
+    overlap_threshold: Decimal inclusive upper bound on the percentage
+      of overlap of normal patches with mitosis patches.
+    p: A decimal probability of sampling each normal patch.
+    seed: Integer random seed for NumPy for this region.
+    save_format: String format in which to save the patches.  For "jpg",
+      each patch is saved to a separate JPEG file.  For "shards", the
+      patches are returned instead, so that they can be saved with
+      `save_patches_2_shards`.
+
+  Returns:
+    A tuple of (split_name, lab, case, region, num_mitosis, num_normal,
+    patches) with the number of mitosis and normal patches generated,
+    where patches is a list of (patch, label, lab, case, region, row,
+    col, rotation, row_shift, col_shift) tuples for the "shards"
+    format, or None otherwise.
+  """
+  np.random.seed(seed)
+
+  im = np.array(Image.open(region_im_path))  # get region image
+  h, w, c = im.shape
+  if os.path.isfile(coords_path):
+    coords = np.loadtxt(coords_path, dtype=np.int64, delimiter=',', ndmin=2)
+  else:  # a missing file indicates no mitoses
+    coords = []  # no mitoses
+
+  patches = [] if save_format == "shards" else None
+
+  # mitosis samples:
+  # save a centered patch, as well as rotations and random translations thereof
+  save_path = os.path.join(base_save_path, split_name, "mitosis")
+  num_mitosis = 0
+  patch_gen = gen_patches(im, coords, patch_size, rotations, translations, max_shift, 1)
+  for patch, row, col, rot, row_shift, col_shift in patch_gen:
+    if patches is not None:
+      patches.append((patch, 1, lab, case, region, row, col, rot, row_shift, col_shift))
+    else:
+      save_patch(patch, save_path, lab, case, region, row, col, rot, row_shift, col_shift)
+    num_mitosis += 1
+
+  # normal samples:
+  # sample from all possible normal patches
+  save_path = os.path.join(base_save_path, split_name, "normal")
+  num_normal = 0
+  mask = create_mask(h, w, coords, patch_size)
+  normal_coords = get_normal_coords(mask, patch_size, stride, overlap_threshold)
+  # TODO: rotations & translations for normal patches
+  patch_gen = gen_patches(im, normal_coords, patch_size, 0, 0, max_shift, p)
+  for patch, row, col, rot, row_shift, col_shift in patch_gen:
+    if patches is not None:
+      patches.append((patch, 0, lab, case, region, row, col, rot, row_shift, col_shift))
+    else:
+      save_patch(patch, save_path, lab, case, region, row, col, rot, row_shift, col_shift)
+    num_normal += 1
+
+  return split_name, lab, case, region, num_mitosis, num_normal, patches
+
+
+def _process_region_star(region_args):
+  """Unpack the arguments of `process_region` for `Pool.imap`."""
+  return process_region(*region_args)
+
+
 def preprocess(images_path, labels_path, base_save_path, train_size, patch_size, rotations_train,
     rotations_val, translations_train, translations_val, max_shift, stride_train, stride_val,
-    overlap_threshold, p_train, p_val, seed=None):
+    overlap_threshold, p_train, p_val, seed=None, workers=1, save_format="jpg",
+    shard_size=4096):
   """Generate a mitosis detection patch dataset.
 
   This generates train/val datasets of mitosis/normal image patches for
@@ -334,6 +795,16 @@ def preprocess(images_path, labels_path, base_save_path, train_size, patch_size,
   patch filenames will each contain information about the laboratory
   and case from which the patch originated.
 
+  Region images are processed independently, optionally in parallel
+  with a pool of `workers` processes.  Each region is seeded with a
+  seed derived from `seed` and the identity of the region, so the
+  output is identical regardless of the number of workers.
+
+  The patches can either be saved as separate JPEG files in
+  "{split}/{mitosis|normal}" folders, or as shards of raw uint8 arrays
+  along with an index of the patch metadata in "{split}" folders, which
+  can be loaded with `load_patch_shards`.
+
   Args:
     images_path: Path to folder that contains the mitosis training
       images.
@@ -369,6 +840,13 @@ def preprocess(images_path, labels_path, base_save_path, train_size, patch_size,
     p_val: A decimal probability of sampling each normal patch
       in the validation set.
     seed: Integer random seed for NumPy.
+    workers: Integer number of processes with which to process the
+      region images in parallel.
+    save_format: String format in which to save the patches, either
+      "jpg" for separate JPEG files, or "shards" for shards of raw
+      arrays.
+    shard_size: Integer number of patches per shard for the "shards"
+      format.
   """
   # set numpy seed
   np.random.seed(seed)
@@ -379,7 +857,8 @@ def preprocess(images_path, labels_path, base_save_path, train_size, patch_size,
   lab3 = list(range(49, 74))  # cases 49-73
   labs = {1: lab1, 2: lab2, 3: lab3}
 
-  # generate & save patches
+  # gather the regions to process
+  regions = []
   for lab in range(1, 4):  # 3 labs
     # split cases into train/val sets
     lab_cases = labs.get(lab)
@@ -391,41 +870,81 @@ def preprocess(images_path, labels_path, base_save_path, train_size, patch_size,
     for split_args in [train_args, val_args]:
       # generate samples for this split
       split_name, cases, translations, rotations, p, stride = split_args
+      if save_format == "jpg":
+        for class_name in ["mitosis", "normal"]:
+          save_path = os.path.join(base_save_path, split_name, class_name)
+          if not os.path.exists(save_path):
+            os.makedirs(save_path)  # create if necessary
       for case in cases:
         case = "{:02d}".format(case)  # reformat case to zero-padded 2-character number
         case_path = os.path.join(images_path, case)
-        region_ims = os.listdir(case_path)  # get regions
+        region_ims = sorted(os.listdir(case_path))  # get regions
         for region_im in region_ims:  # a single case may have many available regions
           region, ext = region_im.split('.')  # region number, image file extension
           region_im_path = os.path.join(case_path, region_im)
-          im = np.array(Image.open(region_im_path))  # get region image
-          h, w, c = im.shape
           coords_path = os.path.join(labels_path, case, "{}.csv".format(region))
-          if os.path.isfile(coords_path):
-            coords = np.loadtxt(coords_path, dtype=np.int64, delimiter=',', ndmin=2)
-          else:  # a missing file indicates no mitoses
-            coords = []  # no mitoses
-
-          # mitosis samples:
-          # save a centered patch, as well as rotations and random translations thereof
-          save_path = os.path.join(base_save_path, split_name, "mitosis")
-          if not os.path.exists(save_path):
-            os.makedirs(save_path)  # create if necessary
-          patch_gen = gen_patches(im, coords, patch_size, rotations, translations, max_shift, 1)
-          for patch, row, col, rot, row_shift, col_shift in patch_gen:
-            save_patch(patch, save_path, lab, case, region, row, col, rot, row_shift, col_shift)
+          region_seed = get_region_seed(seed, lab, case, region)
+          regions.append((region_im_path, coords_path, base_save_path, split_name, lab, case,
+              region, patch_size, rotations, translations, max_shift, stride, overlap_threshold, p,
+              region_seed, save_format))
 
-          # normal samples:
-          # sample from all possible normal patches
-          save_path = os.path.join(base_save_path, split_name, "normal")
-          if not os.path.exists(save_path):
-            os.makedirs(save_path)  # create if necessary
-          mask = create_mask(h, w, coords, patch_size)
-          normal_coords_gen = gen_normal_coords(mask, patch_size, stride, overlap_threshold)
-          # TODO: rotations & translations for normal patches
-          patch_gen = gen_patches(im, normal_coords_gen, patch_size, 0, 0, max_shift, p)
-          for patch, row, col, rot, row_shift, col_shift in patch_gen:
-            save_patch(patch, save_path, lab, case, region, row, col, rot, row_shift, col_shift)
+  # generate & save patches
+  # NOTE: shards are written by this process as the regions complete, so the regions of each
+  # split are processed consecutively and in order
+  if save_format == "shards":
+    regions.sort(key=lambda region_args: region_args[3])  # stable sort by split
+
+  def gen_ordered_results(pool, max_pending_regions):
+    # NOTE: unlike `pool.imap`, this keeps a bounded number of regions in flight, so that the
+    # patches of completed regions can't pile up in this process while it writes the shards
+    pending = deque()
+    remaining_regions = iter(regions)
+    while True:
+      while len(pending) < max_pending_regions:
+        region_args = next(remaining_regions, None)
+        if region_args is None:
+          break
+        pending.append(pool.apply_async(process_region, region_args))
+      if not pending:
+        break
+      yield pending.popleft().get()
+
+  if workers > 1:
+    pool = multiprocessing.Pool(workers)
+    if save_format == "shards":
+      results = gen_ordered_results(pool, 2 * workers)
+    else:
+      results = pool.imap_unordered(_process_region_star, regions)
+  else:
+    pool = None
+    results = map(_process_region_star, regions)
+
+  def gen_results():
+    start = time.time()
+    total_mitosis = total_normal = 0
+    for i, result in enumerate(results, 1):
+      split_name, lab, case, region, num_mitosis, num_normal, _ = result
+      total_mitosis += num_mitosis
+      total_normal += num_normal
+      print(f"[{i}/{len(regions)}] {split_name} lab {lab}, case {case}, region {region}: "
+            f"{num_mitosis} mitosis, {num_normal} normal patches "
+            f"({time.time() - start:.1f}s elapsed)")
+      yield result
+    print(f"Saved {total_mitosis} mitosis and {total_normal} normal patches from "
+          f"{len(regions)} regions in {time.time() - start:.1f}s")
+
+  try:
+    if save_format == "shards":
+      for split_name, split_results in itertools.groupby(gen_results(), lambda x: x[0]):
+        patches = (patch for *_, region_patches in split_results for patch in region_patches)
+        save_patches_2_shards(patches, os.path.join(base_save_path, split_name), shard_size)
+    else:
+      for _ in gen_results():
+        pass
+  finally:
+    if pool is not None:
+      pool.terminate()  # all results have been consumed, unless an error occurred
+      pool.join()
 
 
 if __name__ == "__main__":
@@ -486,6 +1005,14 @@ if __name__ == "__main__":
   parser.add_argument("--p_val", type=lambda x: check_float_range(x, 0, 1), default=1,
       help="probability of sampling each normal patch in the validation set (default: %(default)s)")
   parser.add_argument("--seed", type=int, help="random seed for numpy (default: %(default)s)")
+  parser.add_argument("--format", dest="save_format", choices=["jpg", "shards"], default="jpg",
+      help="format in which to save the patches, either as separate JPEG files, or as shards of "\
+           "raw uint8 arrays with an index of the patch metadata (default: %(default)s)")
+  parser.add_argument("--shard_size", type=int, default=4096,
+      help="number of patches per shard for the `shards` format (default: %(default)s)")
+  parser.add_argument("--workers", type=int, default=1,
+      help="number of processes with which to process the region images in parallel "\
+           "(default: %(default)s)")
   args = parser.parse_args()
 
   # set any other defaults
@@ -511,7 +1038,7 @@ if __name__ == "__main__":
   preprocess(args.images_path, args.labels_path, args.save_path, args.train_size, args.patch_size,
       args.rotations_train, args.rotations_val, args.translations_train, args.translations_val,
       args.max_shift, args.stride_train, args.stride_val, args.overlap_threshold,
-      args.p_train, args.p_val, args.seed)
+      args.p_train, args.p_val, args.seed, args.workers, args.save_format, args.shard_size)
 
 
 # ---
@@ -619,6 +1146,39 @@ def test_create_mask():
   assert np.array_equal(mask, correct_mask)
 
 
+def test_create_mask_vectorized():
+  # reference implementation of the original loop-based mask builder
+  def create_mask_reference(h, w, coords, size):
+    mask = np.zeros((h, w), dtype=np.int32)
+    half_size = round(size / 2)
+    for row, col in coords:
+      mask[max(0, row-half_size):min(row+half_size, h),
+           max(0, col-half_size):min(col+half_size, w)] += 1
+    return mask
+
+  h, w = 301, 457
+  rng = np.random.RandomState(0)
+  coords = np.stack([rng.randint(0, h+1, 500), rng.randint(0, w+1, 500)], axis=1)
+  for size in (2, 31, 96):  # sparse and dense patches
+    correct_counts = create_mask_reference(h, w, coords, size)
+    assert np.array_equal(create_mask(h, w, coords, size), correct_counts > 0)
+    assert np.array_equal(create_mask(h, w, coords, size, counts=True), correct_counts)
+
+    # downsampled masks are set wherever any pixel of the block is set
+    for downsample in (2, 4, 7):
+      mask = create_mask(h, w, coords, size, downsample)
+      assert mask.shape == (-(-h // downsample), -(-w // downsample))
+      correct_mask = np.zeros(mask.shape, dtype=bool)
+      for i in range(mask.shape[0]):
+        for j in range(mask.shape[1]):
+          block = correct_counts[i*downsample:(i+1)*downsample, j*downsample:(j+1)*downsample]
+          correct_mask[i, j] = block.max() > 0
+      assert np.array_equal(mask, correct_mask)
+
+  # no mitoses
+  assert not create_mask(h, w, [], 32).any()
+
+
 def test_extract_patch():
   import pytest
 
@@ -804,6 +1364,33 @@ def test_gen_normal_coords():
   assert len(coords) == 0
 
 
+def test_get_normal_coords():
+  def gen_normal_coords_reference(mask, size, stride, threshold):
+    h, w = mask.shape
+    for row, col in gen_dense_coords(h, w, size, stride):
+      mask_patch = np.squeeze(extract_patch(np.atleast_3d(mask), row, col, size))
+      if np.mean(mask_patch) <= threshold:
+        yield row, col
+
+  # matches patch-by-patch overlap filtering, including reflection at the
+  # edges for odd sizes
+  np.random.seed(0)
+  h, w = 53, 71
+  for size in (2, 7, 31, 32, 33):
+    coords = np.random.randint(0, min(h, w), size=(5, 2))
+    mask = create_mask(h, w, coords, size)
+    for stride in (1, 5, size):
+      for threshold in (0, 0.1, 0.25, 1):
+        correct_coords = list(gen_normal_coords_reference(mask, size, stride, threshold))
+        normal_coords = get_normal_coords(mask, size, stride, threshold)
+        assert normal_coords.shape == (len(correct_coords), 2)
+        assert normal_coords.tolist() == [list(c) for c in correct_coords]
+
+  # no normal patches
+  normal_coords = get_normal_coords(np.ones((100, 100)), 100, 2, 0)
+  assert normal_coords.shape == (0, 2)
+
+
 def test_gen_random_translation():
   import pytest
 
@@ -916,3 +1503,118 @@ def test_gen_patches():
   patch_gen = gen_patches(im, coords, size, rotations, translations, max_shift, p)
   assert len(list(patch_gen)) > 0
 
+
+def test_gen_patches_pil_parity():
+  def gen_patches_reference(im, coords, size, rotations, translations, max_shift, p):
+    h, w, c = im.shape
+    rads = math.pi / 4
+    bounding_size = math.ceil((size+2*max_shift) * (math.cos(rads) + math.sin(rads)))
+    row_center = col_center = round(bounding_size / 2)
+    for row, col in coords:
+      bounding_patch = Image.fromarray(extract_patch(im, row, col, bounding_size))
+      for theta in np.linspace(0, 180, rotations+1, dtype=int):
+        rotated_patch = np.asarray(bounding_patch.rotate(theta, Image.BILINEAR))
+        shifts = [gen_random_translation(h, w, row, col, max_shift) for _ in range(rotations)]
+        for row_shift, col_shift in [(0, 0)] + shifts:
+          patch = extract_patch(rotated_patch, row_center + row_shift, col_center + col_shift, size)
+          if np.random.binomial(1, p):
+            yield patch, row, col, theta, row_shift, col_shift
+
+  # matches rotating each patch with PIL, including the random draws
+  np.random.seed(0)
+  h, w = 150, 120
+  im = np.random.randint(0, 256, size=(h, w, 3), dtype=np.uint8)
+  coords = np.random.randint(0, min(h, w), size=(10, 2))
+  for size, rotations, max_shift, p, batch_size in [(32, 5, 8, 1, 8), (15, 12, 2, 0.5, 3),
+                                                    (16, 0, 4, 0.5, 1)]:
+    np.random.seed(1)
+    correct_patches = list(gen_patches_reference(im, coords, size, rotations, 0, max_shift, p))
+    np.random.seed(1)
+    patches = list(gen_patches(im, coords, size, rotations, 0, max_shift, p, batch_size))
+    assert len(patches) == len(correct_patches) > 0
+    for patch, correct_patch in zip(patches, correct_patches):
+      assert patch[1:] == correct_patch[1:]
+      assert patch[0].shape == correct_patch[0].shape
+      assert np.max(np.abs(patch[0].astype(int) - correct_patch[0])) <= 1
+
+
+def test_preprocess_workers(tmpdir):
+  # create a tiny dataset with a single region per case
+  images_path = os.path.join(str(tmpdir), "images")
+  labels_path = os.path.join(str(tmpdir), "labels")
+  np.random.seed(0)
+  for case in range(1, 74):
+    case = "{:02d}".format(case)
+    os.makedirs(os.path.join(images_path, case))
+    os.makedirs(os.path.join(labels_path, case))
+    im = np.random.randint(0, 256, size=(48, 48, 3), dtype=np.uint8)
+    Image.fromarray(im).save(os.path.join(images_path, case, "01.tif"))
+    if int(case) % 2 == 0:
+      coords = np.random.randint(8, 40, size=(2, 2))
+      np.savetxt(os.path.join(labels_path, case, "01.csv"), coords, fmt="%d", delimiter=",")
+
+  def run(workers):
+    save_path = os.path.join(str(tmpdir), f"patches_{workers}")
+    preprocess(images_path, labels_path, save_path, 0.8, 8, 2, 0, 2, 0, 2, 8, 8, 0.25, 0.5, 0.5,
+        seed=1, workers=workers)
+    patches = {}
+    for root, dirs, files in os.walk(save_path):
+      for filename in files:
+        with open(os.path.join(root, filename), 'rb') as f:
+          patches[os.path.relpath(os.path.join(root, filename), save_path)] = f.read()
+    return patches
+
+  # output is identical regardless of the number of workers
+  patches = run(1)
+  assert any(name.startswith(os.path.join("train", "mitosis")) for name in patches)
+  assert any(name.startswith(os.path.join("val", "normal")) for name in patches)
+  assert run(3) == patches
+
+  # shards contain the same patches
+  save_path = os.path.join(str(tmpdir), "shards")
+  preprocess(images_path, labels_path, save_path, 0.8, 8, 2, 0, 2, 0, 2, 8, 8, 0.25, 0.5, 0.5,
+      seed=1, workers=2, save_format="shards", shard_size=10)
+  for split_name in ["train", "val"]:
+    shards, index = load_patch_shards(os.path.join(save_path, split_name))
+    names = []
+    for label, lab, case, region, row, col, rot, row_shift, col_shift in zip(
+        *[index[name] for name, _ in PATCH_INDEX_COLUMNS]):
+      filename = f"{lab}_{case:02d}_{region:02d}_{row}_{col}_{rot}_{row_shift}_{col_shift}.jpg"
+      names.append(os.path.join(split_name, "mitosis" if label else "normal", filename))
+    # NOTE: patches with identical metadata overwrite each other as JPEG files
+    assert sorted(set(names)) == sorted(name for name in patches if name.startswith(split_name))
+    assert len(shards) > 1
+    assert sum(len(shard) for shard in shards) == len(names)
+
+
+def test_patch_shards(tmpdir):
+  # roundtrip
+  np.random.seed(0)
+  path = os.path.join(str(tmpdir), "shards")
+  patches = np.random.randint(0, 256, size=(11, 8, 8, 3), dtype=np.uint8)
+  metadata = np.random.randint(0, 2, size=(11, len(PATCH_INDEX_COLUMNS)))
+  num_patches = save_patches_2_shards(zip(patches, *metadata.T), path, shard_size=4)
+  assert num_patches == 11
+  shards, index = load_patch_shards(path)
+  assert [shard.shape for shard in shards] == [(4, 8, 8, 3), (4, 8, 8, 3), (3, 8, 8, 3)]
+  assert np.array_equal(np.concatenate(shards), patches)
+  for (name, dtype), values in zip(PATCH_INDEX_COLUMNS, metadata.T):
+    assert index[name].dtype == dtype
+    assert np.array_equal(index[name], values)
+  indices = [10, 0, 5, 4, 5]
+  assert np.array_equal(gather_patches(shards, indices), patches[indices])
+
+  # existing shards are replaced
+  save_patches_2_shards(zip(patches[:2], *metadata[:2].T), path, shard_size=4)
+  shards, index = load_patch_shards(path)
+  assert len(shards) == 1 and len(index["label"]) == 2
+  assert sorted(os.listdir(path)) == ["index.npz", get_shard_filename(0)]
+
+  # empty split
+  num_patches = save_patches_2_shards([], path, shard_size=4)
+  assert num_patches == 0
+  shards, index = load_patch_shards(path)
+  assert [shard.shape for shard in shards] == [(0, 0, 0, 0)]
+  assert all(len(index[name]) == 0 for name, _ in PATCH_INDEX_COLUMNS)
+  assert gather_patches(shards, []).shape == (0, 0, 0, 0)
+  assert sorted(os.listdir(path)) == ["index.npz"]
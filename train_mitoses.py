@@ -4,6 +4,7 @@ from datetime import datetime
 import os
 import pickle
 import shutil
+import time
 
 import keras
 from keras import backend as K
@@ -53,14 +54,35 @@ def get_image(filename, patch_size):
     type float32 and values in [0, 1).
   """
   image_string = tf.read_file(filename)
+  return decode_image(image_string, patch_size)
+
+
+def decode_image(image_string, patch_size=None):
+  """Decode and resize an image.
+
+  Args:
+    image_string: String contents of a JPEG image file.
+    patch_size: Integer length to which the square image will be
+      resized, or None to skip the resizing.
+
+  Returns:
+    TensorFlow tensor containing the decoded and resized image with
+    type float32 and values in [0, 1).
+  """
   image = tf.image.decode_jpeg(image_string, channels=3)  # shape (h,w,c), uint8 in [0, 255]
   image = tf.image.convert_image_dtype(image, dtype=tf.float32)  # float32 [0, 1)
-  image = tf.image.resize_images(image, [patch_size, patch_size])  # float32 [0, 1)
+  if patch_size is not None:
+    image = tf.image.resize_images(image, [patch_size, patch_size])  # float32 [0, 1)
   #with tf.control_dependencies([tf.assert_type(image, tf.float32, image.dtype)]):
   return image
 
 
-def preprocess(filename, patch_size, augmentation, model_name):
+# stages of the preprocessing, in order
+INPUT_STAGES = ["read", "decode", "resize", "augment", "normalize"]
+
+
+def preprocess(filename, patch_size, augmentation, model_name, image_string=None,
+    stage="normalize"):
   """Get image and label from filename.
 
   Args:
@@ -70,18 +92,29 @@ def preprocess(filename, patch_size, augmentation, model_name):
     augmentation: Boolean for whether or not to apply random augmentation
       to the image.
     model_name: String indicating the model to use.
+    image_string: Optional string contents of the image file, if it
+      has already been read.
+    stage: String name of the last of the `INPUT_STAGES` to apply.  The
+      earlier stages are used for benchmarking.
 
   Returns:
     Tuple of a TensorFlow image tensor, a binary label, and a filename.
   """
   #  return image_resized, label
+  stage_num = INPUT_STAGES.index(stage)
   label = get_label(filename)
   #label = tf.expand_dims(label, -1)  # make each scalar label a vector of length 1 to match model
-  image = get_image(filename, patch_size)  # float32 in [0, 1)
-  if augmentation:
+  if image_string is None:
+    image_string = tf.read_file(filename)
+  if stage_num < INPUT_STAGES.index("decode"):
+    return image_string, label, filename
+  resize_size = patch_size if stage_num >= INPUT_STAGES.index("resize") else None
+  image = decode_image(image_string, resize_size)  # float32 in [0, 1)
+  if augmentation and stage_num >= INPUT_STAGES.index("augment"):
     image = augment(image)
     image = tf.clip_by_value(image, 0, 1)
-  image = normalize(image, model_name)
+  if stage_num >= INPUT_STAGES.index("normalize"):
+    image = normalize(image, model_name)
   return image, label, filename
 
 
@@ -127,6 +160,409 @@ def augment(image):
   return image
 
 
+def create_cached_dataset(filenames, patch_size, model_name, threads, cache_path):
+  """Create a cached dataset of decoded, resized, and normalized images.
+
+  The images are decoded, resized, and normalized during the first pass
+  over the dataset, and then cached in files at `cache_path` for later
+  passes.  The OS page cache keeps the cache files in memory as long as
+  there is room for them.
+
+  NOTE: In TF 1.x, an in-memory `Dataset.cache("")` lives in the
+  dataset op that is created each time an iterator is initialized with
+  the dataset, such as by the initializer ops that `train` runs at the
+  start of each epoch, so it would be refilled from scratch every
+  epoch.  A file cache persists across re-initializations, since each
+  new dataset op reads the files written by the first completed pass.
+  Thus, the first pass must not be abandoned partway through.
+
+  NOTE: The order of `filenames` is frozen into the cache.
+
+  Args:
+    filenames: A Dataset of string filenames of images.
+    patch_size: Integer length to which the square images will be
+      resized.
+    model_name: String indicating the model to use.
+    threads: Integer number of files to read in parallel.
+    cache_path: String path of the files in which to cache the images.
+
+  Returns:
+    A Dataset of (image, label, filename) elements without augmentation.
+  """
+  return (read_files(filenames, threads)
+      .map(lambda x, image_string: preprocess(x, patch_size, False, model_name, image_string),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+      .cache(cache_path))
+
+
+def augment_batch(images):
+  """Apply random data augmentation to each image in the given batch.
+
+  This is the batched equivalent of `augment`.
+
+  Args:
+    images: A Tensor of shape (n,h,w,c).
+
+  Returns:
+    A batch of data-augmented images.
+  """
+  n = tf.shape(images)[0]
+  flip_up_down = tf.random_uniform([n]) < 0.5
+  images = tf.where(flip_up_down, tf.reverse(images, [1]), images)
+  flip_left_right = tf.random_uniform([n]) < 0.5
+  images = tf.where(flip_left_right, tf.reverse(images, [2]), images)
+  return images
+
+
+def get_shard_batch(shards, index, path, indices):
+  """Get a batch of patches from memory-mapped patch shards.
+
+  Args:
+    shards: A list of uint8 NumPy memmaps of patches, as returned by
+      `preprocess_mitoses.load_patch_shards`.
+    index: A dictionary of NumPy arrays of patch metadata, as returned
+      by `preprocess_mitoses.load_patch_shards`.
+    path: String path to the folder containing the shards.
+    indices: An integer NumPy array of shape (n,) of patch numbers.
+
+  Returns:
+    A tuple of a uint8 NumPy array of shape (n,h,w,c) of images, a
+    float32 NumPy array of shape (n,) of binary labels equal to 1 for
+    mitosis or 0 for normal, and a NumPy array of shape (n,) of bytes
+    filenames in the format of `preprocess_mitoses.save_patch`.
+  """
+  from preprocess_mitoses import gather_patches
+
+  images = gather_patches(shards, indices)
+  labels = index["label"][indices].astype(np.float32)
+  filenames = []
+  for i in indices:
+    label_str = "mitosis" if index["label"][i] else "normal"
+    name = "{}_{:02d}_{:02d}_{}_{}_{}_{}_{}.jpg".format(index["lab"][i], index["case"][i],
+        index["region"][i], index["row"][i], index["col"][i], index["rotation"][i],
+        index["row_shift"][i], index["col_shift"][i])
+    filenames.append(os.path.join(path, label_str, name).encode())
+  return images, labels, np.array(filenames, dtype=object)
+
+
+def preprocess_shard_batch(indices, shards, index, path, patch_size, augmentation, model_name):
+  """Get a batch of images and labels from memory-mapped patch shards.
+
+  Args:
+    indices: An int64 Tensor of shape (n,) of patch numbers.
+    shards: A list of uint8 NumPy memmaps of patches, as returned by
+      `preprocess_mitoses.load_patch_shards`.
+    index: A dictionary of NumPy arrays of patch metadata, as returned
+      by `preprocess_mitoses.load_patch_shards`.
+    path: String path to the folder containing the shards.
+    patch_size: Integer length to which the square images will be
+      resized.
+    augmentation: Boolean for whether or not to apply random augmentation
+      to the images.
+    model_name: String indicating the model to use.
+
+  Returns:
+    Tuple of a TensorFlow batch of images, binary labels, and filenames.
+  """
+  images, labels, filenames = tf.py_func(
+      lambda x: get_shard_batch(shards, index, path, x), [indices],
+      [tf.uint8, tf.float32, tf.string], stateful=False)
+  images.set_shape((None,) + shards[0].shape[1:])
+  labels.set_shape([None])
+  filenames.set_shape([None])
+  images = tf.image.convert_image_dtype(images, dtype=tf.float32)  # float32 [0, 1)
+  if shards[0].shape[1:3] != (patch_size, patch_size):
+    images = tf.image.resize_images(images, [patch_size, patch_size])  # float32 [0, 1)
+  if augmentation:
+    images = augment_batch(images)
+    images = tf.clip_by_value(images, 0, 1)
+  images = normalize(images, model_name)
+  return images, labels, filenames
+
+
+def create_shard_dataset(path, patch_size, batch_size, shuffle, augmentation, model_name):
+  """Create a dataset of batches of patches from memory-mapped shards.
+
+  Rather than decoding separate image files, this reads batches of
+  pre-decoded patches from the shards saved by
+  `preprocess_mitoses.save_patches_2_shards`.  The patches are
+  shuffled by drawing a new permutation of the patch numbers each time
+  the dataset is iterated over, and then batched by slicing the
+  permutation.
+
+  Args:
+    path: String path to the folder containing the shards.
+    patch_size: Integer length to which the square patches will be
+      resized.
+    batch_size: Integer batch size.
+    shuffle: Boolean for whether or not to shuffle the patches.
+    augmentation: Boolean for whether or not to apply random augmentation
+      to the images.
+    model_name: String indicating the model to use.
+
+  Returns:
+    A Dataset of batches of (images, labels, filenames), as for the
+    JPEG datasets.
+  """
+  # NOTE: imported here so that the copy of this script in an experiment folder runs on its own
+  # for JPEG datasets
+  from preprocess_mitoses import load_patch_shards
+
+  shards, index = load_patch_shards(path)
+  num_patches = len(index["label"])
+  if num_patches == 0:
+    raise ValueError(f"no patches were found in the shards at {path}")
+  if shuffle:
+    indices = (tf.data.Dataset.range(1)
+        .flat_map(lambda _: tf.data.Dataset.from_tensor_slices(
+          tf.random_shuffle(tf.range(num_patches, dtype=tf.int64)))))
+  else:
+    indices = tf.data.Dataset.range(num_patches)
+  dataset = (indices
+      .batch(batch_size)
+      .map(lambda x: preprocess_shard_batch(x, shards, index, path, patch_size, augmentation,
+        model_name), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+      .prefetch(tf.data.experimental.AUTOTUNE))
+  return dataset
+
+
+def read_files(filenames, threads, sloppy=False):
+  """Read files in parallel.
+
+  Args:
+    filenames: A Dataset of string filenames.
+    threads: Integer number of files to read in parallel.
+    sloppy: Boolean for whether or not to allow the files to be
+      produced out of order, in favor of throughput.
+
+  Returns:
+    A Dataset of (filename, contents) string pairs.
+  """
+  return filenames.apply(tf.data.experimental.parallel_interleave(
+      lambda x: tf.data.Dataset.from_tensors((x, tf.read_file(x))), cycle_length=threads,
+      sloppy=sloppy))
+
+
+def create_jpeg_dataset(path, patch_size, batch_size, shuffle, augmentation, model_name, threads,
+    stage="normalize"):
+  """Create a dataset of batches of images from folders of JPEG files.
+
+  The files are read in parallel, and then decoded, resized, augmented,
+  normalized, and batched in a fused, autotuned map & batch, with
+  prefetching of the batches.
+
+  Args:
+    path: String path to the generated image patches.  This should
+      contain folders for each class.
+    patch_size: Integer length to which the square patches will be
+      resized.
+    batch_size: Integer batch size.
+    shuffle: Boolean for whether or not to shuffle the patches.
+    augmentation: Boolean for whether or not to apply random augmentation
+      to the images.
+    model_name: String indicating the model to use.
+    threads: Integer number of files to read in parallel.
+    stage: String name of the last of the `INPUT_STAGES` to apply.
+
+  Returns:
+    A Dataset of batches of (images, labels, filenames).
+  """
+  autotune = tf.data.experimental.AUTOTUNE
+  files = tf.data.Dataset.list_files('{}/*/*.jpg'.format(path), shuffle=shuffle)
+  dataset = (read_files(files, threads, sloppy=shuffle)
+      .apply(tf.data.experimental.map_and_batch(lambda x, image_string:
+        preprocess(x, patch_size, augmentation, model_name, image_string, stage), batch_size,
+        num_parallel_calls=autotune))
+      .prefetch(autotune))
+  return dataset
+
+
+def create_datasets(train_path, val_path, patch_size, batch_size, augmentation, model_name,
+    threads, data_format="jpg", cache_path=None, cache_shuffle_buffer=10000):
+  """Create the training and validation datasets.
+
+  Args:
+    train_path: String path to the generated training image patches.
+    val_path: String path to the generated validation image patches.
+    patch_size: Integer length to which the square patches will be
+      resized.
+    batch_size: Integer batch size.
+    augmentation: Boolean for whether or not to apply random augmentation
+      to the training images.
+    model_name: String indicating the model to use.
+    threads: Integer number of files to read in parallel.
+    data_format: String format of the patches, either "jpg" for folders
+      of JPEG files for each class, or "shards" for memory-mapped patch
+      shards saved by `preprocess_mitoses.save_patches_2_shards`.
+    cache_path: Optional string path to a folder in which to cache the
+      decoded, resized, and normalized JPEG images.  If given, the
+      images are cached after the first epoch, so that later epochs only
+      apply the augmentation.
+    cache_shuffle_buffer: Integer number of cached training images from
+      which to shuffle each epoch.
+
+  Returns:
+    A tuple of training and validation Datasets of batches of (images,
+    labels, filenames).
+  """
+  autotune = tf.data.experimental.AUTOTUNE
+  if data_format == "shards":
+    train_dataset = create_shard_dataset(train_path, patch_size, batch_size, True, augmentation,
+        model_name)
+    val_dataset = create_shard_dataset(val_path, patch_size, batch_size, False, False,
+        model_name)
+  elif cache_path is not None:
+    # NOTE: the filenames are shuffled once with a fixed seed so that the first epoch fills
+    # the cache in a random order, and then the cached images are shuffled with a buffer.
+    # the augmentation only consists of flips, which commute with the normalization.
+    train_files = (tf.data.Dataset.list_files('{}/*/*.jpg'.format(train_path), shuffle=False)
+        .shuffle(500000, seed=0, reshuffle_each_iteration=False))
+    train_dataset = create_cached_dataset(train_files, patch_size, model_name, threads,
+        os.path.join(cache_path, "train"))
+    train_dataset = train_dataset.shuffle(cache_shuffle_buffer)
+    if augmentation:
+      train_dataset = train_dataset.apply(tf.data.experimental.map_and_batch(
+          lambda image, label, filename: (augment(image), label, filename), batch_size,
+          num_parallel_calls=autotune))
+    else:
+      train_dataset = train_dataset.batch(batch_size)
+    train_dataset = train_dataset.prefetch(autotune)
+    val_files = tf.data.Dataset.list_files('{}/*/*.jpg'.format(val_path), shuffle=False)
+    val_dataset = (create_cached_dataset(val_files, patch_size, model_name, threads,
+        os.path.join(cache_path, "val"))
+        .batch(batch_size)
+        .prefetch(autotune))
+  else:
+    train_dataset = create_jpeg_dataset(train_path, patch_size, batch_size, True, augmentation,
+        model_name, threads)
+    val_dataset = create_jpeg_dataset(val_path, patch_size, batch_size, False, False, model_name,
+        threads)
+  return train_dataset, val_dataset
+
+
+def create_cache_path(exp_path):
+  """Create an empty folder in which to cache the input images.
+
+  The cache is specific to the current data arguments, so any existing
+  cache is removed.
+
+  Args:
+    exp_path: String path in which to store the model checkpoints, logs,
+      etc. for this experiment.
+
+  Returns:
+    The string path to the cache folder.
+  """
+  cache_path = os.path.join(exp_path, "cache")
+  if os.path.exists(cache_path):
+    shutil.rmtree(cache_path)
+  os.makedirs(cache_path)
+  return cache_path
+
+
+def benchmark_input(dataset, num_batches):
+  """Benchmark an input pipeline on its own.
+
+  This drains batches from the dataset without running a model, timing
+  how long each batch takes to be produced.  The first batch is
+  excluded from the timing, since it includes the startup of the
+  pipeline.
+
+  Args:
+    dataset: A Dataset of batches of (images, labels, filenames).
+    num_batches: Integer number of batches to time.
+
+  Returns:
+    A tuple of the float number of examples per second, and a NumPy
+    array of shape (num_batches,) of batch latencies in seconds.
+  """
+  iterator = dataset.repeat().make_initializable_iterator()
+  images, _, _ = iterator.get_next()
+  batch_size = tf.shape(images)[0]  # only fetch the size to avoid copying the batch
+  with tf.Session() as sess:
+    sess.run(iterator.initializer)
+    sess.run(batch_size)  # warm up
+    num_examples = 0
+    latencies = np.empty(num_batches)
+    start = time.time()
+    for i in range(num_batches):
+      batch_start = time.time()
+      num_examples += sess.run(batch_size)
+      latencies[i] = time.time() - batch_start
+    return num_examples / (time.time() - start), latencies
+
+
+def benchmark_input_epochs(dataset, num_epochs):
+  """Benchmark full epochs of an input pipeline on its own.
+
+  As in `train`, a reinitializable iterator is re-initialized with the
+  dataset at the start of each epoch, so this measures whether a cache
+  filled during the first epoch is actually used by later epochs.
+
+  Args:
+    dataset: A Dataset of batches of (images, labels, filenames).
+    num_epochs: Integer number of epochs to time.
+
+  Returns:
+    A list of the float number of examples per second of each epoch.
+  """
+  iterator = tf.data.Iterator.from_structure(dataset.output_types, dataset.output_shapes)
+  images, _, _ = iterator.get_next()
+  batch_size = tf.shape(images)[0]  # only fetch the size to avoid copying the batch
+  init_op = iterator.make_initializer(dataset)
+  epoch_rates = []
+  with tf.Session() as sess:
+    for _ in range(num_epochs):
+      sess.run(init_op)
+      num_examples = 0
+      start = time.time()
+      while True:
+        try:
+          num_examples += sess.run(batch_size)
+        except tf.errors.OutOfRangeError:
+          break
+      epoch_rates.append(num_examples / (time.time() - start))
+  return epoch_rates
+
+
+def benchmark_input_stages(path, patch_size, batch_size, augmentation, model_name, threads,
+    num_batches):
+  """Benchmark the time spent in each stage of the JPEG input pipeline.
+
+  This benchmarks pipelines truncated after each of the `INPUT_STAGES`,
+  and attributes the increase in the mean batch latency from one
+  truncated pipeline to the next to the added stage.  Since the stages
+  run in parallel, these are wall-clock costs of each stage for the
+  pipeline as a whole.
+
+  Args:
+    path: String path to the generated image patches.  This should
+      contain folders for each class.
+    patch_size: Integer length to which the square patches will be
+      resized.
+    batch_size: Integer batch size.
+    augmentation: Boolean for whether or not to apply random augmentation
+      to the images.
+    model_name: String indicating the model to use.
+    threads: Integer number of files to read in parallel.
+    num_batches: Integer number of batches to time for each stage.
+
+  Returns:
+    A list of (stage, seconds) tuples with the mean time per batch
+    spent in each stage.
+  """
+  stage_times = []
+  prev_latency = 0
+  for stage in INPUT_STAGES:
+    dataset = create_jpeg_dataset(path, patch_size, batch_size, True, augmentation, model_name,
+        threads, stage)
+    _, latencies = benchmark_input(dataset, num_batches)
+    latency = np.mean(latencies)
+    stage_times.append((stage, max(0, latency - prev_latency)))
+    prev_latency = max(prev_latency, latency)
+  return stage_times
+
+
 def create_reset_metric(metric, scope, **metric_kwargs):  # prob safer to only allow kwargs
   """Create a resettable metric.
 
@@ -197,7 +633,8 @@ def initialize_variables(sess):
 
 def train(train_path, val_path, exp_path, model_name, patch_size, batch_size, clf_epochs,
     finetune_epochs, clf_lr, finetune_lr, finetune_momentum, finetune_layers, l2, augmentation,
-    log_interval, threads, checkpoint, resume):
+    log_interval, threads, checkpoint, resume, data_format="jpg", cache=False,
+    cache_shuffle_buffer=10000):
   """Train a model.
 
   Args:
@@ -226,11 +663,20 @@ def train(train_path, val_path, exp_path, model_name, patch_size, batch_size, cl
       to the image.
     log_interval: Integer number of steps between logging during
       training.
-    threads: Integer number of threads for dataset buffering.
+    threads: Integer number of files to read in parallel.
     checkpoint: Boolean flag for whether or not to save a checkpoint
       after each epoch.
     resume: Boolean flag for whether or not to resume training from a
       checkpoint.
+    data_format: String format of the patches, either "jpg" for folders
+      of JPEG files for each class, or "shards" for memory-mapped patch
+      shards saved by `preprocess_mitoses.save_patches_2_shards`.
+    cache: Boolean flag for whether or not to cache the decoded,
+      resized, and normalized JPEG images in files in the experiment
+      folder after the first epoch, so that later epochs only apply the
+      augmentation.
+    cache_shuffle_buffer: Integer number of cached training images from
+      which to shuffle each epoch.
   """
   # TODO: break this out into:
   #   * data gen func
@@ -243,18 +689,12 @@ def train(train_path, val_path, exp_path, model_name, patch_size, batch_size, cl
   # data
   with tf.name_scope("data"):
     # TODO: add data augmentation function
-    train_dataset = (tf.contrib.data.Dataset.list_files('{}/*/*.jpg'.format(train_path))
-        .shuffle(500000)
-        .map(lambda x: preprocess(x, patch_size, augmentation, model_name), num_threads=threads,
-          output_buffer_size=100*batch_size)
-        .batch(batch_size))
-    val_dataset = (tf.contrib.data.Dataset.list_files('{}/*/*.jpg'.format(val_path))
-        .map(lambda x: preprocess(x, patch_size, False, model_name), num_threads=threads,
-          output_buffer_size=100*batch_size)
-        .batch(batch_size))
-
-    iterator = tf.contrib.data.Iterator.from_structure(train_dataset.output_types,
-                                                       train_dataset.output_shapes)
+    cache_path = create_cache_path(exp_path) if cache and data_format == "jpg" else None
+    train_dataset, val_dataset = create_datasets(train_path, val_path, patch_size, batch_size,
+        augmentation, model_name, threads, data_format, cache_path, cache_shuffle_buffer)
+
+    iterator = tf.data.Iterator.from_structure(train_dataset.output_types,
+                                               train_dataset.output_shapes)
     images, labels, filenames = iterator.get_next()
     actual_batch_size = tf.shape(images)[0]
     percent_pos = tf.reduce_mean(labels)  # positive labels are 1
@@ -528,6 +968,9 @@ if __name__ == "__main__":
   parser.add_argument("--patches_path", default=os.path.join("data", "mitoses", "patches"),
       help="path to the generated image patches containing `train` & `val` folders "\
            "(default: %(default)s)")
+  parser.add_argument("--data_format", choices=["jpg", "shards"], default="jpg",
+      help="format of the generated image patches, either folders of JPEG files for each class, "\
+           "or memory-mapped patch shards (default: %(default)s)")
   parser.add_argument("--exp_parent_path", default=os.path.join("experiments", "mitoses", "sanity"),
       help="parent path in which to store experiment folders (default: %(default)s)")
   parser.add_argument("--exp_name", default=None,
@@ -567,9 +1010,24 @@ if __name__ == "__main__":
   parser.add_argument("--log_interval", type=int, default=100,
       help="number of steps between logging during training (default: %(default)s)")
   parser.add_argument("--threads", type=int, default=5,
-      help="number of threads for dataset buffering (default: %(default)s)")
+      help="number of files to read in parallel (default: %(default)s)")
+  parser.add_argument("--cache", default=False, action="store_true",
+      help="cache the decoded, resized, and normalized JPEG images in files in the experiment "\
+           "folder after the first epoch, so that later epochs only apply the augmentation "\
+           "(default: %(default)s)")
+  parser.add_argument("--cache_shuffle_buffer", type=int, default=10000,
+      help="number of cached training images from which to shuffle each epoch "\
+           "(default: %(default)s)")
   parser.add_argument("--resume", default=False, action="store_true",
       help="resume training from a checkpoint (default: %(default)s)")
+  parser.add_argument("--benchmark_input", default=False, action="store_true",
+      help="benchmark the throughput, batch latency, and per-stage time of the input pipelines "\
+           "alone, without training (default: %(default)s)")
+  parser.add_argument("--benchmark_batches", type=int, default=100,
+      help="number of batches to time for `--benchmark_input` (default: %(default)s)")
+  parser.add_argument("--benchmark_epochs", type=int, default=2,
+      help="number of full epochs to time for `--benchmark_input` with `--cache`, e.g. to "\
+           "compare the first epoch that fills the cache to later epochs (default: %(default)s)")
   checkpoint_parser = parser.add_mutually_exclusive_group(required=False)
   checkpoint_parser.add_argument("--checkpoint", dest="checkpoint", action="store_true",
       help="save a checkpoint after each epoch (default: True)")
@@ -601,14 +1059,42 @@ if __name__ == "__main__":
   with open(os.path.join(exp_path, 'args.txt'), 'a') as f:
     f.write(str(args) + "\n")
 
-  # copy this script to the experiment folder
+  # copy this script to the experiment folder, along with the shard loading code if needed
   shutil.copy2(os.path.realpath(__file__), exp_path)
-
-  # train!
-  train(train_path, val_path, exp_path, args.model_name, args.patch_size, args.batch_size,
-      args.clf_epochs, args.finetune_epochs, args.clf_lr, args.finetune_lr, args.finetune_momentum,
-      args.finetune_layers, args.l2, args.augment, args.log_interval, args.threads, args.checkpoint,
-      args.resume)
+  if args.data_format == "shards":
+    shutil.copy2(os.path.join(os.path.dirname(os.path.realpath(__file__)), "preprocess_mitoses.py"),
+        exp_path)
+
+  if args.benchmark_input:
+    # benchmark the input pipelines only
+    cache_path = create_cache_path(exp_path) if args.cache and args.data_format == "jpg" else None
+    train_dataset, val_dataset = create_datasets(train_path, val_path, args.patch_size,
+        args.batch_size, args.augment, args.model_name, args.threads, args.data_format, cache_path,
+        args.cache_shuffle_buffer)
+    if cache_path is not None:
+      # NOTE: this runs first, since the caches must be filled by complete passes
+      for name, dataset in [("train", train_dataset), ("val", val_dataset)]:
+        epoch_rates = benchmark_input_epochs(dataset, args.benchmark_epochs)
+        print("{} input: ".format(name) + ", ".join("epoch {}: {:.1f} examples/sec".format(i, rate)
+            for i, rate in enumerate(epoch_rates, 1)))
+    for name, dataset in [("train", train_dataset), ("val", val_dataset)]:
+      examples_per_sec, latencies = benchmark_input(dataset, args.benchmark_batches)
+      p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+      print("{} input: {:.1f} examples/sec, batch latency p50: {:.2f} ms, p99: {:.2f} ms".format(
+          name, examples_per_sec, p50, p99))
+    if args.data_format == "jpg":
+      # NOTE: the stages are always measured on the uncached training pipeline
+      stage_times = benchmark_input_stages(train_path, args.patch_size, args.batch_size,
+          args.augment, args.model_name, args.threads, args.benchmark_batches)
+      print("train input stages (ms/batch): " + ", ".join(
+          "{}: {:.2f}".format(stage, seconds * 1000) for stage, seconds in stage_times))
+  else:
+    # train!
+    train(train_path, val_path, exp_path, args.model_name, args.patch_size, args.batch_size,
+        args.clf_epochs, args.finetune_epochs, args.clf_lr, args.finetune_lr,
+        args.finetune_momentum, args.finetune_layers, args.l2, args.augment, args.log_interval,
+        args.threads, args.checkpoint, args.resume, args.data_format, args.cache,
+        args.cache_shuffle_buffer)
 
 
 # ---
@@ -647,6 +1133,27 @@ def test_get_label():
     label = sess.run(label_op)
 
 
+def test_get_shard_batch(tmpdir):
+  from preprocess_mitoses import load_patch_shards, save_patches_2_shards
+
+  np.random.seed(0)
+  path = str(tmpdir)
+  patches = np.random.randint(0, 256, size=(5, 8, 8, 3), dtype=np.uint8)
+  metadata = [(1, 1, 3, 5, 713, 348, 0, 0, 0), (0, 2, 24, 1, 10, 20, 90, -2, 3),
+              (0, 3, 70, 12, 5, 6, 0, 0, 0), (1, 1, 3, 5, 700, 350, 36, 1, 1),
+              (0, 1, 3, 5, 32, 32, 0, 0, 0)]
+  save_patches_2_shards([(patch, *meta) for patch, meta in zip(patches, metadata)], path, 2)
+  shards, index = load_patch_shards(path)
+
+  indices = np.array([3, 1, 4])
+  images, labels, filenames = get_shard_batch(shards, index, path, indices)
+  assert np.array_equal(images, patches[indices])
+  assert labels.dtype == np.float32
+  assert np.array_equal(labels, [1, 0, 0])
+  assert filenames[0] == os.path.join(path, "mitosis", "1_03_05_700_350_36_1_1.jpg").encode()
+  assert filenames[1] == os.path.join(path, "normal", "2_24_01_10_20_90_-2_3.jpg").encode()
+
+
 def test_resettable_metric():
   K.clear_session()
   tf.reset_default_graph()